@@ -0,0 +1,202 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# Headless bus benchmark. Runs a set of workloads against each board on the
+# bus (or the simulated bus) and reports throughput, latency percentiles,
+# retry rate and bus utilization.
+#
+#     python3 bench.py --sim
+#     python3 bench.py --adr 0x08 --workload read write-verify -n 1000 --json results.json
+#     python3 bench.py --sim --capture bench.bin      (see bus_capture.py)
+#
+# Workloads
+#     read          read_register() of the write_seq_num register, one at a time
+#     write-verify  write_register_verify() of the write test register, one at a time
+#     mixed         one write-verify to every three reads, one at a time
+#     burst         all write-verifies queued to the bus worker at once
+#
+
+import argparse
+import json
+import math
+import time
+from time import monotonic
+import tc_constants as tcc
+import i2c_comm
+import i2c_transport
+import sim_bus
+import bus_capture
+
+
+def read_once(comm, adr, i):
+    reg, reg_data = comm.read_register(adr, tcc.I2C_REG_WRITE_SEQ_NUM,
+                                       tcc.I2C_REG_ID_LEN + tcc.I2C_WRITE_SEQ_NUM_LEN,
+                                       priority=tcc.PRIORITY_DIAGNOSTICS)
+    return reg >= 0
+
+
+def write_verify_once(comm, adr, i):
+    data = [i % 256, (i + 1) % 256, (i + 2) % 256]
+    uncorrected_errors, re, we, dm = comm.write_register_verify(adr, tcc.I2C_REG_WRITE_TEST, data)
+    return uncorrected_errors == 0
+
+
+def mixed_once(comm, adr, i):
+    return write_verify_once(comm, adr, i) if i % 4 == 0 else read_once(comm, adr, i)
+
+
+def run_sequential(comm, adr, count, operation):
+    """Run operation count times back to back.
+
+    :return: (list of latencies in seconds, number of failed operations)
+    """
+    latencies = []
+    failures = 0
+    for i in range(count):
+        start = monotonic()
+        ok = operation(comm, adr, i)
+        latencies.append(monotonic() - start)
+        failures += not ok
+    return latencies, failures
+
+
+def run_burst(comm, adr, count):
+    """Queue count write-verifies at once. Latency includes the time spent queued."""
+    done_times = [0.0] * count
+
+    def completed(i):
+        return lambda future: done_times.__setitem__(i, monotonic())
+
+    start = monotonic()
+    futures = []
+    for i in range(count):
+        future = comm.submit_to(adr, tcc.PRIORITY_DIAGNOSTICS, comm.write_register_verify, adr,
+                                tcc.I2C_REG_WRITE_TEST, [i % 256, (i + 1) % 256, (i + 2) % 256])
+        future.add_done_callback(completed(i))
+        futures.append(future)
+
+    failures = sum(1 for future in futures if future.result()[0] > 0)
+    return [done - start for done in done_times], failures
+
+
+WORKLOADS = {
+    "read": lambda comm, adr, count: run_sequential(comm, adr, count, read_once),
+    "write-verify": lambda comm, adr, count: run_sequential(comm, adr, count, write_verify_once),
+    "mixed": lambda comm, adr, count: run_sequential(comm, adr, count, mixed_once),
+    "burst": run_burst,
+}
+
+
+def percentile(sorted_values, p):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def bus_counters(comm, adr):
+    """(bus messages, retries, busy seconds) so far, from the bus metrics"""
+    registers = [summary for (metrics_adr, reg), summary in comm.metrics().items() if metrics_adr == adr]
+    messages = sum(summary["transactions"] for summary in registers)
+    retries = sum(summary["retries"] for summary in registers)
+    return messages, retries, comm.busy_time()
+
+
+def run_workload(comm, adr, workload, count):
+    messages_before, retries_before, busy_before = bus_counters(comm, adr)
+    start = monotonic()
+    latencies, failures = WORKLOADS[workload](comm, adr, count)
+    elapsed = monotonic() - start
+    messages_after, retries_after, busy_after = bus_counters(comm, adr)
+
+    messages = messages_after - messages_before
+    retries = retries_after - retries_before
+    latencies.sort()
+    return {
+        "adr": "0x{:02x}".format(adr),
+        "workload": workload,
+        "operations": count,
+        "failures": failures,
+        "elapsed": elapsed,
+        "ops_per_sec": count / elapsed if elapsed > 0 else 0.0,
+        "messages": messages,
+        "messages_per_sec": messages / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {"p50": percentile(latencies, 50) * 1000,
+                       "p95": percentile(latencies, 95) * 1000,
+                       "p99": percentile(latencies, 99) * 1000,
+                       "max": latencies[-1] * 1000 if latencies else 0.0},
+        "retries": retries,
+        "retry_rate": retries / messages if messages else 0.0,
+        "utilization": (busy_after - busy_before) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def print_results(results):
+    print("{:<6}{:<14}{:>9}{:>10}{:>10}{:>9}{:>9}{:>9}{:>9}{:>8}".format(
+        "adr", "workload", "ops", "ops/s", "msgs/s", "p50 ms", "p95 ms", "p99 ms", "retry%", "util%"))
+    for r in results:
+        print("{:<6}{:<14}{:>9}{:>10.1f}{:>10.1f}{:>9.3f}{:>9.3f}{:>9.3f}{:>9.2f}{:>8.1f}".format(
+            r["adr"], r["workload"], r["operations"], r["ops_per_sec"], r["messages_per_sec"],
+            r["latency_ms"]["p50"], r["latency_ms"]["p95"], r["latency_ms"]["p99"],
+            r["retry_rate"] * 100, r["utilization"] * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="I2C bus throughput and latency benchmark")
+    parser.add_argument("--sim", action="store_true", help="benchmark the simulated bus")
+    parser.add_argument("--bus", type=int, default=1, help="I2C bus number (default 1)")
+    parser.add_argument("--adr", type=lambda a: int(a, 0), nargs="+",
+                        help="board addresses (default: every board found on the bus)")
+    parser.add_argument("--workload", nargs="+", choices=sorted(WORKLOADS), default=list(WORKLOADS),
+                        help="workloads to run (default: all)")
+    parser.add_argument("-n", "--count", type=int, default=500, help="operations per workload (default 500)")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--latency", type=float, default=tcc.SIM_LATENCY,
+                        help="simulated bus: seconds of overhead per transaction")
+    parser.add_argument("--nack-rate", type=float, default=0.0, help="simulated bus: NACK probability")
+    parser.add_argument("--corruption-rate", type=float, default=0.0, help="simulated bus: bit flip probability")
+    parser.add_argument("--seed", type=int, help="simulated bus: random seed")
+    parser.add_argument("--capture", help="record the bus traffic to this file (see bus_capture.py)")
+    args = parser.parse_args()
+
+    if args.sim:
+        transport = sim_bus.SimulatedBus(latency=args.latency, nack_rate=args.nack_rate,
+                                         corruption_rate=args.corruption_rate, seed=args.seed)
+    else:
+        transport = i2c_transport.open_transport(args.bus)
+    if args.capture:
+        transport = bus_capture.CaptureTransport(transport)
+    comm = i2c_comm.I2C_Comm(args.bus, transport)
+
+    addresses = args.adr or comm.get_controller_list()
+    boards = [comm.get_device_info(adr) for adr in addresses]
+
+    results = []
+    for adr in addresses:
+        for workload in args.workload:
+            results.append(run_workload(comm, adr, workload, args.count))
+    print_results(results)
+
+    if args.json:
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "transport": "sim" if args.sim else "smbus",
+            "bus": args.bus,
+            "count": args.count,
+            "boards": boards,
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.capture:
+        comm.save_capture(args.capture)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the bus capture. CaptureTransport wraps a transport (see
+# i2c_transport.py) and records every transaction in a ring buffer, which can
+# be saved to a compact binary file and looked at offline.
+#
+#     python3 bus_capture.py summary bus_capture.bin
+#     python3 bus_capture.py replay bus_capture.bin --realtime --save replayed.bin
+#     python3 bus_capture.py compare bus_capture.bin replayed.bin
+#
+# summary   count, errors and duration percentiles of each (adr, reg, op)
+# replay    feed the transactions through a simulated bus with boards at the
+#           captured addresses and compare the durations (a = captured,
+#           b = replayed). --realtime keeps the captured spacing.
+# compare   the summaries of two captures side by side
+#
+# File format: a header (magic, version, wall clock time of the first
+# record) then the records, oldest first. Each record is
+#
+#     time      float64  seconds since the first record
+#     duration  float32  seconds the transaction took
+#     adr, reg, op, result, length, payload length   one byte each
+#     payload   the bytes written or read
+#
+# length is the number of bytes asked for (read) or written (write).
+#
+
+import argparse
+import collections
+import math
+import struct
+import threading
+import time
+from time import sleep, monotonic
+import tc_constants as tcc
+import sim_bus
+
+CAPTURE_MAGIC = b"TCBUSCAP"
+CAPTURE_VERSION = 1
+HEADER = struct.Struct("<8sBd")
+RECORD = struct.Struct("<dfBBBBBB")
+
+# Transaction types
+OP_READ_BLOCK = 0
+OP_WRITE_BLOCK = 1
+OP_WRITE_QUICK = 2
+OP_READ_BYTE = 3
+OP_NAMES = {OP_READ_BLOCK: "read", OP_WRITE_BLOCK: "write", OP_WRITE_QUICK: "quick", OP_READ_BYTE: "byte"}
+
+# Transaction results
+RESULT_OK = 0
+RESULT_IO_ERROR = 1
+
+BOARD_TYPE_UNKNOWN = 0          # as in the board info of get_device_info()
+
+Record = collections.namedtuple("Record", "time duration adr reg op result length payload")
+
+
+class CaptureTransport:
+    def __init__(self, transport, capacity=tcc.CAPTURE_RECORDS):
+        """Transport that records each transaction of the transport it wraps.
+
+        Only the last capacity transactions are kept, so a capture can be left
+        running for a whole session.
+        """
+        self.transport = transport
+        self.ring = collections.deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.start = monotonic()
+
+    def __getattr__(self, name):
+        # anything else (i.e. SimulatedBus.utilization) comes from the wrapped transport
+        return getattr(self.transport, name)
+
+    def record(self, op, adr, reg, length, payload, start, result):
+        entry = encode(Record(start - self.start, monotonic() - start, adr, reg, op, result, length, payload))
+        with self.lock:
+            self.ring.append(entry)
+
+    def read_block(self, adr, reg, length):
+        start = monotonic()
+        try:
+            data = self.transport.read_block(adr, reg, length)
+        except IOError:
+            self.record(OP_READ_BLOCK, adr, reg, length, b"", start, RESULT_IO_ERROR)
+            raise
+        self.record(OP_READ_BLOCK, adr, reg, length, data, start, RESULT_OK)
+        return data
+
+    def write_block(self, adr, reg, data):
+        start = monotonic()
+        try:
+            self.transport.write_block(adr, reg, data)
+        except IOError:
+            self.record(OP_WRITE_BLOCK, adr, reg, len(data), data, start, RESULT_IO_ERROR)
+            raise
+        self.record(OP_WRITE_BLOCK, adr, reg, len(data), data, start, RESULT_OK)
+
+    def write_quick(self, adr):
+        start = monotonic()
+        try:
+            self.transport.write_quick(adr)
+        except IOError:
+            self.record(OP_WRITE_QUICK, adr, 0, 0, b"", start, RESULT_IO_ERROR)
+            raise
+        self.record(OP_WRITE_QUICK, adr, 0, 0, b"", start, RESULT_OK)
+
+    def read_byte(self, adr):
+        start = monotonic()
+        try:
+            value = self.transport.read_byte(adr)
+        except IOError:
+            self.record(OP_READ_BYTE, adr, 0, 1, b"", start, RESULT_IO_ERROR)
+            raise
+        self.record(OP_READ_BYTE, adr, 0, 1, bytes([value & 0xFF]), start, RESULT_OK)
+        return value
+
+    def close(self):
+        self.transport.close()
+
+    def clear(self):
+        with self.lock:
+            self.ring.clear()
+
+    def records(self):
+        """The captured transactions (list of Record), oldest first"""
+        with self.lock:
+            entries = list(self.ring)
+        return [decode(entry)[0] for entry in entries]
+
+    def save(self, file):
+        """Write the captured transactions to file.
+
+        :return: number of transactions written
+        """
+        records = self.records()
+        first = records[0].time if records else 0.0
+        with open(file, "wb") as f:
+            f.write(HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, self.start_time + first))
+            for record in records:
+                # times are saved relative to the oldest record kept
+                f.write(encode(record._replace(time=record.time - first)))
+        return len(records)
+
+
+def encode(record):
+    payload = bytes(record.payload[:255])
+    return RECORD.pack(record.time, record.duration, record.adr, record.reg, record.op, record.result,
+                       record.length, len(payload)) + payload
+
+
+def decode(raw, offset=0):
+    """Return (the Record at offset in raw, offset of the next record)"""
+    t, duration, adr, reg, op, result, length, payload_length = RECORD.unpack_from(raw, offset)
+    offset += RECORD.size
+    return Record(t, duration, adr, reg, op, result, length, raw[offset:offset + payload_length]), \
+        offset + payload_length
+
+
+def load(file):
+    """Read a capture file.
+
+    :return: (wall clock time of the first record, list of Record)
+    """
+    with open(file, "rb") as f:
+        raw = f.read()
+    magic, version, start_time = HEADER.unpack_from(raw)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError("{} isn't a version {} bus capture".format(file, CAPTURE_VERSION))
+
+    records = []
+    offset = HEADER.size
+    while offset + RECORD.size <= len(raw):
+        record, offset = decode(raw, offset)
+        records.append(record)
+    return start_time, records
+
+
+# ############################################################################
+# Offline tools
+# ############################################################################
+def percentile(sorted_values, p):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(1, math.ceil(p / 100 * len(sorted_values))) - 1]
+
+
+def summarize(records):
+    """Return {(adr, reg, op): (count, errors, p50, p99, max duration in seconds)}"""
+    durations = collections.defaultdict(list)
+    errors = collections.Counter()
+    for r in records:
+        durations[(r.adr, r.reg, r.op)].append(r.duration)
+        errors[(r.adr, r.reg, r.op)] += r.result != RESULT_OK
+
+    summary = {}
+    for key in sorted(durations):
+        values = sorted(durations[key])
+        summary[key] = (len(values), errors[key], percentile(values, 50), percentile(values, 99), values[-1])
+    return summary
+
+
+def simulated_boards(records):
+    """A SimulatedBoard at each address that answered in the capture. The board
+    type comes from a captured inventory read if there is one."""
+    board_types = {}
+    for r in records:
+        if r.result != RESULT_OK:
+            continue
+        board_type = board_types.setdefault(r.adr, BOARD_TYPE_UNKNOWN)
+        if r.op == OP_READ_BLOCK and r.reg in (tcc.I2C_REG_INVENTORY_BLOCK_1, tcc.I2C_REG_BOARD_TYPE):
+            offset = 2 if r.reg == tcc.I2C_REG_INVENTORY_BLOCK_1 else 1     # skip reg id (and adr)
+            if len(r.payload) > offset and board_type == BOARD_TYPE_UNKNOWN:
+                board_types[r.adr] = r.payload[offset]
+    return [sim_bus.SimulatedBoard(adr, board_type, "Replay 0x{:02x}".format(adr))
+            for adr, board_type in sorted(board_types.items())]
+
+
+def replay(records, transport, realtime=False):
+    """Send each captured transaction to transport again.
+
+    :param realtime: wait so the transactions start with the captured spacing
+    :return: number of transactions whose result (ok / IO error) differs from the capture
+    """
+    differences = 0
+    start = monotonic()
+    for r in records:
+        if realtime:
+            wait = r.time - (monotonic() - start)
+            if wait > 0:
+                sleep(wait)
+        try:
+            if r.op == OP_READ_BLOCK:
+                transport.read_block(r.adr, r.reg, r.length)
+            elif r.op == OP_WRITE_BLOCK:
+                transport.write_block(r.adr, r.reg, list(r.payload))
+            elif r.op == OP_WRITE_QUICK:
+                transport.write_quick(r.adr)
+            else:
+                transport.read_byte(r.adr)
+            result = RESULT_OK
+        except IOError:
+            result = RESULT_IO_ERROR
+        differences += result != r.result
+    return differences
+
+
+def key_name(key):
+    adr, reg, op = key
+    return "0x{:02x}".format(adr), reg if op in (OP_READ_BLOCK, OP_WRITE_BLOCK) else "", OP_NAMES.get(op, op)
+
+
+def unanswered_probes(summary):
+    """Keys of the probes (scan of the bus) that no board answered"""
+    return [key for key, (count, errors, p50, p99, most) in summary.items()
+            if key[2] in (OP_WRITE_QUICK, OP_READ_BYTE) and count == errors]
+
+
+def print_summary(summary):
+    unanswered = unanswered_probes(summary)
+    print("{:<6}{:>5} {:<6}{:>9}{:>8}{:>10}{:>10}{:>10}".format(
+        "adr", "reg", "op", "count", "errors", "p50 ms", "p99 ms", "max ms"))
+    for key, (count, errors, p50, p99, most) in summary.items():
+        if key in unanswered:
+            continue
+        print("{:<6}{:>5} {:<6}{:>9}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+            *key_name(key), count, errors, p50 * 1000, p99 * 1000, most * 1000))
+    if unanswered:
+        print("{} addresses didn't answer a probe".format(len(unanswered)))
+
+
+def print_comparison(summary_a, summary_b):
+    print("{:<6}{:>5} {:<6}{:>8}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "adr", "reg", "op", "count a", "count b", "p50 a ms", "p50 b ms", "p99 a ms", "p99 b ms"))
+    empty = (0, 0, 0.0, 0.0, 0.0)
+    unanswered = set(unanswered_probes(summary_a)) & set(unanswered_probes(summary_b))
+    for key in sorted(set(summary_a) | set(summary_b)):
+        if key in unanswered:
+            continue
+        a = summary_a.get(key, empty)
+        b = summary_b.get(key, empty)
+        print("{:<6}{:>5} {:<6}{:>8}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+            *key_name(key), a[0], b[0], a[2] * 1000, b[2] * 1000, a[3] * 1000, b[3] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look at, replay and compare bus captures")
+    commands = parser.add_subparsers(dest="command", required=True)
+    summary = commands.add_parser("summary", help="transaction counts and durations of a capture")
+    summary.add_argument("file")
+    replayer = commands.add_parser("replay", help="replay a capture through a simulated bus")
+    replayer.add_argument("file")
+    replayer.add_argument("--realtime", action="store_true", help="keep the captured spacing of the transactions")
+    replayer.add_argument("--latency", type=float, default=tcc.SIM_LATENCY,
+                          help="simulated bus: seconds of overhead per transaction")
+    replayer.add_argument("--save", help="capture the replay to this file (i.e. to compare it)")
+    comparer = commands.add_parser("compare", help="compare the durations of two captures")
+    comparer.add_argument("file_a")
+    comparer.add_argument("file_b")
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        start_time, records = load(args.file)
+        print("{} transactions from {}".format(len(records), time.strftime("%Y-%m-%d %H:%M:%S",
+                                                                          time.localtime(start_time))))
+        print_summary(summarize(records))
+
+    elif args.command == "replay":
+        start_time, records = load(args.file)
+        transport = CaptureTransport(sim_bus.SimulatedBus(simulated_boards(records), latency=args.latency))
+        start = monotonic()
+        differences = replay(records, transport, args.realtime)
+        elapsed = monotonic() - start
+        print("Replayed {} transactions in {:.3f}s (captured over {:.3f}s). {} results differ.".format(
+            len(records), elapsed, records[-1].time + records[-1].duration if records else 0.0, differences))
+        print_comparison(summarize(records), summarize(transport.records()))
+        if args.save:
+            transport.save(args.save)
+
+    else:
+        print_comparison(summarize(load(args.file_a)[1]), summarize(load(args.file_b)[1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the bus metrics: counters and latency histograms for each
+# register of each board, so we can see which board or register is using the
+# bus time and which ones are failing.
+#
+
+import json
+import threading
+import time
+
+
+class LatencyHistogram:
+    SUB_BUCKET_BITS = 3
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        """Log-linear (HDR style) histogram of latencies in microseconds.
+
+        Each power of two is split into SUB_BUCKETS buckets, so a recorded value is
+        known to within 1 / SUB_BUCKETS (12.5%) whatever its size. Recording is an
+        integer bit_length and a list increment.
+        """
+        self.counts = []
+        self.count = 0
+        self.total = 0              # microseconds
+        self.max = 0
+
+    @classmethod
+    def bucket(cls, us):
+        if us < cls.SUB_BUCKETS:
+            return us
+        shift = us.bit_length() - cls.SUB_BUCKET_BITS - 1
+        return ((shift + 1) << cls.SUB_BUCKET_BITS) + (us >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def bucket_limit(cls, index):
+        """Largest value (microseconds) that falls in the bucket"""
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = (index >> cls.SUB_BUCKET_BITS) - 1
+        return ((index % cls.SUB_BUCKETS + cls.SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, seconds):
+        us = int(seconds * 1000000)
+        index = self.bucket(us)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        """Latency (microseconds) p percent of the recorded values are at or below"""
+        if self.count == 0:
+            return 0
+        rank = max(1, -(-p * self.count // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_limit(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {"count": self.count,
+                "mean_us": self.total / self.count if self.count else 0,
+                "p50_us": self.percentile(50),
+                "p95_us": self.percentile(95),
+                "p99_us": self.percentile(99),
+                "max_us": self.max}
+
+
+class RegisterMetrics:
+    def __init__(self):
+        """Counters for one (adr, reg)"""
+        self.transactions = 0       # block reads / writes put on the bus
+        self.retries = 0            # attempts after the first
+        self.io_errors = 0          # NACK / IOError
+        self.errors = {}            # error kind (see retry_policy.py) -> count, for errors found in the data
+        self.busy_time = 0.0        # seconds of bus time
+        self.latency = LatencyHistogram()
+
+    def summary(self):
+        return {"transactions": self.transactions,
+                "retries": self.retries,
+                "io_errors": self.io_errors,
+                "errors": dict(self.errors),
+                "busy_time": self.busy_time,
+                "latency": self.latency.summary()}
+
+
+class BusMetrics:
+    def __init__(self):
+        """Metrics for every (adr, reg) that has seen traffic"""
+        self.lock = threading.Lock()
+        self.registers = {}         # (adr, reg) -> RegisterMetrics
+        self.start_time = time.time()
+
+    def entry(self, adr, reg):
+        metrics = self.registers.get((adr, reg))
+        if metrics is None:
+            metrics = self.registers[(adr, reg)] = RegisterMetrics()
+        return metrics
+
+    def record(self, adr, reg, seconds, ok):
+        """A block read / write of reg at adr took seconds. ok is False on an IOError."""
+        with self.lock:
+            metrics = self.entry(adr, reg)
+            metrics.transactions += 1
+            metrics.busy_time += seconds
+            metrics.latency.record(seconds)
+            if not ok:
+                metrics.io_errors += 1
+
+    def record_error(self, adr, reg, kind):
+        """A transaction got through the bus but its data was bad (i.e. checksum error)"""
+        with self.lock:
+            errors = self.entry(adr, reg).errors
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def record_retry(self, adr, reg):
+        with self.lock:
+            self.entry(adr, reg).retries += 1
+
+    def reset(self):
+        with self.lock:
+            self.registers = {}
+            self.start_time = time.time()
+
+    def snapshot(self):
+        """Return {(adr, reg): summary dict}, busiest register first"""
+        with self.lock:
+            summaries = {key: metrics.summary() for key, metrics in self.registers.items()}
+        return dict(sorted(summaries.items(), key=lambda item: item[1]["busy_time"], reverse=True))
+
+    def dump(self, file):
+        """Write the metrics to file as JSON"""
+        write_report(file, self.snapshot(), time.localtime(self.start_time))
+
+
+def write_report(file, snapshot, start_time=None):
+    """Write a BusMetrics.snapshot() to file as JSON
+
+    :param start_time: time.struct_time the metrics were started or reset, if known
+    """
+    report = {"start_time": None if start_time is None else time.strftime("%Y-%m-%dT%H:%M:%S", start_time),
+              "dump_time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "registers": [dict(adr="0x{:02x}".format(adr), reg=reg, **summary)
+                            for (adr, reg), summary in snapshot.items()]}
+    with open(file, "w") as f:
+        json.dump(report, f, indent=2)
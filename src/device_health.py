@@ -0,0 +1,133 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the per board circuit breaker. A board that stops
+# answering is quarantined so the bus time isn't wasted retrying it.
+#
+
+import threading
+from time import monotonic
+import tc_constants as tcc
+
+# Circuit states
+HEALTH_OK = "ok"                # closed - traffic flows
+HEALTH_OPEN = "open"            # quarantined - traffic fails without touching the bus
+HEALTH_PROBING = "probing"      # half open - one transaction is let through to see if the board is back
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of a bus transaction to a quarantined board"""
+
+
+class BoardHealth:
+    def __init__(self):
+        self.state = HEALTH_OK
+        self.failures = 0               # consecutive failed transactions
+        self.probe_interval = 0.0
+        self.next_probe = 0.0
+        self.before_success = None      # (failures, state) before the last good transaction
+
+
+class DeviceHealth:
+    def __init__(self, threshold=tcc.HEALTH_FAILURE_THRESHOLD, probe_interval=tcc.HEALTH_PROBE_INTERVAL,
+                 max_probe_interval=tcc.HEALTH_MAX_PROBE_INTERVAL):
+        """Circuit breaker for each board.
+
+        After threshold consecutive failed transactions the circuit to a board opens.
+        Transactions to it then fail straight away with CircuitOpenError. Every
+        probe_interval seconds one transaction is let through as a probe. If it works
+        the circuit closes, if not the interval doubles, up to max_probe_interval.
+        """
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.boards = {}                # I2C address -> BoardHealth
+        self.lock = threading.Lock()
+        self.on_change = None
+
+    def set_listener(self, on_change):
+        """on_change(adr, state) is called, from the bus worker, when a board's state changes"""
+        self.on_change = on_change
+
+    def check(self, adr):
+        """Raise CircuitOpenError if no transaction may be sent to adr now. Runs on the bus worker."""
+        board = self.boards.get(adr)
+        if board is None or board.state == HEALTH_OK:
+            return
+        with self.lock:
+            if board.state == HEALTH_OPEN and monotonic() >= board.next_probe:
+                board.state = HEALTH_PROBING
+            else:
+                raise CircuitOpenError("adr 0x{:02x} is quarantined".format(adr))
+        self.notify(adr, HEALTH_PROBING)
+
+    def record(self, adr, ok):
+        """Record the outcome of a transaction to adr. Runs on the bus worker."""
+        board = self.boards.get(adr)
+        if board is None:
+            if ok:
+                return
+            with self.lock:
+                board = self.boards.setdefault(adr, BoardHealth())
+
+        with self.lock:
+            old_state = board.state
+            if ok:
+                board.before_success = (board.failures, board.state)
+                board.failures = 0
+                board.state = HEALTH_OK
+            else:
+                board.failures += 1
+                if board.state == HEALTH_PROBING:
+                    board.probe_interval = min(self.max_probe_interval, board.probe_interval * 2)
+                    board.state = HEALTH_OPEN
+                elif board.state == HEALTH_OK and board.failures >= self.threshold:
+                    board.probe_interval = self.probe_interval
+                    board.state = HEALTH_OPEN
+                if board.state == HEALTH_OPEN:
+                    board.next_probe = monotonic() + board.probe_interval
+            state = board.state
+
+        if state != old_state:
+            if state == HEALTH_OPEN and old_state == HEALTH_OK:
+                print("Board at adr 0x{:02x} isn't answering. Quarantined.".format(adr))
+            elif state == HEALTH_OK:
+                print("Board at adr 0x{:02x} is answering again".format(adr))
+            self.notify(adr, state)
+
+    def record_error(self, adr):
+        """The last transaction to adr got through but its data was bad (i.e. checksum error).
+
+        It was recorded as good, so that is undone and it is counted as a failure.
+        Runs on the bus worker.
+        """
+        with self.lock:
+            board = self.boards.setdefault(adr, BoardHealth())
+            if board.before_success is not None:
+                board.failures, board.state = board.before_success
+                board.before_success = None
+        self.record(adr, False)
+
+    def reset(self, adr):
+        """Forget the history of adr (i.e. a board has been added at that address)"""
+        with self.lock:
+            board = self.boards.pop(adr, None)
+        if board is not None and board.state != HEALTH_OK:
+            self.notify(adr, HEALTH_OK)
+
+    def state(self, adr):
+        board = self.boards.get(adr)
+        return HEALTH_OK if board is None else board.state
+
+    def states(self):
+        """Return {adr: state} of every board that isn't healthy"""
+        with self.lock:
+            return {adr: board.state for adr, board in self.boards.items() if board.state != HEALTH_OK}
+
+    def notify(self, adr, state):
+        if self.on_change is not None:
+            self.on_change(adr, state)
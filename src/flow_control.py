@@ -0,0 +1,122 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the flow controller that paces the messages sent to each
+# board so we go as fast as the board can keep up with.
+#
+
+import threading
+from time import sleep, monotonic
+import tc_constants as tcc
+
+
+class DevicePacing:
+    def __init__(self, spacing):
+        """Pacing state for one board
+
+        :param spacing: initial seconds between the end of one message and the start of the next
+        """
+        self.spacing = spacing
+        self.next_allowed = 0
+        self.round_trip = 0.0           # smoothed message time (seconds)
+        self.error_rate = 0.0           # smoothed fraction of messages failing
+        self.messages = 0
+        self.errors = 0
+
+
+class FlowController:
+    def __init__(self, initial_spacing=tcc.FLOW_INITIAL_SPACING, min_spacing=tcc.FLOW_MIN_SPACING,
+                 max_spacing=tcc.FLOW_MAX_SPACING, step=tcc.FLOW_SPACING_STEP,
+                 recovery=tcc.FLOW_RECOVERY, max_backoff=tcc.FLOW_MAX_BACKOFF):
+        """Adaptive pacing of messages, per board.
+
+        Each failure doubles the spacing to that board, plus step, but adds no more than
+        max_backoff, up to max_spacing. Each good message shrinks the spacing above
+        min_spacing to recovery of what it was, less step. So a board backs off quickly
+        from a burst of errors, comes back in a few tens of good messages, and a steady
+        trickle of errors (i.e. a noisy bus) only costs a few ms. Boards that keep up
+        end up at min_spacing; a struggling board is backed off without slowing down
+        the others.
+        """
+        self.initial_spacing = initial_spacing
+        self.min_spacing = min_spacing
+        self.max_spacing = max_spacing
+        self.step = step
+        self.recovery = recovery
+        self.max_backoff = max_backoff
+        self.hold_until = 0             # no messages to anyone before this time
+        self.devices = {}               # I2C address -> DevicePacing
+        self.lock = threading.Lock()
+
+    def hold(self, seconds):
+        """Hold all traffic for the given time (i.e. to let the bus settle after opening)"""
+        self.hold_until = monotonic() + seconds
+
+    def device(self, adr):
+        with self.lock:
+            if adr not in self.devices:
+                self.devices[adr] = DevicePacing(self.initial_spacing)
+            return self.devices[adr]
+
+    def ready_time(self, adr):
+        """monotonic() time from which we may send to adr"""
+        pacing = self.devices.get(adr)
+        return self.hold_until if pacing is None else max(self.hold_until, pacing.next_allowed)
+
+    def wait(self, adr):
+        """Wait until we are allowed to send to adr. Runs on the bus worker.
+
+        The bus worker sets aside operations for a board until it is ready (see
+        BusWorker.submit_to()), so this only waits between the messages of one operation.
+        """
+        delay = self.ready_time(adr) - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def record(self, adr, round_trip, ok):
+        """Record the outcome of a message to adr and set the spacing before the next one.
+
+        :param round_trip: seconds the message took
+        :param ok: False if the message failed (i.e. NACK / IOError)
+        """
+        pacing = self.device(adr)
+        with self.lock:
+            pacing.messages += 1
+            pacing.round_trip += tcc.FLOW_SMOOTHING * (round_trip - pacing.round_trip)
+            if ok:
+                pacing.error_rate -= tcc.FLOW_SMOOTHING * pacing.error_rate
+                gap = (pacing.spacing - self.min_spacing) * self.recovery - self.step
+                pacing.spacing = self.min_spacing + max(0.0, gap)
+            else:
+                self.back_off(pacing)
+            pacing.next_allowed = monotonic() + pacing.spacing
+
+    def record_error(self, adr):
+        """The last message to adr got through the bus but turned out to be bad (i.e. checksum error).
+
+        The message has already been recorded, so this only counts it as a failure.
+        """
+        pacing = self.device(adr)
+        with self.lock:
+            self.back_off(pacing)
+            pacing.next_allowed = max(pacing.next_allowed, monotonic() + pacing.spacing)
+
+    def back_off(self, pacing):
+        """Count a failure against pacing. Called with the lock held."""
+        pacing.errors += 1
+        pacing.error_rate += tcc.FLOW_SMOOTHING * (1 - pacing.error_rate)
+        backoff = min(pacing.spacing + self.step, self.max_backoff)
+        pacing.spacing = min(self.max_spacing, pacing.spacing + backoff)
+
+    def pacing(self):
+        """Snapshot of the current pacing, for the diagnostics tab.
+
+        :return: dict of I2C address -> (spacing, round_trip, error_rate, messages, errors)
+        """
+        with self.lock:
+            return {adr: (p.spacing, p.round_trip, p.error_rate, p.messages, p.errors)
+                    for adr, p in self.devices.items()}
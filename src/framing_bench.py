@@ -0,0 +1,118 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# Micro-benchmark of the message framing. Compares the list based framing
+# I2C_Comm used to do with the i2c_framing module. No I2C bus is needed.
+#
+#     python3 framing_bench.py [-n NUMBER]
+#
+
+import argparse
+import timeit
+import tc_constants as tcc
+import i2c_framing
+
+
+# ############################################################################
+# The list based framing, as it was in I2C_Comm
+# ############################################################################
+def list_validate_checksum(data):
+    checksum = 0
+    for element in data:
+        checksum += element
+    return checksum % 256
+
+
+def list_gen_checksum(reg, buffer):
+    check_sum = reg
+    for element in buffer:
+        check_sum += element
+    return -(check_sum % 256)
+
+
+def list_write_frame(reg, seq_num, data):
+    cs = list_gen_checksum(reg, [seq_num] + data)
+    return [seq_num] + data + [cs]
+
+
+def list_parse_reply(reg_data, length):
+    reg_data = list(reg_data)          # the SMBus read hands back a fresh list
+    if len(reg_data) == length and list_validate_checksum(reg_data) == 0:
+        cmd = reg_data.pop(0)
+        reg_data.pop(-1)
+        return cmd, reg_data
+    return None, None
+
+
+def list_verify_seq_num(read_data, seq_num):
+    read_data = list(read_data)
+    if list_validate_checksum(read_data) == 0:
+        read_data.pop(-1)
+        return read_data == [tcc.I2C_REG_WRITE_SEQ_NUM, seq_num]
+    return False
+
+
+# ############################################################################
+# The same operations using i2c_framing
+# ############################################################################
+frame_buffer = i2c_framing.FrameBuffer()
+bytes_write_frame = frame_buffer.write_frame        # as I2C_Comm calls it, one bound method call
+
+
+def bytes_verify_seq_num(read_data, seq_num):
+    return bytes(read_data) == i2c_framing.SEQ_NUM_REPLIES[seq_num]
+
+
+def run(number):
+    reg = tcc.I2C_REG_LIGHT_POWER_LEVEL_BATCH
+    light_data = [tcc.I2C_LIGHT_BATCH_MAX_PAIRS] + list(range(2 * tcc.I2C_LIGHT_BATCH_MAX_PAIRS))
+    throttle_data = [50]
+    status_reply = list(i2c_framing.reply_frame(tcc.I2C_REG_DT_STATUS_BLOCK, [1, 1, 0, 50, 48, 0]))
+    inventory_reply = list(i2c_framing.reply_frame(tcc.I2C_REG_INVENTORY_BLOCK_2,
+                                                   range(tcc.I2C_INVENTORY_BLOCK_2_LEN)))
+    seq_reply = list(i2c_framing.SEQ_NUM_REPLIES[123])
+
+    cases = [
+        ("write frame, 1 byte",
+         lambda: list_write_frame(tcc.I2C_REG_DT_POWER_LEVEL, 123, throttle_data),
+         lambda: bytes_write_frame(tcc.I2C_REG_DT_POWER_LEVEL, 123, throttle_data)),
+        ("write frame, light batch",
+         lambda: list_write_frame(reg, 123, light_data),
+         lambda: bytes_write_frame(reg, 123, light_data)),
+        ("verify seq num",
+         lambda: list_verify_seq_num(seq_reply, 123),
+         lambda: bytes_verify_seq_num(seq_reply, 123)),
+        ("parse status block",
+         lambda: list_parse_reply(status_reply, len(status_reply)),
+         lambda: i2c_framing.parse_reply(status_reply, len(status_reply))),
+        ("parse inventory block",
+         lambda: list_parse_reply(inventory_reply, len(inventory_reply)),
+         lambda: i2c_framing.parse_reply(inventory_reply, len(inventory_reply))),
+    ]
+
+    print("{:<26}{:>12}{:>12}{:>10}".format("operation", "list (us)", "bytes (us)", "speedup"))
+    for name, list_func, bytes_func in cases:
+        list_time = min(timeit.repeat(list_func, number=number, repeat=5)) / number * 1e6
+        bytes_time = min(timeit.repeat(bytes_func, number=number, repeat=5)) / number * 1e6
+        print("{:<26}{:>12.3f}{:>12.3f}{:>9.1f}x".format(name, list_time, bytes_time, list_time / bytes_time))
+
+
+def check():
+    """Make sure both framings put the same bytes on the wire"""
+    for data in ([0], [255], [7, 8, 9], list(range(29))):
+        for seq_num in (0, 1, 255):
+            old = bytes(b % 256 for b in list_write_frame(42, seq_num, data))
+            new = bytes(bytes_write_frame(42, seq_num, data))
+            assert old == new, (data, seq_num, old, new)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the I2C message framing")
+    parser.add_argument("-n", "--number", type=int, default=100000, help="calls per timing run")
+    args = parser.parse_args()
+    check()
+    run(args.number)
@@ -8,27 +8,432 @@
 #
 
 import tc_constants as tcc
-import subprocess
-from time import sleep
-from smbus2 import SMBus
+import i2c_framing
+import threading
+import itertools
+import heapq
+import queue
+from collections import namedtuple
+from queue import PriorityQueue
+from concurrent.futures import Future
+from time import sleep, monotonic
+from i2c_transport import SMBusTransport
+from flow_control import FlowController
+from device_health import DeviceHealth, HEALTH_OPEN
+from shadow_registers import ShadowRegisters
+from bus_metrics import BusMetrics
+from bus_capture import CaptureTransport
+import retry_policy
+from retry_policy import RetryPolicy
+
+# Layout of the inventory version 2 block registers.
+# Each field is (board_info key, length, is_string)
+INVENTORY_V2_BLOCKS = (
+    (tcc.I2C_REG_INVENTORY_BLOCK_1, tcc.I2C_INVENTORY_BLOCK_1_LEN,
+     (("i2cAddress", tcc.I2C_I2C_ADR_LEN, False),
+      ("boardType", tcc.I2C_BOARD_TYPE_LEN, False),
+      ("boardDescription", tcc.I2C_BOARD_DESCRIPTION_LEN, True),
+      ("boardVersion", tcc.I2C_BOARD_VERSION_LEN, False))),
+    (tcc.I2C_REG_INVENTORY_BLOCK_2, tcc.I2C_INVENTORY_BLOCK_2_LEN,
+     (("i2cCommSwVersion", tcc.I2C_I2C_COMM_SW_VERSION_LEN, True),
+      ("inventorySwVersion", tcc.I2C_INVENTORY_SW_VERSION_LEN, True),
+      ("applicationSwVersion", tcc.I2C_APP_SW_VERSION_LEN, True))),
+)
+
+# Decoded I2C_REG_DT_STATUS_BLOCK. Fields are in register order.
+ThrottleStatus = namedtuple('ThrottleStatus',
+                            ['power_status', 'direction', 'momentum', 'power_level', 'speed', 'emergency_stop'])
+
+# The registers a throttle status block covers, for boards without one. (register, length)
+THROTTLE_STATUS_REGISTERS = ((tcc.I2C_REG_DT_POWER_STATUS, tcc.I2C_DT_POWER_STATUS_LEN),
+                             (tcc.I2C_REG_DT_DIRECTION, tcc.I2C_DT_DIRECTION_LEN),
+                             (tcc.I2C_REG_DT_MOMENTUM, tcc.I2C_DT_MOMENTUM_LEN),
+                             (tcc.I2C_REG_DT_POWER_LEVEL, tcc.I2C_DT_POWER_LEVEL_LEN),
+                             (tcc.I2C_REG_DT_SPEED, tcc.I2C_DT_SPEED_LEN),
+                             (tcc.I2C_REG_DT_EMERGENCY_STOP, tcc.I2C_DT_EMERGENCY_STOP_LEN))
+
+# Throttle status block register -> first register it covers. The status block starts
+# with the power status, direction, momentum and power level settings.
+THROTTLE_STATUS_BLOCKS = {tcc.I2C_REG_DT_STATUS_BLOCK + tcc.DT_THROTTLE_ALLOCATION * instance:
+                          tcc.I2C_REG_DT_POWER_STATUS + tcc.DT_THROTTLE_ALLOCATION * instance
+                          for instance in (0, 1)}
+THROTTLE_STATUS_SETTINGS = 4
+
+# An emergency stop changes a throttle's settings behind our back
+EMERGENCY_STOP_REGISTERS = tuple(tcc.I2C_REG_DT_EMERGENCY_STOP + tcc.DT_THROTTLE_ALLOCATION * instance
+                                 for instance in (0, 1))
+
+
+class BusWorker(threading.Thread):
+    def __init__(self, bus, transport=None):
+        """The bus worker is the only thread that touches the bus transport.
+
+        Work is submitted as a callable along with a priority (see the PRIORITY_xxx
+        values in tc_constants). The worker drains its queue lowest priority number
+        first, FIFO within a priority, and hands the result back via a Future.
+        Work for a board the flow controller is holding off is set aside until the
+        board is ready, and the rest of the queue goes ahead in the meantime.
+
+        :param bus: I2C bus number (i.e. 1 for /dev/i2c-1)
+        :param transport: see i2c_transport.py. Defaults to the SMBus on the given bus.
+        """
+        threading.Thread.__init__(self, name="i2c-bus-{}".format(bus), daemon=True)
+        self.transport = SMBusTransport(bus) if transport is None else transport
+        self.flow_control = FlowController()
+        self.metrics = BusMetrics()
+        self.health = DeviceHealth()
+        self.queue = PriorityQueue()
+        self.sequence = itertools.count()       # keeps the queue FIFO within a priority
+        self.busy_time = 0.0                    # seconds spent in block reads / writes
+
+    def submit(self, priority, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be run on the bus worker.
+
+        :return: Future holding the result of the call
+        """
+        return self.submit_to(None, priority, func, *args, **kwargs)
+
+    def submit_to(self, adr, priority, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), which talks to the board at adr. See submit().
+
+        It isn't run before the flow controller is ready for adr.
+        """
+        future = Future()
+        self.queue.put((priority, next(self.sequence), adr, future, func, args, kwargs))
+        return future
+
+    def execute(self, priority, func, *args, **kwargs):
+        """Run func on the bus worker and wait for the result.
+
+        If we are already running on the worker, the call is made directly. This
+        allows bus operations to be composed of other bus operations.
+        """
+        return self.execute_for(None, priority, func, *args, **kwargs)
+
+    def execute_for(self, adr, priority, func, *args, **kwargs):
+        """execute() func, which talks to the board at adr. See submit_to()."""
+        if threading.current_thread() is self:
+            return func(*args, **kwargs)
+        return self.submit_to(adr, priority, func, *args, **kwargs).result()
+
+    def read_block(self, adr, reg, length):
+        """Block read, paced by the flow controller. Runs on the bus worker.
+
+        Raises CircuitOpenError, without touching the bus, if the board is quarantined.
+        """
+        self.health.check(adr)
+        self.flow_control.wait(adr)
+        start = monotonic()
+        try:
+            data = self.transport.read_block(adr, reg, length)
+        except IOError:
+            self.record(adr, reg, start, False)
+            raise
+        self.record(adr, reg, start, True)
+        return data
+
+    def write_block(self, adr, reg, data):
+        """Block write, paced by the flow controller. Runs on the bus worker. See read_block()"""
+        self.health.check(adr)
+        self.flow_control.wait(adr)
+        start = monotonic()
+        try:
+            self.transport.write_block(adr, reg, data)
+        except IOError:
+            self.record(adr, reg, start, False)
+            raise
+        self.record(adr, reg, start, True)
+
+    def probe(self, adr, read=False):
+        """Address probe, paced by the flow controller. Runs on the bus worker.
+
+        Probes go through even if the board is quarantined, a board that answers is
+        healthy again. No answer only counts against a board we already know of, an
+        empty address isn't a failing board. Probes aren't register traffic so they
+        aren't in the bus metrics.
+
+        :param read: True for a read byte probe, False for a quick write
+        :return: True if a device acknowledges at adr
+        """
+        known = adr in self.flow_control.devices
+        self.flow_control.wait(adr)
+        start = monotonic()
+        try:
+            if read:
+                self.transport.read_byte(adr)
+            else:
+                self.transport.write_quick(adr)
+        except IOError:
+            if known:
+                self.record_probe(adr, start, False)
+            else:
+                self.busy_time += monotonic() - start
+            return False
+        self.record_probe(adr, start, True)
+        return True
+
+    def record_probe(self, adr, start, ok):
+        round_trip = monotonic() - start
+        self.busy_time += round_trip
+        self.flow_control.record(adr, round_trip, ok)
+        self.health.record(adr, ok)
+
+    def record(self, adr, reg, start, ok):
+        round_trip = monotonic() - start
+        self.busy_time += round_trip
+        self.flow_control.record(adr, round_trip, ok)
+        self.metrics.record(adr, reg, round_trip, ok)
+        self.health.record(adr, ok)
+
+    def record_error(self, adr, reg, error):
+        """A transaction got through but its data was bad. error is one of the retry_policy.ERROR_xxx"""
+        self.flow_control.record_error(adr)
+        self.metrics.record_error(adr, reg, error)
+        self.health.record_error(adr)
+
+    def run(self):
+        deferred = []           # heap of (ready time, seq, work) set aside for their board's pacing
+        while True:
+            now = monotonic()
+            while deferred and deferred[0][0] <= now:
+                self.queue.put(heapq.heappop(deferred)[2])
+            try:
+                work = self.queue.get(timeout=deferred[0][0] - now if deferred else None)
+            except queue.Empty:
+                continue
+
+            priority, seq, adr, future, func, args, kwargs = work
+            if adr is not None:
+                ready = self.flow_control.ready_time(adr)
+                if ready > monotonic():
+                    heapq.heappush(deferred, (ready, seq, work))
+                    continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
 
 
 class I2C_Comm:
-    def __init__(self, bus):
-        self.smbus = SMBus(bus=bus)
-        self.write_seq_num = 0
-        sleep(1)   # give the bus a chance to settle
+    def __init__(self, bus, transport=None):
+        """
+        :param bus: I2C bus number
+        :param transport: see i2c_transport.py (i.e. a sim_bus.SimulatedBus).
+                          Defaults to the SMBus on the given bus.
+        """
+        self.bus = bus
+        self.bus_worker = BusWorker(bus, transport)
+        self.write_seq_num = 0              # only touched on the bus worker
+        self.frames = i2c_framing.FrameBuffer()     # only touched on the bus worker
+        self.callback_dispatcher = None     # how completion callbacks get back to the GUI thread
+        self.coalesce_lock = threading.Lock()
+        self.coalesced_writes = {}          # (adr, reg) -> (data, callback) waiting to be written
+        self.coalesced_write_time = {}      # (adr, reg) -> time of the last coalesced write
+        self.shadow = ShadowRegisters()     # last confirmed value of each board register
+        self.retry_policy = RetryPolicy()
+        # give the bus a chance to settle. Traffic is held, the caller isn't.
+        self.bus_worker.flow_control.hold(tcc.I2C_SETTLE_TIME)
+        self.bus_worker.start()
+
+    def submit(self, priority, func, *args, **kwargs):
+        """Queue a bus operation and return a Future for its result.
+
+        func is typically one of the I2C_Comm methods, for example:
+            i2c_comm.submit(tcc.PRIORITY_LIGHTS, i2c_comm.write_register_verify, adr, reg, data)
+        """
+        return self.bus_worker.submit(priority, func, *args, **kwargs)
+
+    def submit_to(self, adr, priority, func, *args, **kwargs):
+        """Queue a bus operation for the board at adr. See submit().
+
+        It waits in the queue while the flow controller is holding off adr, without
+        holding up work for other boards. MultiBusComm queues it to the worker of the
+        bus the board is on.
+        """
+        return self.bus_worker.submit_to(adr, priority, func, *args, **kwargs)
+
+    def buses(self):
+        """Return {bus number: I2C_Comm} of every bus we drive"""
+        return {self.bus: self}
+
+    def bus_of(self, adr):
+        """Bus number the board at adr is on"""
+        return self.bus
+
+    def assign_buses(self, inventory):
+        """Learn which bus each board in the inventory is on. Nothing to do with a single bus."""
+        pass
+
+    def pacing(self):
+        """Current flow control pacing per board. See FlowController.pacing()"""
+        return self.bus_worker.flow_control.pacing()
+
+    def busy_time(self):
+        """Seconds the bus worker has spent in block reads and writes"""
+        return self.bus_worker.busy_time
+
+    def metrics(self):
+        """Counters and latency of each (adr, reg). See BusMetrics.snapshot()"""
+        return self.bus_worker.metrics.snapshot()
+
+    def dump_metrics(self, file):
+        """Write the bus metrics to file as JSON"""
+        self.bus_worker.metrics.dump(file)
+
+    def reset_metrics(self):
+        self.bus_worker.metrics.reset()
+
+    def save_capture(self, file):
+        """Write the transactions captured on the bus (see bus_capture.py) to file.
+
+        :return: number of transactions written, None if the bus isn't being captured
+        """
+        transport = self.bus_worker.transport
+        if not isinstance(transport, CaptureTransport):
+            return None
+        return transport.save(file)
+
+    def health(self, adr):
+        """Circuit breaker state of the board at adr (one of the device_health.HEALTH_xxx)"""
+        return self.bus_worker.health.state(adr)
+
+    def set_register_listener(self, on_change):
+        """on_change(adr, reg, data) is called from the bus worker when a register is confirmed
+        with a new value. See ShadowRegisters."""
+        self.shadow.set_listener(on_change)
+
+    def set_health_listener(self, on_change):
+        """on_change(adr, state) is called from the bus worker when a board's health changes"""
+        self.bus_worker.health.set_listener(on_change)
+
+    def reset_health(self, adr):
+        """Take the board at adr out of quarantine (i.e. it has been replaced)"""
+        self.bus_worker.health.reset(adr)
+
+    def failure_kind(self, adr):
+        """How to classify a failed write or read back to adr for the retry policy"""
+        if self.bus_worker.health.state(adr) == HEALTH_OPEN:
+            return retry_policy.ERROR_CIRCUIT_OPEN
+        return retry_policy.ERROR_NACK
+
+    def register_state(self, adr):
+        """Registers of the board at adr with a confirmed value. See ShadowRegisters.state()"""
+        return self.shadow.state(adr)
+
+    def invalidate(self, adr=None):
+        """Forget the shadow registers of the board at adr (all boards if None), i.e. after a reset"""
+        self.shadow.invalidate(adr)
+
+    def set_callback_dispatcher(self, dispatcher):
+        """Set the function used to deliver completion callbacks.
+
+        :param dispatcher: dispatcher(callback, *args) - typically UiDispatcher.post so
+                           callbacks run on the Tk thread. If None, callbacks are made
+                           directly on the bus worker thread.
+        """
+        self.callback_dispatcher = dispatcher
+
+    def write_register_async(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None):
+        """Queue a write_register_verify() and return immediately.
+
+        :param callback: optional callback(result) where result is the tuple returned
+                         by write_register_verify(). Delivered via the callback dispatcher.
+        :return: Future for the write_register_verify() result
+        """
+        future = self.submit_to(adr, priority, self.write_register_verify, adr, reg, data)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.deliver(callback, f))
+        return future
+
+    def write_registers_async(self, adr, writes, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None):
+        """Queue a write_registers_pipelined() and return immediately.
+
+        :param callback: optional callback(result) where result is the tuple returned
+                         by write_registers_pipelined(). Delivered via the callback dispatcher.
+        :return: Future for the write_registers_pipelined() result
+        """
+        future = self.submit_to(adr, priority, self.write_registers_pipelined, adr, writes)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.deliver(callback, f))
+        return future
+
+    def write_register_coalesced(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None,
+                                 max_hz=tcc.COALESCE_MAX_HZ):
+        """Queue a write where only the latest value matters (i.e. a slider position).
+
+        Writes are keyed by (adr, reg). If a write to the same register is already
+        waiting, its data is replaced by this one so only the newest value reaches the
+        board. Writes to a register are spaced at least 1/max_hz seconds apart.
+
+        :param callback: optional callback(result) made for the write that is actually sent
+        :return: True if this write replaced one still waiting, whose callback won't be made
+        """
+        key = (adr, reg)
+        with self.coalesce_lock:
+            already_pending = key in self.coalesced_writes
+            self.coalesced_writes[key] = (data, callback)
+            if already_pending:
+                return True
+            delay = self.coalesced_write_time.get(key, 0) + 1 / max_hz - monotonic()
+
+        if delay > 0:
+            timer = threading.Timer(delay, self.submit_to, (adr, priority, self.flush_coalesced_write, key))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.submit_to(adr, priority, self.flush_coalesced_write, key)
+        return False
+
+    def flush_coalesced_write(self, key):
+        """Write the latest data queued for key = (adr, reg). Runs on the bus worker."""
+        with self.coalesce_lock:
+            data, callback = self.coalesced_writes.pop(key)
+            self.coalesced_write_time[key] = monotonic()
+
+        adr, reg = key
+        result = self._write_register_verify(adr, reg, data)
+        if callback is not None:
+            self.dispatch(callback, result)
+        return result
+
+    def deliver(self, callback, future):
+        """Hand the result of a completed bus operation to its callback"""
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Bus operation failed: {}".format(e))
+            return
+        self.dispatch(callback, result)
+
+    def dispatch(self, callback, result):
+        if self.callback_dispatcher is None:
+            callback(result)
+        else:
+            self.callback_dispatcher(callback, result)
+
+    def get_device_info(self, adr, priority=tcc.PRIORITY_DIAGNOSTICS):
+        """Collect the inventory information from the board at the given address."""
+        return self.bus_worker.execute_for(adr, priority, self._get_device_info, adr)
 
-    def get_device_info(self, adr):
+    def _get_device_info(self, adr):
 
-        board_info = {"inventoryVersion": 0, "i2cAddress": 0, "boardType": 0, "boardDescription": "unknown",
-                      "boardVersion": 0, "i2cCommSwVersion": "unknown", "inventorySwVersion": "unknown",
-                      "applicationSwVersion": "unknown"}
+        board_info = {"inventoryVersion": 0, "i2cAddress": adr, "i2cBus": self.bus, "boardType": 0,
+                      "boardDescription": "unknown", "boardVersion": 0, "i2cCommSwVersion": "unknown",
+                      "inventorySwVersion": "unknown", "applicationSwVersion": "unknown"}
 
         reg, dev_info = self.read_register(adr,
                                           tcc.I2C_REG_INVENTORY_VERSION,
                                           tcc.I2C_REG_ID_LEN + tcc.I2C_INVENTORY_VERSION_LEN)
-        if reg == tcc.I2C_REG_INVENTORY_VERSION and dev_info[0] == 1:
+        if reg == tcc.I2C_REG_INVENTORY_VERSION and dev_info[0] >= tcc.INVENTORY_VERSION_2:
+            # ####################################
+            # inventory structure version 2
+            # ####################################
+            board_info["inventoryVersion"] = dev_info[0]
+            self.read_inventory_blocks(adr, board_info)
+
+        elif reg == tcc.I2C_REG_INVENTORY_VERSION and dev_info[0] == 1:
             # ####################################
             # inventory structure version 1
             # ####################################
@@ -63,39 +468,146 @@ class I2C_Comm:
 
         return board_info
 
+    def read_inventory_blocks(self, adr, board_info):
+        """Fill in board_info from the version 2 inventory block registers. Runs on the bus worker."""
+        for block_reg, block_len, fields in INVENTORY_V2_BLOCKS:
+            reg, block = self.read_register(adr, block_reg, tcc.I2C_REG_ID_LEN + block_len)
+            if reg < 0:
+                continue
+            offset = 0
+            for key, length, is_string in fields:
+                field = block[offset:offset + length]
+                board_info[key] = self.char_list_to_string(field) if is_string else field[0]
+                offset += length
+
+    @staticmethod
+    def throttle_status_reg(throttle_instance):
+        """Status block register for the given throttle instance (0 = A, 1 = B)"""
+        return tcc.I2C_REG_DT_STATUS_BLOCK + (tcc.DT_THROTTLE_ALLOCATION * throttle_instance)
+
+    @staticmethod
+    def decode_throttle_status(reg_data):
+        """Decode the data read from a throttle status block register into a ThrottleStatus"""
+        return ThrottleStatus(*reg_data[:tcc.I2C_DT_STATUS_BLOCK_LEN])
+
+    def read_throttle_status(self, adr, throttle_instance, priority=tcc.PRIORITY_POLLING):
+        """Read the status of one throttle.
+
+        Boards running application sw DT_STATUS_BLOCK_SW_VERSION or later are read in a
+        single transaction of the status block, older ones a register at a time.
+
+        :return: ThrottleStatus, or None if the read failed
+        """
+        return self.bus_worker.execute_for(adr, priority, self._read_throttle_status, adr, throttle_instance)
+
+    def _read_throttle_status(self, adr, throttle_instance):
+        if self.app_sw_version(adr) >= tcc.DT_STATUS_BLOCK_SW_VERSION:
+            reg, reg_data = self._read_register(adr, self.throttle_status_reg(throttle_instance),
+                                                tcc.I2C_REG_ID_LEN + tcc.I2C_DT_STATUS_BLOCK_LEN)
+            if reg < 0:
+                return None
+            return self.decode_throttle_status(reg_data)
+
+        status = []
+        for status_reg, length in THROTTLE_STATUS_REGISTERS:
+            reg, reg_data = self._read_register(adr, status_reg + (tcc.DT_THROTTLE_ALLOCATION * throttle_instance),
+                                                tcc.I2C_REG_ID_LEN + length)
+            if reg < 0:
+                return None
+            status.append(reg_data[0])
+        return ThrottleStatus(*status)
+
+    def app_sw_version(self, adr):
+        """Application sw version of the board at adr, i.e. (2, 0, 0). Runs on the bus worker.
+
+        The register is static so, once read, it comes from the shadow registers until
+        the board is invalidated (i.e. it has been replaced). () if it can't be read.
+        """
+        reg, reg_data = self._read_register(adr, tcc.I2C_REG_APP_SW_VERSION,
+                                            tcc.I2C_REG_ID_LEN + tcc.I2C_APP_SW_VERSION_LEN)
+        if reg < 0:
+            return ()
+        return self.parse_sw_version(self.char_list_to_string(reg_data))
+
+    @staticmethod
+    def parse_sw_version(version):
+        """Return "2.1.0" as (2, 1, 0). Parsing stops at the first part that isn't a number."""
+        numbers = []
+        for part in version.split("."):
+            digits = "".join(itertools.takewhile(str.isdigit, part.strip()))
+            if not digits:
+                break
+            numbers.append(int(digits))
+        return tuple(numbers)
+
     @staticmethod
     def char_list_to_string(char_list):
         return ''.join([chr(c) for c in char_list if 31 < c and c < 128])
 
-    def read_register(self, adr, reg, data_length):
+    def read_register(self, adr, reg, data_length, priority=tcc.PRIORITY_POLLING, cached=True):
         """
         :param adr: I2C Bus address
         :param reg: board register
         :param data_length: of data to read (not counting the checksum)
+        :param priority: bus worker priority
+        :param cached: if False, static registers are read from the board even when
+                       the shadow registers hold their value
         :return: reg or -1 (on error),
                  reg_data (remaining bytes read)
         """
+        return self.bus_worker.execute_for(adr, priority, self._read_register, adr, reg, data_length, cached)
+
+    def _read_register(self, adr, reg, data_length, cached=True):
+        if cached:
+            reg_data = self.shadow.cached_read(adr, reg)
+            if reg_data is not None and len(reg_data) == data_length - tcc.I2C_REG_ID_LEN:
+                return reg, reg_data
+
         cmd = -1            # Assume error return
         reg_data = []
         length = data_length + tcc.I2C_CHECKSUM_LEN
-        for retry in range(0, 4):
+        retry = self.retry_policy.start()
+        while retry.next_attempt():
+            if retry.retries:
+                self.bus_worker.metrics.record_retry(adr, reg)
             try:
-                reg_data = self.smbus.read_i2c_block_data(adr, reg, length)
-                if len(reg_data) == length:
-                    if self.validate_checksum(reg_data) == 0:
-                        cmd = reg_data.pop(0)        # todo - checksum is still attached !
-                        reg_data.pop(-1)             # remove the checksum
-                        if cmd == reg:
-                            break
-                    else:
-                        print("read_register checksum error {}".format(self.validate_checksum(reg_data)))
-                else:
-                    print("read_register length error {}".format(length))
-            except IOError:
-                print("IOError read_register at adr {} / reg {}".format(adr, reg))
+                raw = self.bus_worker.read_block(adr, reg, length)
+            except IOError as e:
+                error = retry_policy.io_error_kind(e)
+                if error == retry_policy.ERROR_NACK:
+                    print("IOError read_register at adr {} / reg {}".format(adr, reg))
+                retry.failed(error)
+                continue
+
+            reg_id, data = i2c_framing.parse_reply(raw, length)
+            if reg_id == reg:
+                cmd = reg_id
+                reg_data = data
+                break
+            if reg_id is not None:
+                print("read_register reg id error {} / {}".format(reg_id, reg))
+                error = retry_policy.ERROR_REG_ID
+            elif data == "checksum":
+                print("read_register checksum error {}".format(i2c_framing.checksum(raw)))
+                error = retry_policy.ERROR_CHECKSUM
+            else:
+                print("read_register length error {}".format(length))
+                error = retry_policy.ERROR_LENGTH
+            self.bus_worker.record_error(adr, reg, error)
+            retry.failed(error)
 
+        if cmd == reg:
+            self.confirm_read(adr, reg, reg_data)
         return cmd, reg_data
 
+    def confirm_read(self, adr, reg, reg_data):
+        """Record the data read from a register in the shadow registers"""
+        self.shadow.confirm(adr, reg, reg_data)
+        if reg in THROTTLE_STATUS_BLOCKS:
+            first = THROTTLE_STATUS_BLOCKS[reg]
+            for offset, value in enumerate(reg_data[:THROTTLE_STATUS_SETTINGS]):
+                self.shadow.confirm(adr, first + offset, [value])
+
     """
     def set_register(self, adr, reg, send_data):
         try:
@@ -133,33 +645,31 @@ class I2C_Comm:
 
         return return_reg, reg_data
      """
-    @staticmethod
-    def get_controller_list():
+    def get_controller_list(self, first_adr=tcc.I2C_SCAN_FIRST_ADR, last_adr=tcc.I2C_SCAN_LAST_ADR,
+                            priority=tcc.PRIORITY_DIAGNOSTICS):
         """ Find all active I2C devices on the bus
 
+        The scan is done in process (no i2cdetect) as a single bus worker operation.
+
         :return: list of I2C addresses of all active devices
         """
+        return self.bus_worker.execute(priority, self._get_controller_list, first_adr, last_adr)
+
+    def _get_controller_list(self, first_adr, last_adr):
         arduino_list = []
+        for adr in range(first_adr, last_adr + 1):
+            if self.probe(adr):
+                arduino_list.append(adr)
 
-        run_cmd = "i2cdetect -y 1"
+        return arduino_list
 
-        try:
-            i2c_detect_output = subprocess.run(run_cmd, shell=True, check=True, stdout=subprocess.PIPE, universal_newlines=True)
-
-            i2c_detect_output.check_returncode()
-            i2c_rows = i2c_detect_output.stdout.splitlines()
-            del i2c_rows[0]               # delete top row, its the heading
-            for row in i2c_rows:
-                adr_list = row.split()
-                # delete the row identifier
-                del adr_list[0]
-                for adr in adr_list:
-                    if adr != '--':
-                        arduino_list.append(adr)
-        except subprocess.CalledProcessError:
-            print("CallProcessError encountered")
+    def probe(self, adr):
+        """Return True if a device acknowledges at adr. Runs on the bus worker.
 
-        return arduino_list
+        Like i2cdetect, use a read byte probe for the EEPROM and write protect ranges,
+        where a quick write could corrupt a device, and a quick write everywhere else.
+        """
+        return self.bus_worker.probe(adr, read=0x30 <= adr <= 0x37 or 0x50 <= adr <= 0x5f)
 
     def block_read_test(self, adr):
         """Execute a block read test on the given address.
@@ -180,7 +690,7 @@ class I2C_Comm:
         reg = tcc.I2C_REG_UP_COUNTER
 
         # Reset the upCounter
-        uncorrected_error, re, we, dm = self.write_register_verify(adr, reg, [0])
+        uncorrected_error, re, we, dm = self.write_register_verify(adr, reg, [0], priority=tcc.PRIORITY_DIAGNOSTICS)
         if uncorrected_error > 0:
             print("An attempt to reset the UP_COUNTER at adr {} resulted in an uncorrectable error: {}".format(
                 adr,
@@ -191,19 +701,17 @@ class I2C_Comm:
         expected_data = 0
         for i in range(messages_to_send):
             try:
-                read_data = self.smbus.read_i2c_block_data(adr, reg, length)
-                if len(read_data) == length:
-                    if self.validate_checksum(read_data) == 0:
-                        read_data.pop(-1)   # remove the checksum
-                        if read_data[0] != reg or read_data[1] != expected_data:
-                            data_mismatch += 1
-                            print("Read error. S/B {} Is {}".format(expected_data, read_data[1]))
-                    else:
-                        data_mismatch += 1    # todo - verify the following byte assignments
-                        print("Checksum error: {} {} ".format(read_data[1], read_data[2]))
-                else:
+                # each read is queued separately so control traffic can get in between
+                raw = self.bus_worker.execute_for(adr, tcc.PRIORITY_DIAGNOSTICS,
+                                                  self.bus_worker.read_block, adr, reg, length)
+                reg_id, read_data = i2c_framing.parse_reply(raw, length)
+                if reg_id is None:
+                    data_mismatch += 1
+                    print("{} read error".format(read_data))
+                    self.bus_worker.record_error(adr, reg, read_data)
+                elif reg_id != reg or read_data[0] != expected_data % 256:
                     data_mismatch += 1
-                    print("Length read error")
+                    print("Read error. S/B {} Is {}".format(expected_data, read_data[0]))
                 expected_data += 1
             except IOError:
                 read_exception += 1
@@ -239,7 +747,7 @@ class I2C_Comm:
             # generate the data
             data = [i % 256, (i + 1) % 256, (i + 2) % 256]
             # do the write
-            ue, re, we, dm = self.write_register_verify(adr, reg, data)
+            ue, re, we, dm = self.write_register_verify(adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS)
 
             # update the results
             uncorrectable_err += ue
@@ -250,38 +758,60 @@ class I2C_Comm:
         return messages_to_send, read_exception, write_exception, \
                data_mismatch, uncorrectable_err
 
-    def write_register_verify(self, adr, reg, data):
+    def write_register_verify(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS):
         """Do a single write / verify test with retries on the write and read back
 
+        The write and the read back are run as a single bus worker operation so no other
+        traffic can get between them and upset the write_seq_num.
+
         return -
            uncorrected_errors
            read_exception
            write_exception
            data_mismatch
         """
+        return self.bus_worker.execute_for(adr, priority, self._write_register_verify, adr, reg, data)
+
+    def _write_register_verify(self, adr, reg, data):
         #print("Adr: {}, reg {}, data {}".format(adr, reg,data));
+        if not self.shadow.write_needed(adr, reg, data):
+            return 0, 0, 0, 0       # the board already holds this value
+
         write_exception = 0
         read_exception = 0
         data_mismatch = 0
         uncorrected_errors = 0
         read_result = -1
 
-        for attempt in range(1, 5):
-            write_result, we = self.write_func(adr, reg, data)
+        # the writes and read backs below all share one time budget
+        deadline = self.retry_policy.deadline()
+        retry = self.retry_policy.start(deadline)
+        while retry.next_attempt():
+            if retry.retries:
+                self.bus_worker.metrics.record_retry(adr, reg)
+            write_result, we = self.write_func(adr, reg, data, deadline)
             write_exception += we
-            if write_result == 0:
-                # todo - .5 slows things down enough to print in the main Arduino loop if necessary
-                #   I also used .1 to process buffers in the main loop prior to changing verify
-                #   from reading data back to reading sequence number back.
-                # sleep(.001)
-                read_result, re, dm = self.read_verify(adr, 19, [self.write_seq_num])
-
-                read_exception += re
-                data_mismatch += dm
-                if read_result == 0:
-                    break
+            if write_result != 0:
+                retry.failed(self.failure_kind(adr))
+                continue
+            # todo - .5 slows things down enough to print in the main Arduino loop if necessary
+            #   I also used .1 to process buffers in the main loop prior to changing verify
+            #   from reading data back to reading sequence number back.
+            # sleep(.001)
+            read_result, re, dm = self.read_verify(adr, tcc.I2C_REG_WRITE_SEQ_NUM, [self.write_seq_num], deadline)
+
+            read_exception += re
+            data_mismatch += dm
+            if read_result == 0:
+                break
+            retry.failed(retry_policy.ERROR_MISMATCH if dm else self.failure_kind(adr))
         if read_result != 0:
             uncorrected_errors = 1
+            self.shadow.forget(adr, reg)
+        else:
+            self.shadow.confirm(adr, reg, data)
+        if reg in EMERGENCY_STOP_REGISTERS:
+            self.shadow.invalidate(adr)
         """
         errors = write_exception + read_exception + data_mismatch + uncorrected_errors
         
@@ -293,16 +823,165 @@ class I2C_Comm:
         """
         return uncorrected_errors, read_exception, write_exception, data_mismatch
 
-    def write_func(self, adr, reg, data):
-        """Write given data to the given address / register
+    def write_registers_pipelined(self, adr, writes, priority=tcc.PRIORITY_DIAGNOSTICS):
+        """Write several registers on one board, verifying them with a single read back.
+
+        The writes are sent back to back, up to I2C_PIPELINE_WINDOW at a time, and then
+        the board's write_seq_num is read once. If it holds the seq num of the last write
+        the whole window went through. If it holds an earlier seq num from the window,
+        only the writes after it are sent again. If it holds anything else, the whole
+        window is sent again.
+
+        Note the board only remembers the last seq num it received, so a write lost in
+        the middle of a window, with the ones after it arriving, isn't detected. Use
+        write_register_verify() where every write must be confirmed.
+
+        Writes of a value the board is known to hold are dropped.
+
+        :param writes: list of (reg, data)
+        :return: same as write_register_verify(). uncorrected_errors is the number
+                 of writes that could not be verified.
+        """
+        return self.bus_worker.execute_for(adr, priority, self._write_registers_pipelined, adr, writes)
+
+    def _write_registers_pipelined(self, adr, writes):
+        write_exception = 0
+        read_exception = 0
+        data_mismatch = 0
+        uncorrected_errors = 0
+
+        # once a register is written in this batch, later writes to it must go out too
+        written = set()
+        needed = []
+        for reg, data in writes:
+            if reg in written or self.shadow.write_needed(adr, reg, data):
+                written.add(reg)
+                needed.append((reg, data))
+        writes = needed
+
+        for start in range(0, len(writes), tcc.I2C_PIPELINE_WINDOW):
+            pending = writes[start:start + tcc.I2C_PIPELINE_WINDOW]
+            # each window gets its own time budget
+            deadline = self.retry_policy.deadline()
+            retry = self.retry_policy.start(deadline)
+            while pending and retry.next_attempt():
+                seq_nums = []
+                for reg, data in pending:
+                    write_result, we = self.write_func(adr, reg, data, deadline)
+                    write_exception += we
+                    seq_nums.append(self.write_seq_num if write_result == 0 else None)
+
+                reg, reg_data = self._read_register(adr, tcc.I2C_REG_WRITE_SEQ_NUM,
+                                                    tcc.I2C_REG_ID_LEN + tcc.I2C_WRITE_SEQ_NUM_LEN)
+                if reg < 0:
+                    read_exception += 1
+                    retry.failed(self.failure_kind(adr))
+                    continue
+                if None not in seq_nums and reg_data[0] == seq_nums[-1]:
+                    self.confirm_writes(adr, pending)
+                    pending = []
+                    break
+
+                # replay the unacknowledged tail
+                data_mismatch += 1
+                retry.failed(retry_policy.ERROR_MISMATCH)
+                acked = seq_nums.index(reg_data[0]) + 1 if reg_data[0] in seq_nums else 0
+                if None in seq_nums:
+                    acked = min(acked, seq_nums.index(None))
+                self.confirm_writes(adr, pending[:acked])
+                pending = pending[acked:]
+
+            for reg, data in pending:
+                self.shadow.forget(adr, reg)
+            uncorrected_errors += len(pending)
+
+        return uncorrected_errors, read_exception, write_exception, data_mismatch
+
+    def confirm_writes(self, adr, writes):
+        """Record verified (reg, data) writes in the shadow registers"""
+        for reg, data in writes:
+            self.shadow.confirm(adr, reg, data)
+            if reg in EMERGENCY_STOP_REGISTERS:
+                self.shadow.invalidate(adr)
+
+    def write_light_levels(self, adr, levels, priority=tcc.PRIORITY_LIGHTS):
+        """Set many lights on the lights board at once.
+
+        The (pin, level) pairs are packed into I2C_REG_LIGHT_POWER_LEVEL_BATCH frames of up
+        to I2C_LIGHT_BATCH_MAX_PAIRS pairs. Before frames are sent the board's buffer credit
+        is checked so we never send more than it has room for. Frames are sent pipelined,
+        with a single seq num read back per group.
+
+        Boards running application sw older than LIGHT_BATCH_SW_VERSION have neither
+        register. They are sent one I2C_REG_LIGHT_POWER_LEVEL write per pin, pipelined.
+
+        :param levels: list of (pin, level)
+        :return: same as write_registers_pipelined()
+        """
+        return self.bus_worker.execute_for(adr, priority, self._write_light_levels, adr, levels)
+
+    def _write_light_levels(self, adr, levels):
+        if self.app_sw_version(adr) < tcc.LIGHT_BATCH_SW_VERSION:
+            return self._write_registers_pipelined(adr, [(tcc.I2C_REG_LIGHT_POWER_LEVEL, [pin, level])
+                                                         for pin, level in levels])
+
+        totals = [0, 0, 0, 0]
+        pending = []
+        credit = 0
+        max_pairs = tcc.I2C_LIGHT_BATCH_MAX_PAIRS
+
+        for start in range(0, len(levels), max_pairs):
+            pairs = levels[start:start + max_pairs]
+            if credit < len(pairs):
+                # send what the board has room for, then wait for more room
+                totals = [t + r for t, r in zip(totals, self._write_registers_pipelined(adr, pending))]
+                pending = []
+                credit = self.wait_light_credit(adr, len(pairs))
+
+            frame = [len(pairs)]
+            for pin, level in pairs:
+                frame += [pin, level]
+            pending.append((tcc.I2C_REG_LIGHT_POWER_LEVEL_BATCH, frame))
+            credit -= len(pairs)
+
+        totals = [t + r for t, r in zip(totals, self._write_registers_pipelined(adr, pending))]
+        return tuple(totals)
+
+    def wait_light_credit(self, adr, needed):
+        """Wait for the lights board to have room for needed pairs. Runs on the bus worker.
+
+        :return: the board's credit. If the credit can't be read, or doesn't free up in
+                 time, needed is returned and the caller goes ahead anyway.
+        """
+        for poll in range(tcc.LIGHT_CREDIT_POLLS):
+            reg, reg_data = self._read_register(adr, tcc.I2C_REG_LIGHT_BUFFER_CREDIT,
+                                                tcc.I2C_REG_ID_LEN + tcc.I2C_LIGHT_BUFFER_CREDIT_LEN)
+            if reg < 0:
+                break
+            if reg_data[0] >= needed:
+                return reg_data[0]
+            sleep(tcc.LIGHT_CREDIT_POLL_DELAY)
+
+        return needed
+
+    def write_light_levels_async(self, adr, levels, priority=tcc.PRIORITY_LIGHTS, callback=None):
+        """Queue a write_light_levels() and return immediately. See write_register_async()."""
+        future = self.submit_to(adr, priority, self.write_light_levels, adr, levels)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.deliver(callback, f))
+        return future
+
+    def write_func(self, adr, reg, data, deadline=None):
+        """Write given data to the given address / register. Runs on the bus worker.
         Inputs
            adr - I2C bus adr
            reg - register to write to
            data - list of bytes to write
+           deadline - monotonic() time after which no retries are made (see RetryPolicy)
         Generate a checksum and append it to the data. Make n attempts to
         write the data to adr/register. If an IOError occurs during the
-        write, count it and retry. If a retry is required, use a new
-        write_seq_num.
+        write, count it and retry after a backoff. If a retry is required,
+        use a new write_seq_num.
 
         return
             result  0 : success, data was written, (may have taken retries)
@@ -312,25 +991,32 @@ class I2C_Comm:
         write_exception = 0
         result = -1  # assume failure
 
-        for attempt in range(1, 5):
+        retry = self.retry_policy.start(deadline)
+        while retry.next_attempt():
+            if retry.retries:
+                self.bus_worker.metrics.record_retry(adr, reg)
             try:
                 self.write_seq_num = (self.write_seq_num + 1) % 256
-                cs = self.gen_checksum(reg, [self.write_seq_num] + data)
-                self.smbus.write_i2c_block_data(adr, reg, [self.write_seq_num] + data + [cs], force=True)
+                frame = self.frames.write_frame(reg, self.write_seq_num, data)
+                self.bus_worker.write_block(adr, reg, frame)
                 result = 0
                 break
-            except IOError:
-                print("Write exception {}".format(self.write_seq_num))
+            except IOError as e:
+                error = retry_policy.io_error_kind(e)
+                if error == retry_policy.ERROR_NACK:
+                    print("Write exception {}".format(self.write_seq_num))
                 write_exception += 1
+                retry.failed(error)
 
         return result, write_exception
 
-    def read_verify(self, adr, reg, data):
-        """Read from the given address/register and verify the expected_data
+    def read_verify(self, adr, reg, data, deadline=None):
+        """Read from the given address/register and verify the expected_data. Runs on the bus worker.
         Inputs
            adr - I2C bus adr
            reg - register to read from
            data - list of bytes expected
+           deadline - monotonic() time after which no retries are made (see RetryPolicy)
 
         Make n attempts to read from the given adr/register and verify the expected_data.
         If an IOError occurs during the read, count it and retry.
@@ -346,24 +1032,33 @@ class I2C_Comm:
         data_mismatch = 0
         result = -1  # assume failure
 
-        expected_data = [reg] + data       # Put the reg in the data list. Its part of the return data
+        # The whole reply, reg id and checksum included, is compared in one go
+        if reg == tcc.I2C_REG_WRITE_SEQ_NUM and len(data) == 1:
+            expected_frame = i2c_framing.SEQ_NUM_REPLIES[data[0]]
+        else:
+            expected_frame = i2c_framing.reply_frame(reg, data)
 
-        for attempt in range(1, 5):  # 4 retries for now
+        retry = self.retry_policy.start(deadline)
+        while retry.next_attempt():
+            if retry.retries:
+                self.bus_worker.metrics.record_retry(adr, reg)
             try:
                 # do the read/verify
-                read_data = self.smbus.read_i2c_block_data(adr, reg, len(expected_data) + 1)  # +1 for checksum
-                if self.validate_checksum(read_data) == 0:
-                    read_data.pop(-1)    # removed the trailing checksum
-                    if read_data == expected_data:
-                        result = 0
-                    else:
-                        data_mismatch += 1
+                read_data = bytes(self.bus_worker.read_block(adr, reg, len(expected_frame)))
+                if read_data == expected_frame:
+                    result = 0
+                    break
+                if i2c_framing.checksum(read_data) == 0:
+                    data_mismatch += 1
                     break   # OK, we were able to successfully read the register - we're done trying
                 else:
                     data_mismatch += 1
                     print("Read Verify Checksum error")
-            except IOError:
+                    self.bus_worker.record_error(adr, reg, retry_policy.ERROR_CHECKSUM)
+                    retry.failed(retry_policy.ERROR_CHECKSUM)
+            except IOError as e:
                 read_exception += 1
+                retry.failed(retry_policy.io_error_kind(e))
 
         return result, read_exception, data_mismatch
 
@@ -382,25 +1077,20 @@ class I2C_Comm:
         errors = 0
         for i in range(messages_to_send):
             try:
-                self.smbus.read_i2c_block_data(adr, 99, 2)  # 2=length
+                self.bus_worker.execute_for(adr, tcc.PRIORITY_DIAGNOSTICS,
+                                            self.bus_worker.read_block, adr, 99, 2)  # 2=length
             except IOError:
                 errors += 1
                 print("Oops - error at adr {}".format(adr))
-            sleep(0.001)
 
         return messages_to_send, errors
 
     @staticmethod
     def validate_checksum(data):
         """Return zero is the checksum is valid"""
-        checksum = 0
-        for element in data:
-            checksum += element
-        return checksum % 256
+        return i2c_framing.checksum(data)
 
     @staticmethod
     def gen_checksum(reg, buffer):
-        check_sum = reg
-        for element in buffer:
-            check_sum += element
-        return -(check_sum % 256)
+        """Checksum byte (0 - 255) to append to buffer when writing reg"""
+        return i2c_framing.write_checksum(reg, buffer)
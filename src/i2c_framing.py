@@ -0,0 +1,92 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the framing of the messages exchanged with the Arduinos.
+#
+# A write to a register is sent as   [seq num] + data + [checksum]
+# A read of a register comes back as [reg id] + data + [checksum]
+#
+# In both cases the checksum is chosen so the sum of the register id (which is
+# the SMBus command byte of a write), the data and the checksum is 0 modulo 256.
+#
+# The frames are handled as bytes / bytearray / memoryview so checksums and
+# compares are done by the interpreter in C rather than a loop over a list.
+#
+
+import tc_constants as tcc
+
+
+def checksum(frame):
+    """Return zero if the checksum of a received frame is valid"""
+    return sum(frame) & 0xFF
+
+
+def write_checksum(reg, payload):
+    """Checksum byte to append to payload (seq num + data) when writing reg"""
+    return -(reg + sum(payload)) & 0xFF
+
+
+def reply_frame(reg, data):
+    """The frame expected when reading reg from a board holding data"""
+    frame = bytearray([reg])
+    frame += bytes(data)
+    frame.append(-sum(frame) & 0xFF)
+    return bytes(frame)
+
+
+# Replies to a read of the write_seq_num register, one per seq num. Verifying
+# a write is then a single compare of what was read against one of these.
+SEQ_NUM_REPLIES = tuple(reply_frame(tcc.I2C_REG_WRITE_SEQ_NUM, [seq]) for seq in range(256))
+
+
+class FrameBuffer:
+    def __init__(self):
+        """Buffer that write frames are built in.
+
+        The buffer is reused for every write so no lists are built per message.
+        The SMBus call copies the frame before returning, so the frame returned by
+        write_frame() is only valid until the next call. Use one FrameBuffer per
+        thread (i.e. per bus worker).
+        """
+        self.buffer = bytearray(tcc.I2C_SMBUS_BLOCK_MAX)
+        self.view = memoryview(self.buffer)
+
+    def write_frame(self, reg, seq_num, data):
+        """Build [seq_num] + data + [checksum] for a write to reg
+
+        Most writes are a single byte (i.e. a throttle setting). Those are built
+        straight into a bytes, which is quicker than filling in the buffer.
+
+        :return: bytes or memoryview of the frame
+        """
+        if len(data) == 1:
+            value = data[0]
+            return bytes((seq_num, value, -(reg + seq_num + value) & 0xFF))
+        end = len(data) + 1
+        if end >= tcc.I2C_SMBUS_BLOCK_MAX:
+            raise ValueError("{} bytes of data won't fit in a frame".format(len(data)))
+        buffer = self.buffer
+        buffer[0] = seq_num
+        buffer[1:end] = data
+        buffer[end] = -(reg + seq_num + sum(data)) & 0xFF
+        return self.view[:end + 1]
+
+
+def parse_reply(raw, length):
+    """Check a frame read from a board.
+
+    The frame isn't copied or converted, data is a slice of raw.
+
+    :param raw: bytes as returned by the SMBus block read (list, bytes or bytearray)
+    :param length: number of bytes requested (reg id + data + checksum)
+    :return: (reg id, data) or (None, error) where error is "length" or "checksum"
+    """
+    if len(raw) != length:
+        return None, "length"
+    if sum(raw) & 0xFF:
+        return None, "checksum"
+    return raw[0], raw[1:-1]
@@ -0,0 +1,214 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains MultiBusComm, which drives several I2C buses (i.e.
+# /dev/i2c-1, i2c-3 and i2c-4 on a Pi 4) at once. Each bus has its own
+# I2C_Comm and so its own bus worker, so boards on different buses are
+# talked to in parallel.
+#
+
+import threading
+import tc_constants as tcc
+import i2c_comm
+import i2c_transport
+import bus_capture
+
+
+class MultiBusComm:
+    def __init__(self, comms):
+        """Route each board's traffic to the I2C_Comm of the bus the board is on.
+
+        MultiBusComm offers the same services as I2C_Comm, so the GUI doesn't care
+        how many buses there are. Board addresses must be unique across the buses;
+        if the same address is found on two buses only the first is used.
+
+        :param comms: dict of bus number -> I2C_Comm
+        """
+        self.comms = dict(comms)
+        self.default_bus = next(iter(self.comms))
+        self.bus_map = {}               # I2C address -> bus number
+        self.lock = threading.Lock()
+
+    # ########################################################################
+    # Which bus is a board on
+    # ########################################################################
+    def buses(self):
+        return dict(self.comms)
+
+    def bus_of(self, adr):
+        return self.bus_map.get(adr, self.default_bus)
+
+    def comm(self, adr):
+        """I2C_Comm of the bus the board at adr is on"""
+        return self.comms[self.bus_of(adr)]
+
+    def assign_buses(self, inventory):
+        """Learn which bus each board in the inventory is on"""
+        bus_map = {}
+        for entry in inventory:
+            bus_map.setdefault(entry["i2cAddress"], entry.get("i2cBus", self.default_bus))
+        with self.lock:
+            self.bus_map = bus_map
+
+    # ########################################################################
+    # Services of the whole system
+    # ########################################################################
+    def submit(self, priority, func, *args, **kwargs):
+        """Queue work that isn't for a particular board. It goes to the first bus."""
+        return self.comms[self.default_bus].submit(priority, func, *args, **kwargs)
+
+    def submit_to(self, adr, priority, func, *args, **kwargs):
+        """Queue a bus operation to the worker of the bus the board at adr is on"""
+        return self.comm(adr).submit_to(adr, priority, func, *args, **kwargs)
+
+    def get_controller_list(self, first_adr=tcc.I2C_SCAN_FIRST_ADR, last_adr=tcc.I2C_SCAN_LAST_ADR,
+                            priority=tcc.PRIORITY_DIAGNOSTICS):
+        """Scan all the buses, in parallel, and return the addresses found"""
+        scans = [(bus, comm.submit(priority, comm.get_controller_list, first_adr, last_adr))
+                 for bus, comm in self.comms.items()]
+        bus_map = {}
+        for bus, scan in scans:
+            for adr in scan.result():
+                if adr in bus_map:
+                    print("Board at adr 0x{:02x} found on bus {} and bus {}. Ignoring the one on bus {}.".format(
+                        adr, bus_map[adr], bus, bus))
+                else:
+                    bus_map[adr] = bus
+        with self.lock:
+            self.bus_map = bus_map
+        return sorted(bus_map)
+
+    def set_callback_dispatcher(self, dispatcher):
+        for comm in self.comms.values():
+            comm.set_callback_dispatcher(dispatcher)
+
+    def set_register_listener(self, on_change):
+        for comm in self.comms.values():
+            comm.set_register_listener(on_change)
+
+    def set_health_listener(self, on_change):
+        for comm in self.comms.values():
+            comm.set_health_listener(on_change)
+
+    def pacing(self):
+        pacing = {}
+        for comm in self.comms.values():
+            pacing.update(comm.pacing())
+        return pacing
+
+    def busy_time(self):
+        return sum(comm.busy_time() for comm in self.comms.values())
+
+    def metrics(self):
+        metrics = {}
+        for comm in self.comms.values():
+            metrics.update(comm.metrics())
+        return dict(sorted(metrics.items(), key=lambda item: item[1]["busy_time"], reverse=True))
+
+    def dump_metrics(self, file):
+        """Write the metrics of each bus to its own file (file with the bus number added)"""
+        for bus, comm in self.comms.items():
+            comm.dump_metrics(self.bus_file(file, bus))
+
+    def reset_metrics(self):
+        for comm in self.comms.values():
+            comm.reset_metrics()
+
+    def save_capture(self, file):
+        """Write the capture of each bus to its own file (file with the bus number added)
+
+        :return: number of transactions written, None if the buses aren't being captured
+        """
+        counts = [comm.save_capture(self.bus_file(file, bus)) for bus, comm in self.comms.items()]
+        return None if None in counts else sum(counts)
+
+    @staticmethod
+    def bus_file(file, bus):
+        """file name with -busN added before the extension"""
+        base, dot, extension = file.rpartition(".")
+        return "{}-bus{}.{}".format(base, bus, extension) if dot else "{}-bus{}".format(file, bus)
+
+    def invalidate(self, adr=None):
+        if adr is None:
+            for comm in self.comms.values():
+                comm.invalidate()
+        else:
+            self.comm(adr).invalidate(adr)
+
+    char_list_to_string = staticmethod(i2c_comm.I2C_Comm.char_list_to_string)
+
+    # ########################################################################
+    # Services of one board. These go to the I2C_Comm of the board's bus.
+    # ########################################################################
+    def probe(self, adr):
+        return self.comm(adr).probe(adr)
+
+    def get_device_info(self, adr, priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.comm(adr).get_device_info(adr, priority)
+
+    def read_register(self, adr, reg, data_length, priority=tcc.PRIORITY_POLLING, cached=True):
+        return self.comm(adr).read_register(adr, reg, data_length, priority, cached)
+
+    def read_throttle_status(self, adr, throttle_instance, priority=tcc.PRIORITY_POLLING):
+        return self.comm(adr).read_throttle_status(adr, throttle_instance, priority)
+
+    def write_register_verify(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.comm(adr).write_register_verify(adr, reg, data, priority)
+
+    def write_register_async(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None):
+        return self.comm(adr).write_register_async(adr, reg, data, priority, callback)
+
+    def write_register_coalesced(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None,
+                                 max_hz=tcc.COALESCE_MAX_HZ):
+        return self.comm(adr).write_register_coalesced(adr, reg, data, priority, callback, max_hz)
+
+    def write_registers_pipelined(self, adr, writes, priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.comm(adr).write_registers_pipelined(adr, writes, priority)
+
+    def write_registers_async(self, adr, writes, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None):
+        return self.comm(adr).write_registers_async(adr, writes, priority, callback)
+
+    def write_light_levels(self, adr, levels, priority=tcc.PRIORITY_LIGHTS):
+        return self.comm(adr).write_light_levels(adr, levels, priority)
+
+    def write_light_levels_async(self, adr, levels, priority=tcc.PRIORITY_LIGHTS, callback=None):
+        return self.comm(adr).write_light_levels_async(adr, levels, priority, callback)
+
+    def block_read_test(self, adr):
+        return self.comm(adr).block_read_test(adr)
+
+    def block_write_test(self, adr):
+        return self.comm(adr).block_write_test(adr)
+
+    def loopback_test(self, adr):
+        return self.comm(adr).loopback_test(adr)
+
+    def register_state(self, adr):
+        return self.comm(adr).register_state(adr)
+
+    def health(self, adr):
+        return self.comm(adr).health(adr)
+
+    def reset_health(self, adr):
+        self.comm(adr).reset_health(adr)
+
+
+def open_buses(bus_ids, simulate=False, capture=False):
+    """Open the given buses.
+
+    :param capture: if True, the transactions on each bus are recorded (see bus_capture.py)
+    :return: an I2C_Comm if there is one bus, a MultiBusComm if there are more
+    """
+    comms = {}
+    for bus in bus_ids:
+        transport = i2c_transport.open_transport(bus, simulate)
+        if capture:
+            transport = bus_capture.CaptureTransport(transport)
+        comms[bus] = i2c_comm.I2C_Comm(bus, transport)
+    if len(comms) == 1:
+        return comms[bus_ids[0]]
+    return MultiBusComm(comms)
@@ -0,0 +1,66 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the transports the bus worker uses to move bytes on and
+# off an I2C bus. A transport provides:
+#
+#     read_block(adr, reg, length)  -> list of bytes read
+#     write_block(adr, reg, data)
+#     write_quick(adr)
+#     read_byte(adr)                -> byte read
+#     close()
+#
+# Failures (i.e. no acknowledge from the board) raise IOError.
+#
+# SMBusTransport talks to the real bus. See sim_bus.SimulatedBus for a bus
+# with simulated boards on it.
+#
+
+try:
+    from smbus2 import SMBus
+except ImportError:
+    SMBus = None
+
+
+class SMBusTransport:
+    def __init__(self, bus):
+        """Transport over the Linux SMBus driver (i.e. /dev/i2c-1 on the Pi)
+
+        :param bus: I2C bus number
+        """
+        if SMBus is None:
+            raise ImportError("smbus2 is needed to talk to the I2C bus (pip3 install smbus2)")
+        self.bus = bus
+        self.smbus = SMBus(bus=bus)
+
+    def read_block(self, adr, reg, length):
+        return self.smbus.read_i2c_block_data(adr, reg, length)
+
+    def write_block(self, adr, reg, data):
+        self.smbus.write_i2c_block_data(adr, reg, data, force=True)
+
+    def write_quick(self, adr):
+        self.smbus.write_quick(adr, force=True)
+
+    def read_byte(self, adr):
+        return self.smbus.read_byte(adr, force=True)
+
+    def close(self):
+        self.smbus.close()
+
+
+def open_transport(bus, simulate=False):
+    """Return a transport for the given bus.
+
+    :param simulate: if True, a SimulatedBus with its default boards is returned
+                     instead of opening the real bus. Bus 1 has them at 0x08 and up,
+                     other buses 16 addresses higher per bus number so they don't clash.
+    """
+    if simulate:
+        import sim_bus
+        return sim_bus.SimulatedBus(sim_bus.default_boards(0x08 + 0x10 * ((bus - 1) % 6)))
+    return SMBusTransport(bus)
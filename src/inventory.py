@@ -26,55 +26,79 @@ class InventoryTab(ttk.Frame):
         self.master = master
 
         self.textFont = Font(family="Helvetica", size=12)
+        self.rows = {}                  # I2C address -> entry fields for that board
 
         row = 0
         ttk.Label(self, text="Board\nDescription", style="RidgeReliefML.TLabel", width=16)\
             .grid(row=row, column=0, sticky="nsew")
         ttk.Label(self, text="I2C\nAddress", style="RidgeReliefML.TLabel", width=10)\
             .grid(row=row, column=1, sticky="nsew")
-        ttk.Label(self, text="Board\nType", style="RidgeReliefML.TLabel").grid(row=row, column=2, sticky="nsew")
-        ttk.Label(self, text="Board\nVersion", style="RidgeReliefML.TLabel").grid(row=row, column=3, sticky="nsew")
-        ttk.Label(self, text="Inventory\nVersion", style="RidgeReliefML.TLabel").grid(row=row, column=4, sticky="nsew")
-        ttk.Label(self, text="I2C_Comm\nSw Version", style="RidgeReliefML.TLabel").grid(row=row, column=5, sticky="nsew")
-        ttk.Label(self, text="Inventory\nSw Version", style="RidgeReliefML.TLabel").grid(row=row, column=6, sticky="nsew")
-        ttk.Label(self, text="Application\nVersion", style="RidgeReliefML.TLabel").grid(row=row, column=7, sticky="nsew")
+        ttk.Label(self, text="I2C\nBus", style="RidgeReliefML.TLabel").grid(row=row, column=2, sticky="nsew")
+        ttk.Label(self, text="Board\nType", style="RidgeReliefML.TLabel").grid(row=row, column=3, sticky="nsew")
+        ttk.Label(self, text="Board\nVersion", style="RidgeReliefML.TLabel").grid(row=row, column=4, sticky="nsew")
+        ttk.Label(self, text="Inventory\nVersion", style="RidgeReliefML.TLabel").grid(row=row, column=5, sticky="nsew")
+        ttk.Label(self, text="I2C_Comm\nSw Version", style="RidgeReliefML.TLabel").grid(row=row, column=6, sticky="nsew")
+        ttk.Label(self, text="Inventory\nSw Version", style="RidgeReliefML.TLabel").grid(row=row, column=7, sticky="nsew")
+        ttk.Label(self, text="Application\nVersion", style="RidgeReliefML.TLabel").grid(row=row, column=8, sticky="nsew")
+        ttk.Label(self, text="Health", style="RidgeReliefML.TLabel").grid(row=row, column=9, sticky="nsew")
 
     def update_inventory(self, inventory):
-        # find some way to clear out rows 1 - n
+        """Bring the grid in line with the given inventory.
 
-        row = 2
-        for entry in inventory:
-            e1 = ttk.Entry(self, width=16, font=self.textFont)
-            e1.grid(row=row, column=0, sticky="ew")
-            e1.insert(0, entry["boardDescription"])
-
-            e2 = ttk.Entry(self, width=10, justify=tk.CENTER, font=self.textFont)
-            e2.grid(row=row, column=1, sticky="ew")
-            e2.insert(0, "0x{:02x}".format(entry["i2cAddress"]))
-
-            e3 = ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)
-            e3.grid(row=row, column=2, sticky="ew")
-            e3.insert(0, entry["boardType"])
-
-            e4 = ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)
-            e4.grid(row=row, column=3, sticky="ew")
-            e4.insert(0, entry["boardVersion"])
-
-            e5 = ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)
-            e5.grid(row=row, column=4, sticky="ew")
-            e5.insert(0, entry["inventoryVersion"])
-
-            e6 = ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)
-            e6.grid(row=row, column=5, sticky="ew")
-            e6.insert(0, entry["i2cCommSwVersion"])
+        Rows are keyed by I2C address. Rows for boards that have gone are removed, rows
+        for new boards are added and the fields of existing rows are updated in place.
+        """
+        boards = {entry["i2cAddress"]: entry for entry in inventory}
 
-            e7 = ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)
-            e7.grid(row=row, column=6, sticky="ew")
-            e7.insert(0, entry["inventorySwVersion"])
+        for adr in [adr for adr in self.rows if adr not in boards]:
+            for field in self.rows.pop(adr):
+                field.destroy()
 
-            e8 = ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)
-            e8.grid(row=row, column=7, sticky="ew")
-            e8.insert(0, entry["applicationSwVersion"])
+        for adr, entry in boards.items():
+            if adr not in self.rows:
+                self.rows[adr] = self.create_row()
+                self.update_health(adr, self.master.i2c_comm.health(adr))
+            for field, value in zip(self.rows[adr], self.row_values(entry)):
+                field.delete(0, tk.END)
+                field.insert(0, value)
 
+        # keep the rows in address order
+        row = 2
+        for adr in sorted(self.rows):
+            for col, field in enumerate(self.rows[adr]):
+                field.grid(row=row, column=col, sticky="ew")
             row += 1
 
+    def create_row(self):
+        """Create the entry fields for one board"""
+        return [ttk.Entry(self, width=16, font=self.textFont),
+                ttk.Entry(self, width=10, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=5, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont),
+                ttk.Entry(self, width=8, justify=tk.CENTER, font=self.textFont)]
+
+    def update_health(self, adr, state):
+        """Show the circuit breaker state of a board. Runs on the Tk thread."""
+        if adr not in self.rows:
+            return
+        health_field = self.rows[adr][-1]
+        health_field.delete(0, tk.END)
+        health_field.insert(0, state)
+
+    @staticmethod
+    def row_values(entry):
+        """Values displayed for a board, in column order"""
+        return [entry["boardDescription"],
+                "0x{:02x}".format(entry["i2cAddress"]),
+                entry.get("i2cBus", ""),
+                entry["boardType"],
+                entry["boardVersion"],
+                entry["inventoryVersion"],
+                entry["i2cCommSwVersion"],
+                entry["inventorySwVersion"],
+                entry["applicationSwVersion"]]
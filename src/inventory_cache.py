@@ -0,0 +1,119 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the functions used to collect the board inventory, save it
+# between runs and work out what changed when a fresh inventory is collected.
+#
+
+import json
+from time import monotonic
+import tc_constants as tcc
+
+
+def load(file_name):
+    """Load a previously saved inventory.
+
+    :param file_name: cache file written by save()
+    :return: board_inventory list sorted by I2C address, empty if there is no usable cache
+    """
+    try:
+        with open(file_name, 'r') as file_handle:
+            cache = json.load(file_handle)
+    except (OSError, ValueError):
+        return []
+
+    return [cache[adr] for adr in sorted(cache, key=lambda adr: int(adr, base=16))]
+
+
+def save(file_name, inventory):
+    """Save the inventory, keyed by I2C address"""
+    cache = {"0x{:02x}".format(entry["i2cAddress"]): entry for entry in inventory}
+    try:
+        with open(file_name, 'w') as file_handle:
+            json.dump(cache, file_handle, indent=2)
+    except OSError as e:
+        print("Unable to save inventory cache {}: {}".format(file_name, e))
+
+
+def delta(old_inventory, new_inventory):
+    """Compare two inventories.
+
+    :return: (added, removed, changed) - lists of board_info entries. changed holds the new entries.
+    """
+    old = {entry["i2cAddress"]: entry for entry in old_inventory}
+    new = {entry["i2cAddress"]: entry for entry in new_inventory}
+
+    added = [new[adr] for adr in new if adr not in old]
+    removed = [old[adr] for adr in old if adr not in new]
+    changed = [new[adr] for adr in new if adr in old and new[adr] != old[adr]]
+
+    return added, removed, changed
+
+
+def board_unchanged(i2c_comm, adr, cached_entry):
+    """Quick check that the board at adr is still the one in the cache.
+
+    Only the inventory version and application sw version registers are read, and
+    they are always read from the board rather than the shadow registers.
+    Runs on the bus worker.
+    """
+    reg, dev_info = i2c_comm.read_register(adr, tcc.I2C_REG_INVENTORY_VERSION,
+                                           tcc.I2C_REG_ID_LEN + tcc.I2C_INVENTORY_VERSION_LEN, cached=False)
+    if reg < 0 or dev_info[0] != cached_entry["inventoryVersion"]:
+        return False
+
+    reg, dev_info = i2c_comm.read_register(adr, tcc.I2C_REG_APP_SW_VERSION,
+                                           tcc.I2C_REG_ID_LEN + tcc.I2C_APP_SW_VERSION_LEN, cached=False)
+    return reg >= 0 and i2c_comm.char_list_to_string(dev_info) == cached_entry["applicationSwVersion"]
+
+
+def validate_board(i2c_comm, adr, cached_entry):
+    """Return the cached entry if the board is unchanged, otherwise re-read it. Runs on the bus worker."""
+    if board_unchanged(i2c_comm, adr, cached_entry):
+        return cached_entry
+    i2c_comm.invalidate(adr)
+    return i2c_comm.get_device_info(adr)
+
+
+def collect(i2c_comm, cached_inventory=()):
+    """Use the I2C_Comm services to collect inventory information.
+
+    This function uses the I2C bus to collect inventory information from all connect
+    board controllers. All of the boards are queued to the bus worker up front so
+    the requests go back to back on the bus.
+
+    :param i2c_comm: I2C_Comm object
+    :param cached_inventory: previously saved inventory. Boards found in the cache are
+                             only checked for a version change rather than fully re-read.
+    :return: board_inventory - a list of dictionary entries describing each board in the system.
+    """
+    cache = {entry["i2cAddress"]: entry for entry in cached_inventory}
+
+    start = monotonic()
+    dev_list = i2c_comm.get_controller_list()
+    scan_done = monotonic()
+
+    # boards on different buses are read in parallel, each bus by its own worker
+    requests = []
+    for adr in dev_list:
+        bus = i2c_comm.bus_of(adr)
+        if adr in cache and cache[adr].get("i2cBus", bus) == bus:
+            requests.append(i2c_comm.submit_to(adr, tcc.PRIORITY_DIAGNOSTICS,
+                                               validate_board, i2c_comm, adr, cache[adr]))
+        else:
+            requests.append(i2c_comm.submit_to(adr, tcc.PRIORITY_DIAGNOSTICS,
+                                               i2c_comm.get_device_info, adr))
+    board_inventory = [request.result() for request in requests]
+    inventory_done = monotonic()
+
+    print("Inventory: {} boards. Bus scan {:.1f} ms, board info {:.1f} ms, total {:.1f} ms".format(
+        len(board_inventory),
+        (scan_done - start) * 1000,
+        (inventory_done - scan_done) * 1000,
+        (inventory_done - start) * 1000))
+
+    return board_inventory
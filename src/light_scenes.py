@@ -0,0 +1,141 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the lighting scene engine. Scenes (sunrise, sunset, flicker ...)
+# are read from a scene file, turned into timelines of light changes up front,
+# and then played out to the lights board.
+#
+
+import csv
+import random
+import threading
+from time import monotonic
+import tc_constants as tcc
+
+
+def load_scenes(scene_file, frame_interval=tcc.SCENE_FRAME_INTERVAL):
+    """Read the scene file and build the timeline for each scene.
+
+    Each row of the scene file is one step of a scene:
+        scene       : scene name. All rows with the same name make up the scene.
+        pins        : pins the step applies to (same format as the lights file)
+        effect      : set     - go to end_level at start_time
+                      fade    - go from start_level to end_level over duration
+                      flicker - random levels between start_level and end_level for duration
+        start_level, end_level : 0-100
+        start_time, duration   : seconds from the start of the scene
+
+    :return: dict of scene name -> timeline. See build_timeline().
+    """
+    steps = {}
+    with open(scene_file, 'r', newline='') as file_handle:
+        reader = csv.DictReader(file_handle, skipinitialspace=True)
+        for rec in reader:
+            steps.setdefault(rec['scene'], []).append(rec)
+
+    return {name: build_timeline(scene_steps, frame_interval) for name, scene_steps in steps.items()}
+
+
+def build_timeline(steps, frame_interval):
+    """Turn the steps of a scene into a timeline.
+
+    The levels of every step are worked out for each frame and then reduced to the
+    changes only, so a pin is only sent when its level moves.
+
+    :return: list of (t, [(pin, level), ...]) in time order, t in seconds from the start
+    """
+    frames = {}                 # frame number -> {pin: level}
+    for step in steps:
+        pins = [int(pin) for pin in step['pins'].split(',')]
+        effect = step['effect'].strip()
+        start_level = int(step['start_level'])
+        end_level = int(step['end_level'])
+        first_frame = round(float(step['start_time']) / frame_interval)
+        frame_count = max(1, round(float(step['duration'] or 0) / frame_interval))
+
+        if effect == 'set':
+            levels = [end_level]
+        elif effect == 'fade':
+            levels = [round(start_level + (end_level - start_level) * i / frame_count)
+                      for i in range(frame_count + 1)]
+        elif effect == 'flicker':
+            # seeded so a scene flickers the same way every time it is played
+            rand = random.Random(step['pins'])
+            levels = [rand.randint(start_level, end_level) for i in range(frame_count + 1)]
+        else:
+            print("Unknown scene effect '{}' in scene {}".format(effect, step['scene']))
+            continue
+
+        for i, level in enumerate(levels):
+            frame = frames.setdefault(first_frame + i, {})
+            for pin in pins:
+                frame[pin] = level
+
+    timeline = []
+    current = {}
+    for frame_number in sorted(frames):
+        changes = [(pin, level) for pin, level in sorted(frames[frame_number].items())
+                   if current.get(pin) != level]
+        current.update(frames[frame_number])
+        if changes:
+            timeline.append((frame_number * frame_interval, changes))
+
+    return timeline
+
+
+class SceneRunner:
+    def __init__(self, send):
+        """Plays scene timelines.
+
+        :param send: send(levels) - queues a list of (pin, level) to the lights board and
+                     returns a Future for the write. Called from the scene thread.
+        """
+        self.send = send
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def play(self, timeline):
+        """Start playing a timeline, stopping any scene already playing"""
+        self.stop()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(timeline, self.stop_event), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, timeline, stop_event):
+        """Play the timeline. Runs on the scene thread.
+
+        If the board hasn't finished with the last frame when the next one is due, the
+        changes are held and merged (latest level wins) into the frame after, so a slow
+        bus drops intermediate levels rather than falling behind.
+        """
+        start = monotonic()
+        pending = {}                # pin -> level not yet sent
+        in_flight = None
+        try:
+            for t, changes in timeline:
+                if stop_event.wait(max(0, start + t - monotonic())):
+                    return
+                pending.update(changes)
+                if in_flight is None or in_flight.done():
+                    self.check(in_flight)
+                    in_flight = self.send(sorted(pending.items()))
+                    pending = {}
+
+            self.check(in_flight)
+            if pending and not stop_event.is_set():
+                self.check(self.send(sorted(pending.items())))
+        except Exception as e:
+            print("Scene stopped: {}: {}".format(type(e).__name__, e))
+
+    @staticmethod
+    def check(write):
+        """Wait for a write (Future or None) and report it if it failed"""
+        if write is not None and write.exception() is not None:
+            print("Scene write failed: {}".format(write.exception()))
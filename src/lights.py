@@ -12,22 +12,30 @@
 import tkinter as tk
 import tkinter.ttk as ttk
 import csv
-from time import sleep
+from concurrent import futures
+from time import monotonic
 import tc_constants as tcc
+from light_scenes import load_scenes, SceneRunner
 
 INVALID_PIN = "99"
 ALL_PIN = INVALID_PIN
 
 class LightsTab(ttk.Frame):
-    def __init__(self, master, lights_file, i2c_comm, **kwargs):
+    def __init__(self, master, lights_file, scenes_file, i2c_comm, ui_dispatcher, **kwargs):
         """Lights frame contains the light controls
 
         :param master: Notebook holding the Throttle frame
+        :param lights_file: csv file describing the light switches
+        :param scenes_file: csv file describing the lighting scenes
         :param i2c_comm - I2C_Comm object
+        :param ui_dispatcher - UiDispatcher, used to bring the scene steps onto the Tk thread
         :param kwargs:
         """
         self.i2c_comm = i2c_comm
+        self.ui_dispatcher = ui_dispatcher
         self.lights_control_address = 0
+        self.batch = None               # (pin, level) pairs collected between begin_batch() and end_batch()
+        self.pin_levels = {}            # pin -> level last sent to the board
 
         # ##################################################################
         # open the Lights config file to determine what the user wants
@@ -58,6 +66,7 @@ class LightsTab(ttk.Frame):
         # Add a switch for each entry in the config file
         # ##################################################
         switch_objects = []
+        self.switch_objects = switch_objects
         for light_switch in light_switches:
             row = int(instance % max_row) + 1  + row_offset         # +1 since row numbering starts with 1,
             col = (int(instance / max_row) *3) + 1                  # *3 since each switch gets 3 columns
@@ -78,26 +87,128 @@ class LightsTab(ttk.Frame):
         all_frame = ttk.Frame(self,style='DarkGray.TFrame',padding=(60,20))
 
         all_frame.grid(row=max_row+2,column=3,columnspan=4, sticky='w')
-        AllLightsButton(all_frame, 1, 1, switch_objects)
+        AllLightsButton(all_frame, 1, 1, switch_objects, self)
+
+        # ##################################################
+        # Add a button for each scene, plus one to stop it
+        # ##################################################
+        self.scenes = load_scenes(scenes_file)
+        self.scene_runner = SceneRunner(self.send_scene_step)
+
+        scene_frame = ttk.Frame(self, style='DarkGray.TFrame', padding=(60, 0))
+        scene_frame.grid(row=max_row+3, column=1, columnspan=6, sticky='w')
+        col = 0
+        for name in self.scenes:
+            ttk.Button(scene_frame, text=name, style='LightsReady.TButton',
+                       command=lambda name=name: self.scene_runner.play(self.scenes[name])
+                       ).grid(row=0, column=col, padx=3)
+            col += 1
+        ttk.Button(scene_frame, text='STOP', style='LightsOff.TButton',
+                   command=self.scene_runner.stop).grid(row=0, column=col, padx=3)
 
     def update_inventory(self, inventory):
+        """Bind to the lights board. If the board has gone, unbind."""
+        address = 0
         for entry in inventory:
             if entry['boardType'] == tcc.BOARD_TYPE_LIGHTS:
-                self.lights_control_address = entry['i2cAddress']
+                address = entry['i2cAddress']
+        if address != self.lights_control_address:
+            # whatever we sent before doesn't apply to this board
+            self.pin_levels.clear()
+        self.lights_control_address = address
 
     def button_pressed(self, pins, power_level):
         """One of the switches has been depressed. Communicate it to the board controller.
         Sed the pin number and the new power level.
+
+        Between begin_batch() and end_batch() the levels are collected rather than sent.
         """
+        levels = []
         for pin in pins:
             if pin != INVALID_PIN:
                 print("Pin {} to power level {}".format(pin,power_level))
-                self.i2c_comm.write_register_verify(self.lights_control_address,
-                                                     tcc.I2C_REG_LIGHT_POWER_LEVEL,
-                                                     [int(pin), int(power_level)])
+                levels.append((int(pin), int(power_level)))
             else:
                 print("Invalid pin number detected in button_pressed")
 
+        if self.batch is not None:
+            self.batch += levels
+        else:
+            self.send_levels(levels)
+
+    def begin_batch(self):
+        """Collect the levels from button_pressed() until end_batch()"""
+        self.batch = []
+
+    def end_batch(self):
+        """Send all the levels collected since begin_batch() as one batched command"""
+        levels, self.batch = self.batch, None
+        self.send_levels(levels)
+
+    def send_scene_step(self, levels):
+        """send() of the scene runner. Runs on the scene thread.
+
+        The step is played on the Tk thread, like a button press, so the switches follow
+        the scene.
+
+        :return: Future that completes with the write
+        """
+        done = futures.Future()
+        self.ui_dispatcher.post(self.play_scene_step, levels, done)
+        return done
+
+    def play_scene_step(self, levels, done):
+        """Send a scene step and show it on the switches. Runs on the Tk thread."""
+        try:
+            write = self.send_levels(levels)
+            pins = {pin for pin, level in levels}
+            for switch in self.switch_objects:
+                switch_pins = [int(pin) for pin in switch.pins if pin != INVALID_PIN]
+                if pins.intersection(switch_pins):
+                    switch.show_level(max(self.pin_levels.get(pin, 0) for pin in switch_pins))
+        except Exception as e:
+            done.set_exception(e)
+            return
+        if write is None:
+            done.set_result(None)
+        else:
+            write.add_done_callback(lambda f: self.copy_result(f, done))
+
+    @staticmethod
+    def copy_result(source, target):
+        if source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
+
+    def send_levels(self, levels):
+        """Queue the (pin, level) pairs to the lights board. We don't wait for the bus here.
+
+        Pins already at the requested level (as far as we know) are dropped.
+
+        :return: Future for the write, None if nothing was sent
+        """
+        if not self.lights_control_address:
+            print("No lights board in the inventory")
+            return None
+        levels = [(pin, level) for pin, level in levels if self.pin_levels.get(pin) != level]
+        self.pin_levels.update(levels)
+        if levels:
+            return self.i2c_comm.write_light_levels_async(self.lights_control_address, levels,
+                                                          priority=tcc.PRIORITY_LIGHTS,
+                                                          callback=self.write_complete)
+        return None
+
+    def write_complete(self, result):
+        """A lights write has completed.
+
+        :param result: (uncorrected_errors, read_exception, write_exception, data_mismatch)
+        """
+        if result[0] > 0:
+            print("Lights write to adr {} failed".format(self.lights_control_address))
+            # we no longer know what the board has, so don't suppress anything
+            self.pin_levels.clear()
+
 
 class SimpleLight:
     def __init__(self, frame, row, col, light_switch, **kwargs ):
@@ -141,6 +252,16 @@ class SimpleLight:
 
             self.frame.button_pressed(self.pins, self.full_level)
 
+    def show_level(self, level):
+        """A scene has set our lights to level. Show it, so OFF and ON act from there."""
+        self.state = 'on' if level > self.off_level else 'off'
+        if self.state == 'on':
+            self.off_button.config(style='LightsReady.TButton')
+            self.on_button.config(style='LightsOnFull.TButton', text='ON')
+        else:
+            self.off_button.config(style='LightsOff.TButton')
+            self.on_button.config(style='LightsReady.TButton')
+
 class FourWayLight:
     def __init__(self, frame, row, col, light_switch, **kwargs ):
 
@@ -204,6 +325,25 @@ class FourWayLight:
             self.on_button.config(style='LightsOnMed.TButton', text='MED')
             self.frame.button_pressed(self.pins, self.med_level)
 
+    def show_level(self, level):
+        """A scene has set our lights to level. Show the nearest setting, so OFF and ON act from there."""
+        self.direction = 'up'
+        if level <= self.off_level:
+            self.state = 'off'
+            self.off_button.config(style='LightsOff.TButton', text='OFF')
+            self.on_button.config(style='LightsReady.TButton', text='ON')
+            return
+        if level <= self.low_level:
+            self.state = 'low'
+            self.on_button.config(style='LightsOnLow.TButton', text='LOW')
+        elif level <= self.med_level:
+            self.state = 'medium'
+            self.on_button.config(style='LightsOnMed.TButton', text='MED')
+        else:
+            self.state = 'high'
+            self.on_button.config(style='LightsOnFull.TButton', text='FULL')
+        self.off_button.config(style='LightsReady.TButton', text='OFF')
+
 class SliderLight:
     def __init__(self,frame, row, col, light_switch, **kwargs ):
 
@@ -214,13 +354,16 @@ class SliderLight:
         self.med_level = int(light_switch['medium_setting'])
         self.full_level = int(light_switch['full_setting'])
         self.pins = light_switch['pins'].split(',')
+        self.style = 'LightsOff.Horizontal.TScale'
+        self.last_send_time = 0
+        self.pending_send = None            # after() id of the trailing send
 
         col = col
         self.level = ttk.Scale(frame,
                                value=0,
                                from_=0,
                                to=100,
-                               style='LightsOff.Horizontal.TScale',
+                               style=self.style,
                                orient=tk.HORIZONTAL,
                                command=self.scale_updated)
         self.level.grid(row=row, column=col, columnspan=2, sticky=("NSEW"), pady=3)
@@ -232,19 +375,42 @@ class SliderLight:
         label.grid(row=row, column=col, sticky=('W'), padx=6)
 
     def scale_updated(self, event):
+        """User has moved the slider.
+
+        The slider fires for every pixel of motion. The level is sent at most once per
+        LIGHT_SLIDER_DEBOUNCE ms, with a trailing send so the final level always goes out.
+        """
+        self.level_changed()
+        if self.pending_send is not None:
+            return
+        wait = int((self.last_send_time + tcc.LIGHT_SLIDER_DEBOUNCE / 1000 - monotonic()) * 1000)
+        if wait > 0:
+            self.pending_send = self.level.after(wait, self.send_level)
+        else:
+            self.send_level()
+
+    def level_changed(self):
+        """Restyle the slider, only if the level has moved into a different band"""
         new_level = int(self.level.get())
         if new_level <= self.off_level:
-            self.level.config(style='LightsOff.Horizontal.TScale')
-            self.frame.button_pressed(self.pins, new_level)
+            style = 'LightsOff.Horizontal.TScale'
         elif new_level <= self.low_level:
-            self.level.config(style='LightsLow.Horizontal.TScale')
-            self.frame.button_pressed(self.pins, new_level)
+            style = 'LightsLow.Horizontal.TScale'
         elif new_level <= self.med_level:
-            self.level.config(style='LightsMed.Horizontal.TScale')
-            self.frame.button_pressed(self.pins, new_level)
+            style = 'LightsMed.Horizontal.TScale'
         else:
-            self.level.config(style='LightsFull.Horizontal.TScale')
-            self.frame.button_pressed(self.pins, new_level)
+            style = 'LightsFull.Horizontal.TScale'
+        if style != self.style:
+            self.style = style
+            self.level.config(style=style)
+
+    def send_level(self):
+        """Send the current level. The lights tab drops pins already at that level."""
+        if self.pending_send is not None:
+            self.level.after_cancel(self.pending_send)
+            self.pending_send = None
+        self.last_send_time = monotonic()
+        self.frame.button_pressed(self.pins, int(self.level.get()))
 
     def on_button_pressed(self):
         """This is activated when the ALL ON button is pressed"""
@@ -255,23 +421,36 @@ class SliderLight:
             self.level.set(self.med_level)
         elif current_level <= self.med_level:
             self.level.set(self.full_level)
-        self.scale_updated(0)
+        # send now, not debounced, so the level goes in the ALL ON batch
+        self.level_changed()
+        self.send_level()
 
     def off_button_pressed(self):
             """This is activated when the ALL OFF button is pressed"""
             self.level.set(0)
-            self.scale_updated(0)
+            self.level_changed()
+            self.send_level()
+
+    def show_level(self, level):
+        """A scene has set our lights to level. Move the slider to match."""
+        if self.pending_send is not None:
+            self.level.after_cancel(self.pending_send)
+            self.pending_send = None
+        self.level.set(level)
+        self.level_changed()
 
 
 class AllLightsButton:
-    def __init__(self, frame, row, col, switch_objects, **kwargs ):
+    def __init__(self, frame, row, col, switch_objects, lights_tab, **kwargs ):
         """Put up a button for all lights on and off
 
-        The switch_objects list passed in allows access to control all other lights"""
+        The switch_objects list passed in allows access to control all other lights.
+        The lights_tab is used to send all their changes as one batch."""
 
         self.frame = frame
         self.instance = row*col
         self.switch_objects = switch_objects
+        self.lights_tab = lights_tab
 
         self.state = 'off'
 
@@ -294,17 +473,17 @@ class AllLightsButton:
         self.off_button.config(style='LightsOff.TButton')
         self.on_button.config(style='LightsReady.TButton')
 
+        self.lights_tab.begin_batch()
         for object in self.switch_objects:
             object.off_button_pressed()
-            # avoid overrunning buffers in the board controller
-            sleep(.004)
+        self.lights_tab.end_batch()
 
 
     def on_button_pressed(self):
         self.off_button.config(style='LightsReady.TButton')
         self.on_button.config(style='LightsOnFull.TButton', text='ON')
 
+        self.lights_tab.begin_batch()
         for object in self.switch_objects:
             object.on_button_pressed()
-            # avoid overrunning buffers in the board controller
-            sleep(.004)
+        self.lights_tab.end_batch()
@@ -0,0 +1,101 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the monitor that watches for boards being added to or
+# removed from the bus while the train control platform is running.
+#
+
+import threading
+from time import sleep
+import tc_constants as tcc
+import inventory_cache
+
+
+class PresenceMonitor(threading.Thread):
+    def __init__(self, i2c_comm, on_change, interval=tcc.PRESENCE_MONITOR_INTERVAL):
+        """Periodically scan the bus and report inventory changes.
+
+        Each address is probed as its own low priority bus operation so control
+        traffic is never held up behind a scan. Only boards that appear are read.
+
+        :param i2c_comm: I2C_Comm object
+        :param on_change: on_change(inventory) called from this thread with the new inventory
+        :param interval: seconds between scans
+        """
+        threading.Thread.__init__(self, name="presence-monitor", daemon=True)
+        self.i2c_comm = i2c_comm
+        self.on_change = on_change
+        self.interval = interval
+        self.inventory = {}             # I2C address -> board_info of the boards present
+        self.last_seen = {}             # I2C address -> board_info of every board ever seen
+
+    def set_inventory(self, inventory):
+        """Tell the monitor about the current inventory. Safe to call from any thread."""
+        boards = {entry["i2cAddress"]: entry for entry in inventory}
+        self.last_seen.update(boards)
+        self.inventory = boards
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            inventory = self.scan()
+            if inventory is not None:
+                self.set_inventory(inventory)
+                self.on_change(inventory)
+
+    def scan(self):
+        """Scan the bus once.
+
+        :return: the new inventory (sorted by address), None if nothing changed
+        """
+        # every bus is probed, each by its own worker
+        probes = {(bus, adr): comm.submit(tcc.PRIORITY_DIAGNOSTICS, comm.probe, adr)
+                  for bus, comm in self.i2c_comm.buses().items()
+                  for adr in range(tcc.I2C_SCAN_FIRST_ADR, tcc.I2C_SCAN_LAST_ADR + 1)}
+        found = [(bus, adr) for (bus, adr), probe in probes.items() if probe.result()]
+
+        known = self.inventory
+        known_bus = {adr: entry.get("i2cBus", self.i2c_comm.bus_of(adr)) for adr, entry in known.items()}
+        if set(found) == set((bus, adr) for adr, bus in known_bus.items()):
+            return None
+
+        present = []
+        for bus, adr in found:
+            if adr in present:
+                print("Board at adr 0x{:02x} is on more than one bus. Ignoring the one on bus {}.".format(adr, bus))
+            elif adr in known and known_bus[adr] != bus and (known_bus[adr], adr) in found:
+                print("Board at adr 0x{:02x} is already on bus {}. Ignoring the one on bus {}.".format(
+                    adr, known_bus[adr], bus))
+            else:
+                present.append(adr)
+        if set(present) == set(known):
+            return None
+
+        # A board that reappears may have been swapped, so check it against what we last saw.
+        requests = {}
+        for bus, adr in found:
+            if adr in known or adr not in present or adr in requests:
+                continue
+            comm = self.i2c_comm.buses()[bus]
+            comm.reset_health(adr)
+            last_seen = self.last_seen.get(adr)
+            if last_seen is not None and last_seen.get("i2cBus", bus) == bus:
+                requests[adr] = comm.submit(tcc.PRIORITY_DIAGNOSTICS, inventory_cache.validate_board,
+                                            comm, adr, last_seen)
+            else:
+                requests[adr] = comm.submit(tcc.PRIORITY_DIAGNOSTICS, comm.get_device_info, adr)
+
+        for adr in [adr for adr in known if adr not in present]:
+            print("Board at adr 0x{:02x} has gone".format(adr))
+            # whatever comes back at this address starts from a reset
+            self.i2c_comm.invalidate(adr)
+        for adr in requests:
+            print("Board at adr 0x{:02x} has appeared".format(adr))
+
+        boards = {adr: entry for adr, entry in known.items() if adr in present}
+        boards.update({adr: request.result() for adr, request in requests.items()})
+        return [boards[adr] for adr in sorted(boards)]
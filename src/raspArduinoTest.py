@@ -11,8 +11,11 @@
 
 import tkinter as tk
 import tkinter.ttk as ttk
+import threading
 from tkinter.font import Font
+import tc_constants as tcc
 
+BUS_METRICS_FILE = "bus_metrics.json"
 
 class RaspArduinoTestTab(ttk.Frame):
     def __init__(self, master, notebook, root, i2c_comm, **kwargs):
@@ -30,6 +33,9 @@ class RaspArduinoTestTab(ttk.Frame):
         self.textFont = Font(family="Helvetica", size=12)
         self.inventory = []                            # list of all i2c devices on the bus
         self.status_widgets = {}                       # test result widgets
+        self.arduino_rows = {}                         # I2C address -> all widgets in the board's row
+        self.pacing_widgets = {}                       # I2C address -> flow control widgets
+        self.pacing_fetch_running = False
         self.test_running = False
         self.iter_count = None
         self.button_frame = None                        # where we put the test buttons
@@ -60,8 +66,21 @@ class RaspArduinoTestTab(ttk.Frame):
         col += 1
         ttk.Button(self.arduino_frame, text="Uncorrected\nErrors", style='RidgeReliefML.TLabel'). \
             grid(row=row, column=col, sticky='nsew')
+        col += 1
+        ttk.Button(self.arduino_frame, text="Pacing\n(ms)", style='RidgeReliefML.TLabel'). \
+            grid(row=row, column=col, sticky='nsew')
+        col += 1
+        ttk.Button(self.arduino_frame, text="Round Trip\n(ms)", style='RidgeReliefML.TLabel'). \
+            grid(row=row, column=col, sticky='nsew')
+        col += 1
+        ttk.Button(self.arduino_frame, text="Error\nRate", style='RidgeReliefML.TLabel'). \
+            grid(row=row, column=col, sticky='nsew')
+
+        # the flow control pacing is refreshed whether or not a test is running
+        self.after(tcc.PACING_REFRESH_INTERVAL, self.refresh_pacing)
 
     def update_inventory(self, inventory):
+        """May be called again as the inventory is refreshed. Rows are kept for boards still present."""
         self.inventory = inventory
 
         # add a row to the frame for each Arduino found
@@ -69,28 +88,39 @@ class RaspArduinoTestTab(ttk.Frame):
 
         # Add buttons in bottom row
         # Create a frame to hold the test data
-        self.button_frame = self.add_label_frame(self, "Test Control Options", fill=tk.X, expand=0, x_pady=10)
-        self.add_control_buttons(self.button_frame)
+        if self.button_frame is None:
+            self.button_frame = self.add_label_frame(self, "Test Control Options", fill=tk.X, expand=0, x_pady=10)
+            self.add_control_buttons(self.button_frame)
 
     def run(self):
-        """Start the test running"""
+        """Start the test running
+
+        The test itself runs on a background thread. Results are posted back to the
+        Tk thread as each board completes so the GUI stays responsive.
+        """
+        if self.test_running:
+            return
 
         self.test_running = True
         self.runButt.configure(text="Running")
-        #  Todo - do I need the following line ?
-        self.root.update_idletasks()
 
         # read the test selection combo box
         active_test = self.testSelect.get()
         iterations = int(self.iter_count.get())
 
         if active_test == "Read":
-            self.read_test(iterations)
+            test = self.read_test
         elif active_test == "Write/Verify":
-            self.write_verify_test(iterations)
+            test = self.write_verify_test
         else:
             print("Unknown test requested: {}".format(active_test))
+            self.test_complete(iterations)
+            return
+
+        threading.Thread(target=test, args=(iterations,), daemon=True).start()
 
+    def test_complete(self, iterations):
+        """Test has finished. Runs on the Tk thread."""
         self.test_running = False
         self.runButt.configure(text="Run Test")
         self.iter_count.delete(0, tk.END)
@@ -100,41 +130,91 @@ class RaspArduinoTestTab(ttk.Frame):
         self.win.destroy()
 
     def create_arduino_rows(self, frame, inventory):
-        """Create a row for each Arduino in the list."""
-        col_width = 10
-        row = 1
-        col = 0
+        """Create a row for each Arduino in the list.
+
+        Rows for boards no longer in the list are removed. Existing rows keep their totals.
+        """
+        boards = [arduino["i2cAddress"] for arduino in inventory]
 
-        for arduino in inventory:
-            arduino_adr = arduino["i2cAddress"]
-            col = 0
-            ttk.Label(frame, text="0x{:02x}".format(arduino_adr), font=self.textFont).grid(row=row, column=col)
-            col += 1
-            tot_transmit_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)  # transmissions
-            tot_transmit_box.insert(0, 0)
-            tot_transmit_box.grid(row=row, column=col, sticky="ew")
-            col += 1
-            read_exception_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)  # errors
-            read_exception_box.insert(0, 0)
-            read_exception_box.grid(row=row, column=col, sticky="ew")
-            col += 1
-            write_exception_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
-            write_exception_box.insert(0, 0)
-            write_exception_box.grid(row=row, column=col, sticky="ew")
-            col += 1
-            data_mismatch_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
-            data_mismatch_box.insert(0, 0)
-            data_mismatch_box.grid(row=row, column=col, sticky="ew")
-            col += 1
-            uncorrected_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
-            uncorrected_box.insert(0, 0)
-            uncorrected_box.grid(row=row, column=col, sticky="ew")
-            col += 1
+        for arduino_adr in [adr for adr in self.arduino_rows if adr not in boards]:
+            for widget in self.arduino_rows.pop(arduino_adr):
+                widget.destroy()
+            del self.status_widgets[arduino_adr]
+            del self.pacing_widgets[arduino_adr]
+
+        for arduino_adr in boards:
+            if arduino_adr not in self.arduino_rows:
+                self.arduino_rows[arduino_adr] = self.create_arduino_row(frame, arduino_adr)
+
+        row = 1
+        for arduino_adr in sorted(self.arduino_rows):
+            for col, widget in enumerate(self.arduino_rows[arduino_adr]):
+                widget.grid(row=row, column=col, sticky="ew")
             row += 1
-            # capture the widgets. I'll update them when the test runs
-            self.status_widgets[arduino_adr] = \
-                (tot_transmit_box, read_exception_box,
-                 write_exception_box, data_mismatch_box, uncorrected_box)
+
+    def create_arduino_row(self, frame, arduino_adr):
+        """Create the widgets for one Arduino. They are gridded by create_arduino_rows()."""
+        col_width = 10
+
+        adr_label = ttk.Label(frame, text="0x{:02x}".format(arduino_adr), font=self.textFont, anchor=tk.CENTER)
+        tot_transmit_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)  # transmissions
+        tot_transmit_box.insert(0, 0)
+        read_exception_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)  # errors
+        read_exception_box.insert(0, 0)
+        write_exception_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
+        write_exception_box.insert(0, 0)
+        data_mismatch_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
+        data_mismatch_box.insert(0, 0)
+        uncorrected_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
+        uncorrected_box.insert(0, 0)
+        spacing_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
+        round_trip_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
+        error_rate_box = ttk.Entry(frame, w=col_width, font=self.textFont, justify=tk.RIGHT)
+
+        # capture the widgets. I'll update them when the test runs
+        self.status_widgets[arduino_adr] = \
+            (tot_transmit_box, read_exception_box,
+             write_exception_box, data_mismatch_box, uncorrected_box)
+        self.pacing_widgets[arduino_adr] = (spacing_box, round_trip_box, error_rate_box)
+
+        return [adr_label, tot_transmit_box, read_exception_box,
+                write_exception_box, data_mismatch_box, uncorrected_box,
+                spacing_box, round_trip_box, error_rate_box]
+
+    def refresh_pacing(self):
+        """Fetch the flow control pacing, off the Tk thread, every PACING_REFRESH_INTERVAL ms.
+        Runs on the Tk thread."""
+        try:
+            if not self.pacing_fetch_running:
+                self.pacing_fetch_running = True
+                threading.Thread(target=self.fetch_pacing, daemon=True).start()
+        finally:
+            self.after(tcc.PACING_REFRESH_INTERVAL, self.refresh_pacing)
+
+    def fetch_pacing(self):
+        """Runs on the pacing thread. With a RemoteComm this is a round trip to the daemon."""
+        post = self.master.ui_dispatcher.post
+        try:
+            post(self.show_pacing, self.i2c_comm.pacing())
+        except Exception as e:
+            print("Couldn't get the flow control pacing: {}".format(e))
+        finally:
+            post(self.pacing_fetched)
+
+    def pacing_fetched(self):
+        self.pacing_fetch_running = False
+
+    def show_pacing(self, pacing):
+        """Show the current flow control pacing for each board. Runs on the Tk thread."""
+        for adr, (spacing_box, round_trip_box, error_rate_box) in self.pacing_widgets.items():
+            if adr not in pacing:
+                continue
+            spacing, round_trip, error_rate, messages, errors = pacing[adr]
+            for box, value in ((spacing_box, "{:.2f}".format(spacing * 1000)),
+                               (round_trip_box, "{:.2f}".format(round_trip * 1000)),
+                               (error_rate_box, "{:.1%}".format(error_rate))):
+                box.delete(0, tk.END)
+                box.insert(0, value)
 
     @staticmethod
     def add_label_frame(parent, text, x_padx=2, x_pady=2, i_pad=3,
@@ -193,65 +273,87 @@ class RaspArduinoTestTab(ttk.Frame):
         self.iter_count.grid(row=row, column=col, sticky='W')
         self.iter_count.insert(0, 10)
         col += 1
+        ttk.Button(test_control_frame, text="Save Metrics", w=12, style="BiggerText.TButton",
+                   command=self.save_metrics).grid(row=row, column=col, sticky='W', padx=10)
+        col += 1
         self.cancelButt = ttk.Button(cancel_butt_frame, text="Cancel Test", w=10, style="BiggerText.TButton",
                                      command=quit).grid()
 
+    def save_metrics(self):
+        """Write the bus metrics to BUS_METRICS_FILE and list the busiest registers"""
+        self.i2c_comm.dump_metrics(BUS_METRICS_FILE)
+        print("Bus metrics saved to {}. Busiest registers:".format(BUS_METRICS_FILE))
+        for (adr, reg), summary in list(self.i2c_comm.metrics().items())[:5]:
+            print("  adr 0x{:02x} reg {:3}: {:.3f} s, {} transactions, {} retries, p99 {} us".format(
+                adr, reg, summary["busy_time"], summary["transactions"], summary["retries"],
+                summary["latency"]["p99_us"]))
+
     def read_test(self, iterations):
+        """Runs on the test thread"""
+        post = self.master.ui_dispatcher.post
         for i in range(iterations):
             for device in self.inventory:
                 adr = device['i2cAddress']
                 result = self.i2c_comm.block_read_test(adr)
+                post(self.update_read_results, adr, result, iterations - i - 1)
+        post(self.test_complete, iterations)
 
-                # Update the totals in the GUI with the new results
-                (tot_transmit_box, read_exception_box, write_exception_box,
-                           data_mismatch_box, uncorrected_box) = self.status_widgets[adr]
+    def update_read_results(self, adr, result, remaining):
+        """Update the totals in the GUI with the new results. Runs on the Tk thread."""
+        if adr not in self.status_widgets:
+            return      # board has left the inventory
+        (tot_transmit_box, read_exception_box, write_exception_box,
+                   data_mismatch_box, uncorrected_box) = self.status_widgets[adr]
 
-                tt = int(tot_transmit_box.get()) + result[0]
-                tot_transmit_box.delete(0, tk.END)
-                tot_transmit_box.insert(0, tt)
+        tt = int(tot_transmit_box.get()) + result[0]
+        tot_transmit_box.delete(0, tk.END)
+        tot_transmit_box.insert(0, tt)
 
-                re = int(read_exception_box.get()) + result[1]
-                read_exception_box.delete(0, tk.END)
-                read_exception_box.insert(0, re)
+        re = int(read_exception_box.get()) + result[1]
+        read_exception_box.delete(0, tk.END)
+        read_exception_box.insert(0, re)
 
-                dm = int(data_mismatch_box.get()) + result[2]
-                data_mismatch_box.delete(0, tk.END)
-                data_mismatch_box.insert(0, dm)
+        dm = int(data_mismatch_box.get()) + result[2]
+        data_mismatch_box.delete(0, tk.END)
+        data_mismatch_box.insert(0, dm)
 
-                self.root.update_idletasks()
-                self.iter_count.delete(0, tk.END)
-                self.iter_count.insert(0, iterations - i - 1)
+        self.iter_count.delete(0, tk.END)
+        self.iter_count.insert(0, remaining)
 
     def write_verify_test(self, iterations):
         """
         iterations - the number of times the user wants the test run
+
+        Runs on the test thread
         """
+        post = self.master.ui_dispatcher.post
         for i in range(iterations):
             for device in self.inventory:
                 adr = device['i2cAddress']
                 result = self.i2c_comm.block_write_test(adr)
-
-                # Update the totals in the GUI with the new results
-                (tot_transmit_box, read_exception_box, write_exception_box,
-                 data_mismatch_box, uncorrected_box) = self.status_widgets[adr]
-                ct = int(tot_transmit_box.get()) + result[0]
-                re = int(read_exception_box.get()) + result[1]
-                we = int(write_exception_box.get()) + result[2]
-                dm = int(data_mismatch_box.get()) + result[3]
-                uc = int(uncorrected_box.get()) + result[4]
-                tot_transmit_box.delete(0, tk.END)
-                tot_transmit_box.insert(0, ct)
-                read_exception_box.delete(0, tk.END)
-                read_exception_box.insert(0, re)
-                write_exception_box.delete(0, tk.END)
-                write_exception_box.insert(0, we)
-                data_mismatch_box.delete(0, tk.END)
-                data_mismatch_box.insert(0, dm)
-                uncorrected_box.delete(0, tk.END)
-                uncorrected_box.insert(0, uc)
-                self.root.update_idletasks()
-                self.iter_count.delete(0, tk.END)
-                self.iter_count.insert(0, iterations - i - 1)
-
-
-
+                post(self.update_write_verify_results, adr, result, iterations - i - 1)
+        post(self.test_complete, iterations)
+
+    def update_write_verify_results(self, adr, result, remaining):
+        """Update the totals in the GUI with the new results. Runs on the Tk thread."""
+        if adr not in self.status_widgets:
+            return      # board has left the inventory
+        (tot_transmit_box, read_exception_box, write_exception_box,
+         data_mismatch_box, uncorrected_box) = self.status_widgets[adr]
+        ct = int(tot_transmit_box.get()) + result[0]
+        re = int(read_exception_box.get()) + result[1]
+        we = int(write_exception_box.get()) + result[2]
+        dm = int(data_mismatch_box.get()) + result[3]
+        uc = int(uncorrected_box.get()) + result[4]
+        tot_transmit_box.delete(0, tk.END)
+        tot_transmit_box.insert(0, ct)
+        read_exception_box.delete(0, tk.END)
+        read_exception_box.insert(0, re)
+        write_exception_box.delete(0, tk.END)
+        write_exception_box.insert(0, we)
+        data_mismatch_box.delete(0, tk.END)
+        data_mismatch_box.insert(0, dm)
+        uncorrected_box.delete(0, tk.END)
+        uncorrected_box.insert(0, uc)
+        self.iter_count.delete(0, tk.END)
+        self.iter_count.insert(0, remaining)
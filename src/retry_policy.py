@@ -0,0 +1,113 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the retry policy shared by the I2C_Comm retry loops.
+#
+
+import random
+from time import sleep, monotonic
+import tc_constants as tcc
+from device_health import CircuitOpenError
+
+# Classification of a failed bus transaction. The length and checksum values
+# are the errors returned by i2c_framing.parse_reply().
+ERROR_NACK = "nack"             # IOError - the board didn't acknowledge (busy or gone)
+ERROR_LENGTH = "length"         # reply was the wrong length
+ERROR_CHECKSUM = "checksum"     # reply was corrupted
+ERROR_REG_ID = "reg_id"         # reply was for a different register
+ERROR_MISMATCH = "mismatch"     # read back didn't match what was written
+ERROR_CIRCUIT_OPEN = "circuit_open"     # the board is quarantined (see DeviceHealth). Never retried.
+
+
+def io_error_kind(error):
+    """Classify an IOError raised by a bus transaction"""
+    return ERROR_CIRCUIT_OPEN if isinstance(error, CircuitOpenError) else ERROR_NACK
+
+
+class RetryPolicy:
+    def __init__(self, attempts=tcc.RETRY_ATTEMPTS, nack_delay=tcc.RETRY_NACK_DELAY,
+                 corrupt_delay=tcc.RETRY_CORRUPT_DELAY, max_delay=tcc.RETRY_MAX_DELAY,
+                 budget=tcc.RETRY_BUDGET, seed=None):
+        """How a failed bus operation is retried.
+
+        The delay before a retry is drawn at random between zero and a ceiling that
+        doubles with each retry (exponential backoff with full jitter). A NACK means
+        the board is busy, so its first ceiling is longer than that of a corrupted
+        reply, which is usually noise and worth trying again straight away.
+
+        Each call has a time budget. No retry is started that would end after it, so a
+        board that keeps failing can't hold the bus for long.
+
+        :param attempts: most attempts of one operation, the first included
+        :param budget: seconds from the start of a call after which no more retries are made
+        """
+        self.attempts = attempts
+        self.first_delay = {ERROR_NACK: nack_delay,
+                            ERROR_LENGTH: corrupt_delay,
+                            ERROR_CHECKSUM: corrupt_delay,
+                            ERROR_REG_ID: corrupt_delay,
+                            ERROR_MISMATCH: corrupt_delay}
+        self.max_delay = max_delay
+        self.budget = budget
+        self.random = random.Random(seed)
+
+    def deadline(self):
+        """Deadline of a call starting now"""
+        return monotonic() + self.budget
+
+    def delay(self, error, retry):
+        """Seconds to wait before retry number retry (0 = first retry) after the given error"""
+        ceiling = min(self.max_delay, self.first_delay.get(error, self.max_delay) * (2 ** retry))
+        return self.random.uniform(0, ceiling)
+
+    def start(self, deadline=None):
+        """Start retrying an operation. See Retry.
+
+        :param deadline: monotonic() time to give up retrying. Nested operations pass
+                         their caller's deadline so the whole call shares one budget.
+        """
+        return Retry(self, self.deadline() if deadline is None else deadline)
+
+
+class Retry:
+    def __init__(self, policy, deadline):
+        """The attempts of one operation. Used as
+
+            retry = policy.start()
+            while retry.next_attempt():
+                ...
+                if it worked:
+                    break
+                retry.failed(ERROR_xxx)
+        """
+        self.policy = policy
+        self.deadline = deadline
+        self.attempt = 0
+        self.error = None
+
+    def next_attempt(self):
+        """Wait out the backoff and return True if another attempt should be made"""
+        if self.attempt == 0:
+            self.attempt = 1
+            return True
+        if self.attempt >= self.policy.attempts or self.error == ERROR_CIRCUIT_OPEN:
+            return False
+        delay = self.policy.delay(self.error, self.attempt - 1)
+        if monotonic() + delay > self.deadline:
+            return False
+        if delay > 0:
+            sleep(delay)
+        self.attempt += 1
+        return True
+
+    def failed(self, error):
+        """The attempt failed with the given ERROR_xxx"""
+        self.error = error
+
+    @property
+    def retries(self):
+        return max(0, self.attempt - 1)
@@ -0,0 +1,89 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the shadow register cache. It holds the last value
+# confirmed for each register of each board on the bus.
+#
+
+import threading
+import tc_constants as tcc
+
+
+class ShadowRegisters:
+    def __init__(self, static_registers=tcc.I2C_STATIC_REGISTERS, setting_registers=tcc.I2C_SETTING_REGISTERS):
+        """Last confirmed value of each (adr, reg).
+
+        A value is confirmed when it is read from the board or when a write of it is
+        verified. Static registers (inventory) never change while a board is running so
+        reads of them can be served from here. Setting registers hold values the board
+        keeps until told otherwise, so writing the value it already has can be skipped.
+
+        Registers that are neither (i.e. write test, up counter, seq num) are not kept.
+
+        :param static_registers: registers whose reads may be served from the cache
+        :param setting_registers: registers whose writes may be suppressed
+        """
+        self.static_registers = frozenset(static_registers)
+        self.setting_registers = frozenset(setting_registers)
+        self.lock = threading.Lock()
+        self.boards = {}            # I2C address -> {reg: data}
+        self.on_change = None
+
+    def set_listener(self, on_change):
+        """on_change(adr, reg, data) is called, from the bus worker, when a register is confirmed with a new value"""
+        self.on_change = on_change
+
+    def is_kept(self, reg):
+        return reg in self.static_registers or reg in self.setting_registers
+
+    def cached_read(self, adr, reg):
+        """Return a copy of the confirmed data of a static register, None if there isn't any"""
+        if reg not in self.static_registers:
+            return None
+        with self.lock:
+            data = self.boards.get(adr, {}).get(reg)
+        return None if data is None else list(data)
+
+    def write_needed(self, adr, reg, data):
+        """Return False if data is the confirmed value of a setting register"""
+        if reg not in self.setting_registers:
+            return True
+        with self.lock:
+            return self.boards.get(adr, {}).get(reg) != list(data)
+
+    def confirm(self, adr, reg, data):
+        """Record data as the value the board holds in reg"""
+        if not self.is_kept(reg):
+            return
+        data = list(data)
+        with self.lock:
+            registers = self.boards.setdefault(adr, {})
+            changed = registers.get(reg) != data
+            registers[reg] = data
+        if changed and self.on_change is not None:
+            self.on_change(adr, reg, data)
+
+    def forget(self, adr, reg):
+        """The value of reg is no longer known (i.e. a write to it failed)"""
+        with self.lock:
+            self.boards.get(adr, {}).pop(reg, None)
+
+    def invalidate(self, adr=None):
+        """Forget everything known about the board at adr, or about all boards if adr is None.
+
+        Used when a board may have been reset or swapped.
+        """
+        with self.lock:
+            if adr is None:
+                self.boards.clear()
+            else:
+                self.boards.pop(adr, None)
+
+    def state(self, adr):
+        """Return {reg: data} of everything confirmed for the board at adr"""
+        with self.lock:
+            return {reg: list(data) for reg, data in self.boards.get(adr, {}).items()}
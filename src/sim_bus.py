@@ -0,0 +1,287 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains a simulated I2C bus with simulated Arduino boards on it.
+# It is a transport (see i2c_transport.py) so the whole control stack can be
+# run, load tested and benchmarked without the hardware.
+#
+# The boards follow the register map in tc_constants.py: the inventory
+# registers, write test, up counter, checksum failure count, write seq num,
+# the two throttles and the lights.
+#
+
+import random
+import threading
+from time import sleep, monotonic
+import tc_constants as tcc
+import i2c_framing
+
+
+def padded(text, length):
+    """text as a list of length bytes, zero filled"""
+    data = list(text.encode("ascii"))[:length]
+    return data + [0] * (length - len(data))
+
+
+class SimulatedThrottle:
+    def __init__(self):
+        self.power_status = tcc.POWER_DISABLED
+        self.direction = tcc.DIR_FORWARD
+        self.momentum = tcc.MOMENTUM_DISABLED
+        self.power_level = 0
+        self.emergency_stop = 0
+        self.speed = 0.0
+        self.speed_time = monotonic()
+
+    def update_speed(self):
+        """Move the speed towards the power level. With momentum on it ramps at SIM_MOMENTUM_RATE."""
+        now = monotonic()
+        target = self.power_level if self.power_status == tcc.POWER_ENABLED else 0
+        if self.momentum == tcc.MOMENTUM_ENABLED:
+            step = (now - self.speed_time) * tcc.SIM_MOMENTUM_RATE
+            if self.speed < target:
+                self.speed = min(target, self.speed + step)
+            else:
+                self.speed = max(target, self.speed - step)
+        else:
+            self.speed = target
+        self.speed_time = now
+
+    def status(self):
+        self.update_speed()
+        return [self.power_status, self.direction, self.momentum, self.power_level,
+                int(self.speed), self.emergency_stop]
+
+    def read(self, offset):
+        if offset == tcc.I2C_REG_DT_STATUS_BLOCK - tcc.DT_THROTTLE_BASE:
+            return self.status()
+        return self.status()[offset:offset + 1]
+
+    def write(self, offset, data):
+        self.update_speed()
+        if offset == tcc.I2C_REG_DT_POWER_STATUS - tcc.DT_THROTTLE_BASE:
+            self.power_status = data[0]
+            if data[0] == tcc.POWER_ENABLED:
+                self.emergency_stop = 0
+        elif offset == tcc.I2C_REG_DT_DIRECTION - tcc.DT_THROTTLE_BASE:
+            self.direction = data[0]
+        elif offset == tcc.I2C_REG_DT_MOMENTUM - tcc.DT_THROTTLE_BASE:
+            self.momentum = data[0]
+        elif offset == tcc.I2C_REG_DT_POWER_LEVEL - tcc.DT_THROTTLE_BASE:
+            self.power_level = data[0]
+        elif offset == tcc.I2C_REG_DT_EMERGENCY_STOP - tcc.DT_THROTTLE_BASE and data[0] == tcc.STOP_ACTIVATED:
+            self.emergency_stop = 1
+            self.power_status = tcc.POWER_DISABLED
+            self.power_level = 0
+            self.speed = 0.0
+
+
+class SimulatedBoard:
+    def __init__(self, adr, board_type, description, board_version=1, sw_version="1.0.0",
+                 light_pins=tcc.SIM_LIGHT_PINS):
+        """One simulated Arduino.
+
+        :param adr: I2C address
+        :param board_type: one of the BOARD_TYPE_xxx values. Throttle boards have
+                           two throttles, lights boards have light_pins lights.
+        :param sw_version: application sw version. Registers added in later versions
+                           (i.e. the throttle status block) read as zeros and ignore writes.
+        """
+        self.adr = adr
+        self.board_type = board_type
+        self.description = description
+        self.board_version = board_version
+        self.sw_version = sw_version
+        self.firmware = tuple(int(part) for part in sw_version.split("."))
+        self.write_seq_num = 0
+        self.write_test = [0] * tcc.I2C_WRITE_TEST_LEN
+        self.up_counter = 0
+        self.checksum_failures = 0
+        self.throttles = [SimulatedThrottle(), SimulatedThrottle()] if board_type == tcc.BOARD_TYPE_THROTTLE else []
+        self.light_levels = [0] * light_pins if board_type == tcc.BOARD_TYPE_LIGHTS else []
+        self.light_backlog = 0.0        # pairs received and not yet applied
+        self.light_backlog_time = monotonic()
+
+    def inventory_block_1(self):
+        return ([self.adr, self.board_type] + padded(self.description, tcc.I2C_BOARD_DESCRIPTION_LEN) +
+                [self.board_version])
+
+    def inventory_block_2(self):
+        return (padded(self.sw_version, tcc.I2C_I2C_COMM_SW_VERSION_LEN) +
+                padded(self.sw_version, tcc.I2C_INVENTORY_SW_VERSION_LEN) +
+                padded(self.sw_version, tcc.I2C_APP_SW_VERSION_LEN))
+
+    def light_batches(self):
+        """True if the firmware has the light batch and buffer credit registers"""
+        return self.firmware >= tcc.LIGHT_BATCH_SW_VERSION
+
+    def light_credit(self):
+        now = monotonic()
+        self.light_backlog = max(0.0, self.light_backlog - (now - self.light_backlog_time) * tcc.SIM_LIGHT_DRAIN_RATE)
+        self.light_backlog_time = now
+        return max(0, tcc.SIM_LIGHT_BUFFER - int(self.light_backlog + 0.999))
+
+    def throttle(self, reg):
+        """Return (throttle, register offset) for a throttle register, (None, None) otherwise"""
+        offset = reg - tcc.DT_THROTTLE_BASE
+        instance = offset // tcc.DT_THROTTLE_ALLOCATION
+        offset = offset % tcc.DT_THROTTLE_ALLOCATION
+        if self.firmware >= tcc.DT_STATUS_BLOCK_SW_VERSION:
+            last = tcc.I2C_REG_DT_STATUS_BLOCK
+        else:
+            last = tcc.I2C_REG_DT_EMERGENCY_STOP
+        if 0 <= instance < len(self.throttles) and offset <= last - tcc.DT_THROTTLE_BASE:
+            return self.throttles[instance], offset
+        return None, None
+
+    def read(self, reg):
+        """Data held in reg (without the reg id or checksum)"""
+        if reg == tcc.I2C_REG_INVENTORY_VERSION:
+            return [tcc.INVENTORY_VERSION_2]
+        if reg == tcc.I2C_REG_I2C_ADR:
+            return [self.adr]
+        if reg == tcc.I2C_REG_BOARD_TYPE:
+            return [self.board_type]
+        if reg == tcc.I2C_REG_BOARD_DESCRIPTION:
+            return padded(self.description, tcc.I2C_BOARD_DESCRIPTION_LEN)
+        if reg == tcc.I2C_REG_BOARD_VERSION:
+            return [self.board_version]
+        if reg == tcc.I2C_REG_INVENTORY_BLOCK_1:
+            return self.inventory_block_1()
+        if reg == tcc.I2C_REG_INVENTORY_BLOCK_2:
+            return self.inventory_block_2()
+        if reg in (tcc.I2C_REG_I2C_COMM_SW_VERSION, tcc.I2C_REG_INVENTORY_SW_VERSION, tcc.I2C_REG_APP_SW_VERSION):
+            return padded(self.sw_version, tcc.I2C_APP_SW_VERSION_LEN)
+        if reg == tcc.I2C_REG_WRITE_TEST:
+            return list(self.write_test)
+        if reg == tcc.I2C_REG_UP_COUNTER:
+            value = self.up_counter
+            self.up_counter = (self.up_counter + 1) % 256
+            return [value]
+        if reg == tcc.I2C_REG_I2C_WRITE_CHKSUM_FAILURE:
+            return [self.checksum_failures >> 8 & 0xFF, self.checksum_failures & 0xFF]
+        if reg == tcc.I2C_REG_WRITE_SEQ_NUM:
+            return [self.write_seq_num]
+        if reg == tcc.I2C_REG_LIGHT_BUFFER_CREDIT and self.light_levels and self.light_batches():
+            return [self.light_credit()]
+        throttle, offset = self.throttle(reg)
+        if throttle is not None:
+            return throttle.read(offset)
+        return []
+
+    def write(self, reg, frame):
+        """Handle a write of frame ([seq num] + data + [checksum]) to reg"""
+        if i2c_framing.checksum(frame) != -reg & 0xFF:
+            self.checksum_failures = (self.checksum_failures + 1) % 65536
+            return
+        self.write_seq_num = frame[0]
+        data = frame[1:-1]
+
+        if reg == tcc.I2C_REG_WRITE_TEST:
+            self.write_test = list(data[:tcc.I2C_WRITE_TEST_LEN])
+        elif reg == tcc.I2C_REG_UP_COUNTER:
+            self.up_counter = data[0]
+        elif reg == tcc.I2C_REG_LIGHT_POWER_LEVEL and self.light_levels:
+            self.set_lights(data[:2])
+        elif reg == tcc.I2C_REG_LIGHT_POWER_LEVEL_BATCH and self.light_levels and self.light_batches():
+            self.set_lights(data[1:1 + 2 * data[0]])
+        else:
+            throttle, offset = self.throttle(reg)
+            if throttle is not None:
+                throttle.write(offset, data)
+
+    def set_lights(self, pairs):
+        self.light_credit()
+        for i in range(0, len(pairs) - 1, 2):
+            pin, level = pairs[i], pairs[i + 1]
+            if pin < len(self.light_levels):
+                self.light_levels[pin] = level
+        self.light_backlog += len(pairs) // 2
+
+
+def default_boards(first_adr=0x08, sw_version=tcc.SIM_SW_VERSION):
+    """A throttle board, a lights board and a switching board, at first_adr and up"""
+    return [SimulatedBoard(first_adr, tcc.BOARD_TYPE_THROTTLE, "Sim Throttle", sw_version=sw_version),
+            SimulatedBoard(first_adr + 1, tcc.BOARD_TYPE_LIGHTS, "Sim Lights", sw_version=sw_version),
+            SimulatedBoard(first_adr + 2, tcc.BOARD_TYPE_SWITCHING, "Sim Switches", sw_version=sw_version)]
+
+
+class SimulatedBus:
+    def __init__(self, boards=None, latency=tcc.SIM_LATENCY, bit_rate=tcc.SIM_BIT_RATE,
+                 nack_rate=0.0, corruption_rate=0.0, seed=None):
+        """A transport (see i2c_transport.py) with simulated boards on it.
+
+        Each transaction takes latency seconds plus the time to clock its bytes at
+        bit_rate (9 bits a byte including the ack).
+
+        :param boards: list of SimulatedBoard. Defaults to default_boards().
+        :param nack_rate: probability a transaction isn't acknowledged (IOError)
+        :param corruption_rate: probability one bit of a transaction's data is flipped
+        :param seed: seed for the NACK / corruption random numbers
+        """
+        self.boards = {board.adr: board for board in (default_boards() if boards is None else boards)}
+        self.latency = latency
+        self.bit_rate = bit_rate
+        self.nack_rate = nack_rate
+        self.corruption_rate = corruption_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.nacks = 0
+        self.corruptions = 0
+        self.busy_time = 0.0            # seconds the simulated bus was in use
+
+    def transact(self, adr, byte_count):
+        """Take the bus for one transaction and return the board at adr. Raises IOError on a NACK."""
+        duration = self.latency + (byte_count + 2) * 9 / self.bit_rate     # + address and reg bytes
+        with self.lock:
+            self.transactions += 1
+            self.busy_time += duration
+            if duration > 0:
+                sleep(duration)
+            board = self.boards.get(adr)
+            if board is None or self.random.random() < self.nack_rate:
+                self.nacks += 1
+                raise IOError(121, "Remote I/O error")
+            return board
+
+    def corrupt(self, frame):
+        """Maybe flip one bit of frame (a bytearray)"""
+        if frame and self.random.random() < self.corruption_rate:
+            self.corruptions += 1
+            frame[self.random.randrange(len(frame))] ^= 1 << self.random.randrange(8)
+
+    def read_block(self, adr, reg, length):
+        board = self.transact(adr, length)
+        with self.lock:
+            data = board.read(reg)
+        frame = bytearray([reg] + data[:length - 2])
+        frame += bytes(length - 1 - len(frame))
+        frame.append(-sum(frame) & 0xFF)
+        self.corrupt(frame)
+        return list(frame)
+
+    def write_block(self, adr, reg, data):
+        board = self.transact(adr, len(data))
+        frame = bytearray(data)
+        self.corrupt(frame)
+        with self.lock:
+            board.write(reg, frame)
+
+    def write_quick(self, adr):
+        self.transact(adr, 0)
+
+    def read_byte(self, adr):
+        self.transact(adr, 1)
+        return 0
+
+    def close(self):
+        pass
+
+    def utilization(self, elapsed):
+        """Fraction of elapsed seconds the bus was busy"""
+        return self.busy_time / elapsed if elapsed > 0 else 0.0
@@ -7,24 +7,57 @@
 #
 #
 
-import tc_gui
-import i2c_comm as i2c_comm
+import argparse
+import tc_constants as tcc
+import i2c_multibus
 
-bus_id = 1
+bus_ids = [1]
 
 
 def main():
-    # #########################################
-    # Run the GUI
-    # #########################################
-
-    i2c_bus = i2c_comm.I2C_Comm(bus_id)
-
-    gui = tc_gui.TcGui(i2c_bus)
-
-    gui.run()
+    parser = argparse.ArgumentParser(description="Train control")
+    parser.add_argument("--bus", type=int, nargs="+", default=bus_ids,
+                        help="I2C bus numbers the boards are on (default 1). Each bus gets its own worker.")
+    parser.add_argument("--sim", action="store_true",
+                        help="run against a simulated bus instead of the I2C hardware")
+    parser.add_argument("--capture", nargs="?", const=tcc.CAPTURE_FILE,
+                        help="record the bus traffic and save it to this file on exit "
+                             "(default {}). See bus_capture.py.".format(tcc.CAPTURE_FILE))
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--daemon", nargs="?", const=tcc.DAEMON_ADDRESS, metavar="ADDRESS",
+                      help="run the control daemon, without the GUI, on a Unix socket path or [host:]port "
+                           "(default {}). See tc_daemon.py.".format(tcc.DAEMON_ADDRESS))
+    mode.add_argument("--connect", nargs="?", const=tcc.DAEMON_ADDRESS, metavar="ADDRESS",
+                      help="run the GUI as a client of the control daemon at ADDRESS "
+                           "(default {})".format(tcc.DAEMON_ADDRESS))
+    args = parser.parse_args()
+
+    if args.connect:
+        # the daemon owns the buses
+        import tc_client
+        import tc_gui
+        tc_gui.TcGui(tc_client.RemoteComm(args.connect), remote=True).run()
+        return
+
+    i2c_bus = i2c_multibus.open_buses(args.bus, simulate=args.sim, capture=args.capture is not None)
+
+    try:
+        if args.daemon:
+            import tc_daemon
+            tc_daemon.ControlDaemon(i2c_bus, args.daemon).run()
+        else:
+            # #########################################
+            # Run the GUI
+            # #########################################
+            import tc_gui
+            gui = tc_gui.TcGui(i2c_bus)
+
+            gui.run()
+    finally:
+        # the GUI leaves with exit()
+        if args.capture:
+            print("Saved {} bus transactions".format(i2c_bus.save_capture(args.capture)))
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,374 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the clients of the control daemon (see tc_daemon.py).
+#
+# RemoteComm offers the I2C_Comm services the GUI uses, each carried out by
+# the daemon, so the GUI runs the same in or out of process.
+#
+# ProtocolClient speaks the binary protocol (see tc_protocol.py), for control
+# panels and scripts that keep in sync with the layout by subscription.
+#
+
+import itertools
+import json
+import socket
+import threading
+from concurrent import futures
+import tc_constants as tcc
+import i2c_comm
+import bus_metrics
+import tc_daemon
+import tc_protocol
+
+
+class RemoteComm:
+    def __init__(self, address=tcc.DAEMON_ADDRESS):
+        """Connect to the control daemon.
+
+        :param address: Unix socket path or [host:]port the daemon listens on
+        """
+        family, server_address = tc_daemon.parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(server_address)
+        self.rfile = self.sock.makefile("rb")
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}               # request id -> (method, Future)
+        self.connected = True
+        self.executor = futures.ThreadPoolExecutor(max_workers=tcc.DAEMON_WORKERS, thread_name_prefix="client")
+
+        self.callback_dispatcher = None
+        self.health_listener = None
+        self.inventory_listener = None
+        self.coalesced_callbacks = {}   # (adr, reg) -> callback of the latest coalesced write
+
+        threading.Thread(target=self.read_loop, name="tc-client", daemon=True).start()
+
+    # ########################################################################
+    # Talking to the daemon
+    # ########################################################################
+    def call_async(self, method, *args, **kwargs):
+        """Send a request to the daemon.
+
+        :return: Future for the result. It fails with IOError if the daemon reports an
+                 error or the connection is lost.
+        """
+        future = futures.Future()
+        with self.lock:
+            if not self.connected:
+                future.set_exception(IOError("Not connected to the control daemon"))
+                return future
+            request_id = next(self.ids)
+            self.pending[request_id] = (method, future)
+
+        line = json.dumps({"id": request_id, "method": method, "args": args, "kwargs": kwargs}) + "\n"
+        try:
+            with self.send_lock:
+                self.sock.sendall(line.encode())
+        except OSError as e:
+            self.disconnected(e)
+        return future
+
+    def call(self, method, *args, **kwargs):
+        return self.call_async(method, *args, **kwargs).result()
+
+    def read_loop(self):
+        error = "connection closed"
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                if "event" in message:
+                    self.handle_event(message["event"], *message["args"])
+                else:
+                    self.handle_reply(message)
+        except (OSError, ValueError) as e:
+            error = e
+        self.disconnected(error)
+
+    def handle_reply(self, message):
+        with self.lock:
+            method, future = self.pending.pop(message["id"], (None, None))
+        if future is None:
+            return
+        if "error" in message:
+            future.set_exception(IOError(message["error"]))
+            return
+        result = message["result"]
+        if method in tc_daemon.ITEM_RESULTS:
+            result = {tuple(key) if isinstance(key, list) else key: value for key, value in result}
+        future.set_result(result)
+
+    def handle_event(self, event, *args):
+        if event == "health" and self.health_listener is not None:
+            self.health_listener(*args)
+        elif event == "inventory" and self.inventory_listener is not None:
+            self.inventory_listener(args[0])
+        elif event == "coalesced":
+            adr, reg, result = args
+            callback = self.coalesced_callbacks.get((adr, reg))
+            if callback is not None:
+                self.dispatch(callback, result)
+
+    def disconnected(self, error):
+        with self.lock:
+            if not self.connected:
+                return
+            self.connected = False
+            pending = list(self.pending.values())
+            self.pending.clear()
+        print("Lost the connection to the control daemon: {}".format(error))
+        for method, future in pending:
+            future.set_exception(IOError("Lost the connection to the control daemon"))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    # ########################################################################
+    # Services of the whole system
+    # ########################################################################
+    def submit(self, priority, func, *args, **kwargs):
+        """Run func in the background and return a Future for its result.
+
+        A service of this RemoteComm (i.e. self.read_register) is sent straight to the
+        daemon, which queues it to the bus worker. Anything else runs on a local thread
+        and makes its own calls.
+        """
+        if getattr(func, "__self__", None) is self and func.__name__ in tc_daemon.REMOTE_METHODS:
+            return self.call_async(func.__name__, *args, **kwargs)
+        return self.executor.submit(func, *args, **kwargs)
+
+    def submit_to(self, adr, priority, func, *args, **kwargs):
+        return self.submit(priority, func, *args, **kwargs)
+
+    def get_inventory(self):
+        """The board inventory the daemon holds"""
+        return self.call("inventory")
+
+    def set_inventory_listener(self, on_change):
+        """on_change(inventory) is called, from the client thread, when the daemon sees boards come or go"""
+        self.inventory_listener = on_change
+
+    def assign_buses(self, inventory):
+        """Nothing to do. The daemon keeps track of which bus each board is on."""
+
+    def set_callback_dispatcher(self, dispatcher):
+        """See I2C_Comm.set_callback_dispatcher()"""
+        self.callback_dispatcher = dispatcher
+
+    def set_health_listener(self, on_change):
+        """on_change(adr, state) is called from the client thread when a board's health changes"""
+        self.health_listener = on_change
+
+    def deliver(self, callback, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print("Bus operation failed: {}".format(e))
+            return
+        self.dispatch(callback, result)
+
+    def dispatch(self, callback, result):
+        if self.callback_dispatcher is None:
+            callback(result)
+        else:
+            self.callback_dispatcher(callback, result)
+
+    def get_controller_list(self, first_adr=tcc.I2C_SCAN_FIRST_ADR, last_adr=tcc.I2C_SCAN_LAST_ADR,
+                            priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.call("get_controller_list", first_adr, last_adr, priority)
+
+    def bus_of(self, adr):
+        return self.call("bus_of", adr)
+
+    def pacing(self):
+        return self.call("pacing")
+
+    def busy_time(self):
+        return self.call("busy_time")
+
+    def metrics(self):
+        return self.call("metrics")
+
+    def dump_metrics(self, file):
+        """Write the daemon's bus metrics to file, here on the client. The daemon never
+        writes files a client names."""
+        bus_metrics.write_report(file, self.metrics())
+
+    def reset_metrics(self):
+        self.call("reset_metrics")
+
+    def invalidate(self, adr=None):
+        self.call("invalidate", adr)
+
+    char_list_to_string = staticmethod(i2c_comm.I2C_Comm.char_list_to_string)
+
+    # ########################################################################
+    # Services of one board
+    # ########################################################################
+    def probe(self, adr):
+        return self.call("probe", adr)
+
+    def get_device_info(self, adr, priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.call("get_device_info", adr, priority)
+
+    def read_register(self, adr, reg, data_length, priority=tcc.PRIORITY_POLLING, cached=True):
+        return self.call("read_register", adr, reg, data_length, priority, cached)
+
+    def read_throttle_status(self, adr, throttle_instance, priority=tcc.PRIORITY_POLLING):
+        status = self.call("read_throttle_status", adr, throttle_instance, priority)
+        return None if status is None else i2c_comm.ThrottleStatus(*status)
+
+    def write_register_verify(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.call("write_register_verify", adr, reg, data, priority)
+
+    def write_register_async(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None):
+        """See I2C_Comm.write_register_async()"""
+        future = self.call_async("write_register_verify", adr, reg, data, priority)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.deliver(callback, f))
+        return future
+
+    def write_register_coalesced(self, adr, reg, data, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None,
+                                 max_hz=tcc.COALESCE_MAX_HZ):
+        """See I2C_Comm.write_register_coalesced(). The daemon does the coalescing."""
+        with self.lock:
+            self.coalesced_callbacks[(adr, reg)] = callback
+        self.call_async("write_register_coalesced", adr, reg, data, priority, max_hz=max_hz,
+                        callback=callback is not None)
+
+    def write_registers_pipelined(self, adr, writes, priority=tcc.PRIORITY_DIAGNOSTICS):
+        return self.call("write_registers_pipelined", adr, writes, priority)
+
+    def write_registers_async(self, adr, writes, priority=tcc.PRIORITY_DIAGNOSTICS, callback=None):
+        """See I2C_Comm.write_registers_async()"""
+        future = self.call_async("write_registers_pipelined", adr, writes, priority)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.deliver(callback, f))
+        return future
+
+    def write_light_levels(self, adr, levels, priority=tcc.PRIORITY_LIGHTS):
+        return self.call("write_light_levels", adr, levels, priority)
+
+    def write_light_levels_async(self, adr, levels, priority=tcc.PRIORITY_LIGHTS, callback=None):
+        """See I2C_Comm.write_light_levels_async()"""
+        future = self.call_async("write_light_levels", adr, levels, priority)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.deliver(callback, f))
+        return future
+
+    def block_read_test(self, adr):
+        return self.call("block_read_test", adr)
+
+    def block_write_test(self, adr):
+        return self.call("block_write_test", adr)
+
+    def loopback_test(self, adr):
+        return self.call("loopback_test", adr)
+
+    def register_state(self, adr):
+        return self.call("register_state", adr)
+
+    def health(self, adr):
+        return self.call("health", adr)
+
+    def reset_health(self, adr):
+        self.call("reset_health", adr)
+
+
+class ProtocolClient:
+    def __init__(self, address=tcc.DAEMON_ADDRESS, on_delta=None):
+        """Binary protocol client of the control daemon.
+
+        self.state holds {(kind, adr, index, field): value} of what is subscribed to,
+        kept up to date by the daemon's deltas.
+
+        :param address: Unix socket path or [host:]port the daemon listens on
+        :param on_delta: optional on_delta(entries) called from the client thread with the
+                         (kind, adr, index, field, value) entries of each delta
+        """
+        family, server_address = tc_daemon.parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(server_address)
+        self.sock.sendall(tc_protocol.HELLO)
+        self.rfile = self.sock.makefile("rb")
+        self.on_delta = on_delta
+        self.state = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}               # command id -> Future for its STATUS_xxx
+        threading.Thread(target=self.read_loop, name="tc-protocol-client", daemon=True).start()
+
+    def send(self, msg_type, body=b""):
+        with self.lock:
+            self.sock.sendall(tc_protocol.frame(msg_type, body))
+
+    def subscribe(self, kinds=tc_protocol.KIND_ALL):
+        self.send(tc_protocol.MSG_SUBSCRIBE, bytes([kinds]))
+
+    def unsubscribe(self, kinds=tc_protocol.KIND_ALL):
+        self.send(tc_protocol.MSG_UNSUBSCRIBE, bytes([kinds]))
+
+    def command(self, command, args):
+        """Send a command.
+
+        :return: Future for its STATUS_xxx
+        """
+        future = futures.Future()
+        with self.lock:
+            request_id = next(self.ids) & 0xFFFF
+            self.pending[request_id] = future
+        self.send(tc_protocol.MSG_COMMAND, tc_protocol.COMMAND.pack(request_id, command) + args)
+        return future
+
+    def set_throttle(self, adr, throttle_instance, field, value):
+        """Set a throttle field (tc_protocol.FIELD_xxx), i.e. set_throttle(0x08, 0, FIELD_POWER_LEVEL, 100)"""
+        return self.command(tc_protocol.CMD_THROTTLE, bytes([adr, throttle_instance, field, value]))
+
+    def set_lights(self, adr, levels):
+        """Set lights on a lights board. levels is a list of (pin, level)."""
+        return self.command(tc_protocol.CMD_LIGHTS, bytes([adr] + [byte for pair in levels for byte in pair]))
+
+    def set_switch(self, number, position):
+        return self.command(tc_protocol.CMD_SWITCH, tc_protocol.SWITCH.pack(number, position))
+
+    def read_loop(self):
+        while True:
+            msg_type, body = tc_protocol.read_frame(self.rfile)
+            if msg_type is None:
+                break
+            if msg_type == tc_protocol.MSG_DELTA:
+                entries = tc_protocol.decode_delta(body)
+                with self.lock:
+                    self.state.update(((kind, adr, index, field), value)
+                                      for kind, adr, index, field, value in entries)
+                if self.on_delta is not None and entries:
+                    self.on_delta(entries)
+            elif msg_type == tc_protocol.MSG_RESULT:
+                request_id, status = tc_protocol.RESULT.unpack(body)
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(status)
+
+        with self.lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(IOError("Lost the connection to the control daemon"))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -52,6 +52,18 @@ elif SCREEN_SIZE == "LARGE":
     scale_slider_padding = (8, 5, 10)    # spacing around slider title
     stop_sign_file="stop_sign_74_74.png"
 
+# how often (ms) the GUI picks up work handed to it from other threads
+UI_DISPATCH_INTERVAL = 16
+
+# ms between level updates sent while a light slider is being dragged
+LIGHT_SLIDER_DEBOUNCE = 50
+
+# seconds between frames of a lighting scene
+SCENE_FRAME_INTERVAL = 0.05
+
+# how often (ms) the test tab refreshes the flow control pacing
+PACING_REFRESH_INTERVAL = 1000
+
 # ############################################################################
 # See I2C register definitions. The following are the I2C register assignments
 # (and register length) for each of the supported I2C registers. For example,
@@ -83,6 +95,17 @@ I2C_BOARD_DESCRIPTION_LEN = 16
 I2C_REG_BOARD_VERSION = 4
 I2C_BOARD_VERSION_LEN = 1
 
+# Inventory structure version 2. The board also packs its inventory into two
+# block registers so it can be collected in two reads instead of eight. Each
+# block (reg id + data + checksum) fits in a single 32 byte SMBus block read.
+INVENTORY_VERSION_2 = 2
+
+I2C_REG_INVENTORY_BLOCK_1 = 5       # i2c adr, board type, description, board version
+I2C_INVENTORY_BLOCK_1_LEN = 19
+
+I2C_REG_INVENTORY_BLOCK_2 = 6       # i2c comm, inventory and application sw versions
+I2C_INVENTORY_BLOCK_2_LEN = 27
+
 I2C_REG_I2C_COMM_SW_VERSION = 10
 I2C_I2C_COMM_SW_VERSION_LEN = 9
 
@@ -110,9 +133,80 @@ I2C_WRITE_SEQ_NUM_LEN = 1
 I2C_REG_APP_SW_VERSION = 20
 I2C_APP_SW_VERSION_LEN = 9
 
+# Inventory registers. These don't change while a board is running so reads
+# of them can be served from the shadow register cache.
+I2C_STATIC_REGISTERS = (I2C_REG_INVENTORY_VERSION, I2C_REG_I2C_ADR, I2C_REG_BOARD_TYPE,
+                        I2C_REG_BOARD_DESCRIPTION, I2C_REG_BOARD_VERSION, I2C_REG_INVENTORY_BLOCK_1,
+                        I2C_REG_INVENTORY_BLOCK_2, I2C_REG_I2C_COMM_SW_VERSION,
+                        I2C_REG_INVENTORY_SW_VERSION, I2C_REG_APP_SW_VERSION)
+
+# Range of addresses probed when scanning the bus for boards. These are the
+# non-reserved 7 bit addresses (same as the i2cdetect default).
+I2C_SCAN_FIRST_ADR = 0x08
+I2C_SCAN_LAST_ADR = 0x77
+
+# Seconds between telemetry reads (i.e. throttle speed) of a source that is
+# active (train moving) and one that is idle (stopped or powered off)
+TELEMETRY_FAST_INTERVAL = 0.1
+TELEMETRY_SLOW_INTERVAL = 1.0
+
+# Seconds between presence scans looking for boards added or removed while running
+PRESENCE_MONITOR_INTERVAL = 5
+
 # All transmissions include a 1 byte checksum
 I2C_CHECKSUM_LEN = 1
 
+# Largest transfer the SMBus block read/write calls support
+I2C_SMBUS_BLOCK_MAX = 32
+
+# Most writes issued back to back before the write_seq_num is read back to
+# verify them in a pipelined write
+I2C_PIPELINE_WINDOW = 16
+
+# Retries of a failed bus operation (see RetryPolicy). The backoff ceiling
+# starts at the NACK or corrupt delay and doubles with each retry, up to the
+# max. No retry is started more than the budget (seconds) into a call.
+RETRY_ATTEMPTS = 4
+RETRY_NACK_DELAY = 0.0005
+RETRY_CORRUPT_DELAY = 0.0001
+RETRY_MAX_DELAY = 0.005
+RETRY_BUDGET = 0.05
+
+# Circuit breaker (see DeviceHealth). A board is quarantined after this many
+# consecutive failed transactions, then probed every HEALTH_PROBE_INTERVAL
+# seconds, doubling while it stays down, up to the max.
+HEALTH_FAILURE_THRESHOLD = 8
+HEALTH_PROBE_INTERVAL = 1.0
+HEALTH_MAX_PROBE_INTERVAL = 16.0
+
+# ############################################################################
+# Bus worker priorities. All bus traffic is funneled through a single worker
+# per bus which services its queue lowest number first.
+# ############################################################################
+PRIORITY_EMERGENCY_STOP = 0
+PRIORITY_THROTTLE = 1
+PRIORITY_LIGHTS = 2
+PRIORITY_POLLING = 3
+PRIORITY_DIAGNOSTICS = 4
+
+# Flow control. Spacing (seconds) between messages to a board starts at the
+# initial value and adapts between min and max as messages succeed or fail.
+I2C_SETTLE_TIME = 1.0              # hold all traffic this long after opening the bus
+FLOW_INITIAL_SPACING = 0.001
+FLOW_MIN_SPACING = 0.0
+FLOW_MAX_SPACING = 0.05
+FLOW_SPACING_STEP = 0.0001
+FLOW_RECOVERY = 0.8                # each good message shrinks the spacing above min to this fraction
+FLOW_MAX_BACKOFF = 0.005           # most one failure adds to the spacing
+FLOW_SMOOTHING = 0.1               # weight of the newest sample in the round trip / error rate averages
+
+# Most seconds to wait for the throttles to power down on exit
+SHUTDOWN_TIMEOUT = 2.0
+
+# Upper bound on how often a coalesced register (i.e. throttle power level)
+# is written to a board. Intermediate values are dropped.
+COALESCE_MAX_HZ = 20
+
 # ################################################
 #  I2C Register map for the Throttle application
 # #################################################
@@ -145,9 +239,66 @@ I2C_REG_DT_EMERGENCY_STOP = DT_THROTTLE_BASE + 5      # A: 35, B:55
 I2C_DT_EMERGENCY_STOP_LEN = 1
 STOP_ACTIVATED = 1
 
+# Read only. Registers DT_POWER_STATUS through DT_EMERGENCY_STOP in one block read.
+# Only boards running application sw DT_STATUS_BLOCK_SW_VERSION or later have it.
+I2C_REG_DT_STATUS_BLOCK = DT_THROTTLE_BASE + 6        # A: 36, B:56
+I2C_DT_STATUS_BLOCK_LEN = 6
+DT_STATUS_BLOCK_SW_VERSION = (2, 0)
+
+# Registers holding settings a throttle keeps until told otherwise. A write of
+# the value the board is known to hold is skipped (see ShadowRegisters).
+I2C_SETTING_REGISTERS = tuple(reg + DT_THROTTLE_ALLOCATION * instance
+                              for instance in (0, 1)
+                              for reg in (I2C_REG_DT_POWER_STATUS, I2C_REG_DT_DIRECTION,
+                                          I2C_REG_DT_MOMENTUM, I2C_REG_DT_POWER_LEVEL))
+
+# Seconds after the last throttle write before the GUI trusts the board's status
+# over its own (i.e. to notice a board that has reset)
+THROTTLE_RECONCILE_SETTLE = 1.0
+
 # ################################################
 #  I2C Register map for the Lights application
 # #################################################
 
 I2C_REG_LIGHT_POWER_LEVEL = 150
-I2C_LIGHT_POWER_LEVEL_LEN = 2
\ No newline at end of file
+I2C_LIGHT_POWER_LEVEL_LEN = 2
+
+# Several lights in one write. Data is [pair count, pin, level, pin, level, ...]
+# A frame (seq num + data + checksum) must fit in one SMBus block write.
+# Only boards running application sw LIGHT_BATCH_SW_VERSION or later have this
+# and the buffer credit register.
+I2C_REG_LIGHT_POWER_LEVEL_BATCH = 151
+I2C_LIGHT_BATCH_MAX_PAIRS = (I2C_SMBUS_BLOCK_MAX - 3) // 2
+LIGHT_BATCH_SW_VERSION = (2, 0)
+
+# Read only. Number of (pin, level) pairs the lights board can still buffer
+I2C_REG_LIGHT_BUFFER_CREDIT = 152
+I2C_LIGHT_BUFFER_CREDIT_LEN = 1
+
+# How many times to read the buffer credit waiting for room, and the pause between reads
+LIGHT_CREDIT_POLLS = 10
+LIGHT_CREDIT_POLL_DELAY = 0.001
+# ################################################
+#  Simulated bus (see sim_bus.py)
+# #################################################
+SIM_LATENCY = 0.0001                # seconds of overhead per transaction
+SIM_BIT_RATE = 100000               # standard mode I2C
+SIM_MOMENTUM_RATE = 20              # power level units per second a throttle ramps with momentum on
+SIM_SW_VERSION = "2.0.0"            # application sw of the simulated boards
+SIM_LIGHT_PINS = 32
+SIM_LIGHT_BUFFER = 64               # (pin, level) pairs a lights board can buffer
+SIM_LIGHT_DRAIN_RATE = 2000         # pairs per second a lights board applies
+
+# ################################################
+#  Bus capture (see bus_capture.py)
+# #################################################
+CAPTURE_RECORDS = 100000            # transactions kept. The oldest are dropped.
+CAPTURE_FILE = "bus_capture.bin"
+
+# ################################################
+#  Control daemon (see tc_daemon.py)
+# #################################################
+# A Unix socket path, or [host:]port for TCP (host defaults to localhost)
+DAEMON_ADDRESS = "/tmp/tc_daemon.sock"
+DAEMON_WORKERS = 8                  # RemoteComm threads for work that isn't a single daemon request
+DAEMON_SEND_QUEUE = 1000            # replies and events queued to a client before it is dropped as stalled
@@ -0,0 +1,408 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the control daemon. It owns the I2C buses, the board
+# inventory and the state the boards are known to hold (see ShadowRegisters),
+# and serves any number of clients over a Unix socket or TCP on localhost.
+# The GUI is one such client (see tc_client.py), so bus timing doesn't depend
+# on Tk and more panels or scripts can attach at the same time.
+#
+#     python3 tc.py --daemon                  (Unix socket DAEMON_ADDRESS)
+#     python3 tc.py --daemon 7878             (TCP port 7878 on localhost)
+#     python3 tc.py --connect                 (GUI as a client)
+#
+# Messages are JSON, one per line.
+#
+#     request   {"id": 1, "method": "read_register", "args": [8, 36, 8], "kwargs": {}}
+#     reply     {"id": 1, "result": [36, [1, 1, 0, 0, 0, 0]]}  or  {"id": 1, "error": "..."}
+#     event     {"event": "health", "args": [8, "open"]}
+#
+# Events
+#     inventory   [inventory]         a board came or went
+#     health      [adr, state]        a board was quarantined or recovered
+#     coalesced   [adr, reg, result]  a write_register_coalesced() asked with "callback": true was sent
+#
+# A client that opens with tc_protocol.HELLO speaks the binary protocol
+# instead: commands plus subscriptions to the throttle, light and switch
+# state. The daemon polls the throttle status blocks itself while anyone is
+# subscribed to throttles.
+#
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+from concurrent import futures
+import tc_constants as tcc
+import inventory_cache
+import tc_protocol
+from presence_monitor import PresenceMonitor
+from telemetry import TelemetryScheduler, RATE_FAST, RATE_PAUSED
+
+INVENTORY_CACHE_FILE = "inventory_cache.json"
+
+# I2C_Comm services a client may ask for
+REMOTE_METHODS = frozenset((
+    "probe", "get_controller_list", "get_device_info", "bus_of",
+    "read_register", "read_throttle_status",
+    "write_register_verify", "write_registers_pipelined", "write_register_coalesced", "write_light_levels",
+    "block_read_test", "block_write_test", "loopback_test",
+    "register_state", "invalidate", "health", "reset_health",
+    "pacing", "busy_time", "metrics", "reset_metrics"))
+
+# Results that are dicts with keys JSON can't carry (ints, tuples). They are sent as a list of [key, value].
+ITEM_RESULTS = frozenset(("pacing", "metrics", "register_state"))
+
+
+def parse_address(address):
+    """Return (socket family, socket address) of "/path/to/socket" or "[host:]port" """
+    if "/" in address:
+        return socket.AF_UNIX, address
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "localhost", int(port))
+
+
+class ClientConnection(socketserver.StreamRequestHandler):
+    """One connected client.
+
+    Requests are read here and carried out, one at a time in the order they came, by
+    the connection's own request thread. A long request (i.e. a loopback test) only
+    holds up the client that asked for it. Replies and events are queued to a writer thread, so a client that stops reading (i.e. a hung
+    GUI) never holds up the bus worker. One that falls DAEMON_SEND_QUEUE messages
+    behind is disconnected.
+    """
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.outbox = queue.Queue(maxsize=tcc.DAEMON_SEND_QUEUE)
+        self.closed = False
+        self.binary = False             # speaks tc_protocol rather than JSON
+        self.requests = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="daemon-client")
+        self.name = "client {}".format(self.client_address or "on {}".format(self.server.control.address))
+
+    def handle(self):
+        control = self.server.control
+        control.add_client(self)
+        writer = threading.Thread(target=self.write_loop, name="daemon-writer", daemon=True)
+        writer.start()
+        try:
+            if self.rfile.peek(1)[:1] == tc_protocol.HELLO[:1]:
+                self.binary = True
+                if self.rfile.read(len(tc_protocol.HELLO)) == tc_protocol.HELLO:
+                    control.serve_binary(self)
+                return
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    print("Bad request from {}: {}".format(self.name, line[:80]))
+                    continue
+                self.requests.submit(control.call, self, request)
+        except OSError:
+            pass
+        finally:
+            control.remove_client(self)
+            self.requests.shutdown(wait=False, cancel_futures=True)
+            self.close()
+            writer.join(timeout=1.0)
+
+    def send(self, message):
+        """Queue a JSON message to the client. Safe to call from any thread."""
+        self.send_bytes((json.dumps(message) + "\n").encode())
+
+    def send_bytes(self, data):
+        """Queue data to the client. Safe to call from any thread."""
+        if self.closed:
+            return
+        try:
+            self.outbox.put_nowait(data)
+        except queue.Full:
+            print("{} isn't keeping up. Disconnecting it.".format(self.name))
+            self.close()
+
+    def write_loop(self):
+        while True:
+            data = self.outbox.get()
+            if data is None or self.closed:
+                return
+            try:
+                self.wfile.write(data)
+            except (OSError, ValueError):
+                self.close()
+                return
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.outbox.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class ControlDaemon:
+    def __init__(self, i2c_comm, address=tcc.DAEMON_ADDRESS):
+        """Serve the I2C_Comm services to clients.
+
+        :param i2c_comm: I2C_Comm (or MultiBusComm) object. The daemon is its only user.
+        :param address: Unix socket path or [host:]port. See parse_address().
+        """
+        self.i2c_comm = i2c_comm
+        self.address = address
+        self.inventory = []
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.presence_monitor = PresenceMonitor(i2c_comm, self.board_change)
+        self.i2c_comm.set_health_listener(self.health_change)
+
+        # state published to binary protocol subscribers
+        self.state = tc_protocol.ControlState()
+        self.telemetry = TelemetryScheduler(i2c_comm)
+        self.throttle_sources = []      # telemetry sources of the throttle status blocks
+        self.coalesced_commands = {}    # (adr, reg) -> reply of the coalesced command waiting to be sent
+        self.i2c_comm.set_register_listener(self.register_change)
+
+        family, server_address = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(server_address):
+                os.unlink(server_address)       # left by a daemon that didn't shut down cleanly
+            self.server = socketserver.ThreadingUnixStreamServer(server_address, ClientConnection)
+        else:
+            self.server = socketserver.ThreadingTCPServer(server_address, ClientConnection, bind_and_activate=False)
+            self.server.allow_reuse_address = True
+            self.server.server_bind()
+            self.server.server_activate()
+        self.server.daemon_threads = True
+        self.server.control = self
+
+    def run(self):
+        """Collect the inventory, start watching the bus and serve clients until interrupted"""
+        self.set_inventory(inventory_cache.collect(self.i2c_comm, inventory_cache.load(INVENTORY_CACHE_FILE)))
+        self.presence_monitor.start()
+        self.telemetry.start()
+
+        print("Control daemon listening on {}".format(self.address))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Power down the throttles and stop serving"""
+        self.server.server_close()
+        family, server_address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(server_address):
+            os.unlink(server_address)
+
+        power_status_regs = [tcc.I2C_REG_DT_POWER_STATUS + instance * tcc.DT_THROTTLE_ALLOCATION
+                             for instance in (0, 1)]
+        writes = [self.i2c_comm.write_register_async(entry["i2cAddress"], reg, [tcc.POWER_DISABLED],
+                                                     tcc.PRIORITY_THROTTLE)
+                  for entry in self.get_inventory() if entry["boardType"] == tcc.BOARD_TYPE_THROTTLE
+                  for reg in power_status_regs]
+        futures.wait(writes, timeout=tcc.SHUTDOWN_TIMEOUT)
+
+    def get_inventory(self):
+        with self.lock:
+            return list(self.inventory)
+
+    def set_inventory(self, inventory):
+        present = set(entry["i2cAddress"] for entry in inventory)
+        with self.lock:
+            gone = [entry["i2cAddress"] for entry in self.inventory if entry["i2cAddress"] not in present]
+            self.inventory = inventory
+        self.i2c_comm.assign_buses(inventory)
+        self.presence_monitor.set_inventory(inventory)
+        inventory_cache.save(INVENTORY_CACHE_FILE, inventory)
+
+        for adr in gone:
+            self.state.forget(adr)
+        self.watch_throttles(inventory)
+
+    def board_change(self, inventory):
+        """The presence monitor saw boards come or go. Runs on the monitor thread."""
+        self.set_inventory(inventory)
+        self.broadcast("inventory", inventory)
+
+    def health_change(self, adr, state):
+        """A board was quarantined or has recovered. Runs on the bus worker."""
+        self.broadcast("health", adr, state)
+
+    def add_client(self, client):
+        with self.lock:
+            self.clients.add(client)
+        print("{} connected".format(client.name))
+
+    def remove_client(self, client):
+        with self.lock:
+            self.clients.discard(client)
+        print("{} disconnected".format(client.name))
+
+    def broadcast(self, event, *args):
+        with self.lock:
+            clients = [client for client in self.clients if not client.binary]
+        for client in clients:
+            client.send({"event": event, "args": args})
+
+    def call(self, client, request):
+        """Carry out one request and send the reply. Runs on the client's request thread."""
+        request_id = request.get("id")
+        method = request.get("method")
+        args = request.get("args", [])
+        kwargs = request.get("kwargs", {})
+        try:
+            if method == "inventory":
+                result = self.get_inventory()
+            elif method not in REMOTE_METHODS:
+                raise ValueError("unknown method {}".format(method))
+            else:
+                if method == "write_register_coalesced":
+                    kwargs["callback"] = self.coalesced_callback(client, *args[:2]) if kwargs.get("callback") else None
+                result = getattr(self.i2c_comm, method)(*args, **kwargs)
+                if method == "write_light_levels":
+                    self.lights_written(args[0], args[1], result)
+                if method in ITEM_RESULTS:
+                    result = list(result.items())
+            client.send({"id": request_id, "result": result})
+        except Exception as e:
+            client.send({"id": request_id, "error": "{}: {}".format(type(e).__name__, e)})
+
+    @staticmethod
+    def coalesced_callback(client, adr, reg):
+        return lambda result: client.send({"event": "coalesced", "args": [adr, reg, result]})
+
+    # ########################################################################
+    # State published to the binary protocol subscribers
+    # ########################################################################
+    def register_change(self, adr, reg, data):
+        """A register was confirmed with a new value. Runs on the bus worker."""
+        if reg in tcc.I2C_SETTING_REGISTERS:
+            throttle_instance, field = divmod(reg - tcc.DT_THROTTLE_BASE, tcc.DT_THROTTLE_ALLOCATION)
+            self.state.update(tc_protocol.KIND_THROTTLE, adr, [(throttle_instance, field, data[0])])
+
+    def throttle_status(self, adr, throttle_instance):
+        """Return the telemetry callback publishing a throttle's status block"""
+        return lambda status: self.state.update(tc_protocol.KIND_THROTTLE, adr,
+                                                [(throttle_instance, field, value)
+                                                 for field, value in enumerate(status)])
+
+    def lights_written(self, adr, levels, result):
+        if result[0] == 0:
+            self.state.update(tc_protocol.KIND_LIGHT, adr, [(pin, 0, level) for pin, level in levels])
+
+    def watch_throttles(self, inventory):
+        """Poll the status of each throttle, while anyone is subscribed to throttles"""
+        for name in self.throttle_sources:
+            self.telemetry.unsubscribe(name)
+        self.throttle_sources = []
+        rate = RATE_FAST if self.state.subscribed(tc_protocol.KIND_THROTTLE) else RATE_PAUSED
+        for entry in inventory:
+            if entry["boardType"] != tcc.BOARD_TYPE_THROTTLE:
+                continue
+            adr = entry["i2cAddress"]
+            for throttle_instance in (0, 1):
+                name = "throttle-{}-{}".format(adr, throttle_instance)
+                self.telemetry.subscribe(name, adr, None, 0, self.throttle_status(adr, throttle_instance), rate,
+                                         read=self.throttle_reader(throttle_instance))
+                self.throttle_sources.append(name)
+
+    def throttle_reader(self, throttle_instance):
+        return lambda adr: self.i2c_comm.read_throttle_status(adr, throttle_instance)
+
+    def set_throttle_polling(self):
+        rate = RATE_FAST if self.state.subscribed(tc_protocol.KIND_THROTTLE) else RATE_PAUSED
+        for name in self.throttle_sources:
+            self.telemetry.set_rate(name, rate)
+
+    def serve_binary(self, client):
+        """Read binary protocol frames from client until it goes. Runs on the client's thread.
+
+        Commands are all queued without waiting, so they are handled right here, in order.
+        """
+        try:
+            while True:
+                msg_type, body = tc_protocol.read_frame(client.rfile)
+                if msg_type is None:
+                    return
+                if msg_type in (tc_protocol.MSG_SUBSCRIBE, tc_protocol.MSG_UNSUBSCRIBE) and len(body) == 1:
+                    if msg_type == tc_protocol.MSG_SUBSCRIBE:
+                        self.state.subscribe(client.send_bytes, body[0])
+                    else:
+                        self.state.unsubscribe(client.send_bytes, body[0])
+                    self.set_throttle_polling()
+                elif msg_type == tc_protocol.MSG_COMMAND and len(body) >= tc_protocol.COMMAND.size:
+                    request_id, command = tc_protocol.COMMAND.unpack_from(body)
+                    self.binary_command(client, request_id, command, body[tc_protocol.COMMAND.size:])
+                else:
+                    print("Bad frame (type {}) from {}".format(msg_type, client.name))
+        finally:
+            self.state.unsubscribe(client.send_bytes)
+            self.set_throttle_polling()
+
+    def binary_command(self, client, request_id, command, args):
+        def reply(status):
+            client.send_bytes(tc_protocol.result_frame(request_id, status))
+
+        def write_done(result):
+            reply(tc_protocol.STATUS_OK if result[0] == 0 else tc_protocol.STATUS_FAILED)
+
+        if command == tc_protocol.CMD_THROTTLE and len(args) == 4:
+            adr, throttle_instance, field, value = args
+            if throttle_instance > 1 or field > tc_protocol.FIELD_EMERGENCY_STOP or field == tc_protocol.FIELD_SPEED:
+                reply(tc_protocol.STATUS_BAD_COMMAND)
+                return
+            reg = tcc.DT_THROTTLE_BASE + throttle_instance * tcc.DT_THROTTLE_ALLOCATION + field
+            if field == tc_protocol.FIELD_POWER_LEVEL:
+                self.coalesced_throttle_command(adr, reg, value, reply, write_done)
+            elif field == tc_protocol.FIELD_EMERGENCY_STOP:
+                self.i2c_comm.write_register_async(adr, reg, [value], tcc.PRIORITY_EMERGENCY_STOP, write_done)
+            else:
+                self.i2c_comm.write_register_async(adr, reg, [value], tcc.PRIORITY_THROTTLE, write_done)
+
+        elif command == tc_protocol.CMD_LIGHTS and len(args) >= 3 and len(args) % 2 == 1:
+            adr = args[0]
+            levels = [(args[i], args[i + 1]) for i in range(1, len(args), 2)]
+
+            def lights_done(result):
+                self.lights_written(adr, levels, result)
+                write_done(result)
+            self.i2c_comm.write_light_levels_async(adr, levels, tcc.PRIORITY_LIGHTS, lights_done)
+
+        elif command == tc_protocol.CMD_SWITCH and len(args) == tc_protocol.SWITCH.size:
+            # Switches have no board registers yet. The daemon holds the positions for the panels.
+            number, position = tc_protocol.SWITCH.unpack(args)
+            self.state.update(tc_protocol.KIND_SWITCH, 0, [(number, 0, position)])
+            reply(tc_protocol.STATUS_OK)
+
+        else:
+            reply(tc_protocol.STATUS_BAD_COMMAND)
+
+    def coalesced_throttle_command(self, adr, reg, value, reply, write_done):
+        """Power level commands (i.e. from a slider) are coalesced. One replaced by a newer
+        value before it was sent is answered STATUS_SUPERSEDED."""
+        key = (adr, reg)
+
+        def done(result):
+            with self.lock:
+                if self.coalesced_commands.get(key) is reply:
+                    del self.coalesced_commands[key]
+            write_done(result)
+
+        with self.lock:
+            replaced = self.i2c_comm.write_register_coalesced(adr, reg, [value], tcc.PRIORITY_THROTTLE, done)
+            previous = self.coalesced_commands.get(key) if replaced else None
+            self.coalesced_commands[key] = reply
+        if previous is not None:
+            previous(tc_protocol.STATUS_SUPERSEDED)
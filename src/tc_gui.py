@@ -9,7 +9,8 @@
 # to present a GUI to the cash flow report.
 #
 
-from time import sleep
+import threading
+from concurrent import futures
 import tkinter as tk
 import tkinter.ttk as ttk
 import tc_constants as tcc
@@ -18,25 +19,50 @@ from lights import LightsTab
 from switches import SwitchesTab
 from inventory import InventoryTab
 from raspArduinoTest import RaspArduinoTestTab
+from ui_dispatch import UiDispatcher
+from presence_monitor import PresenceMonitor
+from telemetry import TelemetryScheduler
+import inventory_cache
 import tc_styles
 
 LIGHTS_FILE="lights.csv"
+SCENES_FILE="scenes.csv"
+INVENTORY_CACHE_FILE="inventory_cache.json"
 
 class TcGui:
-    def __init__(self, i2c_comm):
+    def __init__(self, i2c_comm, remote=False):
         """Create the Train control GUI
 
         The init method creates the user frame and related objects.
         The run() function puts it up on the screen.
+
+        :param i2c_comm: I2C_Comm object, or a tc_client.RemoteComm if remote
+        :param remote: True if the GUI is a client of the control daemon (see tc_daemon.py).
+                       The daemon then owns the inventory and watches for boards coming and going.
         """
 
         self.i2c_comm = i2c_comm
+        self.remote = remote
         self.board_inventory = []
+        self.inventory_loaded = False
 
         self.root = tk.Tk()
         self.root.title("Train Control Platform")
         self.root.protocol("WM_DELETE_WINDOW", self.tc_exit)
 
+        # bus completions are delivered to the widgets on the Tk thread
+        self.ui_dispatcher = UiDispatcher(self.root)
+        self.i2c_comm.set_callback_dispatcher(self.ui_dispatcher.post)
+        self.i2c_comm.set_health_listener(self.health_change)
+
+        if remote:
+            self.presence_monitor = None
+            self.i2c_comm.set_inventory_listener(self.board_change)
+        else:
+            self.presence_monitor = PresenceMonitor(self.i2c_comm, self.board_change)
+        self.telemetry = TelemetryScheduler(self.i2c_comm)
+        self.telemetry.set_dispatcher(self.ui_dispatcher.update)
+
         tc_styles.set_styles()
 
         # option: height and width of the notebook in the frame
@@ -47,13 +73,14 @@ class TcGui:
         self.notebook.pack(fill=tk.BOTH, expand=1)
 
         # padding -> around the frame when the tab is selected
-        self.throttleTab = ThrottleTab(self.notebook, i2c_comm, relief=tk.RIDGE)
+        self.throttleTab = ThrottleTab(self.notebook, i2c_comm, self.telemetry, relief=tk.RIDGE)
         self.notebook.add(self.throttleTab, text="Throttle", padding=tcc.tab_padding)
 
         self.switchesTab = SwitchesTab(self.notebook, i2c_comm, relief=tk.RIDGE)
         self.notebook.add(self.switchesTab, text="Switches", padding=tcc.tab_padding)
 
-        self.lightsTab = LightsTab(self.notebook, LIGHTS_FILE, i2c_comm, relief=tk.RIDGE)
+        self.lightsTab = LightsTab(self.notebook, LIGHTS_FILE, SCENES_FILE, i2c_comm, self.ui_dispatcher,
+                                   relief=tk.RIDGE)
         self.notebook.add(self.lightsTab, text="Lights", padding=tcc.tab_padding)
 
         self.inventoryTab = InventoryTab(self, self.notebook, relief=tk.RIDGE)
@@ -66,11 +93,19 @@ class TcGui:
         """Run the GUI
         :return: None
         """
-        self.board_inventory = self.collect_inventory()
-        self.throttleTab.update_inventory(self.board_inventory)
-        self.lightsTab.update_inventory(self.board_inventory)
-        self.inventoryTab.update_inventory(self.board_inventory)
-        self.raspArduinoTestTab.update_inventory(self.board_inventory)
+        if self.remote:
+            self.apply_inventory(self.i2c_comm.get_inventory())
+        else:
+            cached_inventory = inventory_cache.load(INVENTORY_CACHE_FILE)
+            if cached_inventory:
+                # Put the GUI up from the cache and check it against the hardware in the background
+                self.apply_inventory(cached_inventory)
+                threading.Thread(target=self.validate_inventory, args=(cached_inventory,), daemon=True).start()
+            else:
+                self.apply_inventory(self.collect_inventory())
+        if self.presence_monitor is not None:
+            self.presence_monitor.start()
+        self.telemetry.start()
 
         # get screen width and height
         ws = self.root.winfo_screenwidth()  # width of the screen
@@ -91,24 +126,47 @@ class TcGui:
 
         self.root.mainloop()
 
-    def collect_inventory(self):
-        """Use the I2C_Comm services to collect inventory information.
-
-        This function uses the I2C bus to collect inventory information from all connect
-        board controllers.
+    def apply_inventory(self, inventory):
+        """Hand a new inventory to the tabs. Runs on the Tk thread.
 
-        :return: board_inventory - a list of dictionary entries describing each board in the system.
+        Nothing is done if the inventory hasn't changed since the last one applied.
         """
-        dev_list = self.i2c_comm.get_controller_list()
+        added, removed, changed = inventory_cache.delta(self.board_inventory, inventory)
+        if self.inventory_loaded and not (added or removed or changed):
+            return
+        self.inventory_loaded = True
+        self.board_inventory = inventory
+        self.i2c_comm.assign_buses(inventory)
+        if self.presence_monitor is not None:
+            self.presence_monitor.set_inventory(inventory)
+
+        self.throttleTab.update_inventory(self.board_inventory)
+        self.lightsTab.update_inventory(self.board_inventory)
+        self.inventoryTab.update_inventory(self.board_inventory)
+        self.raspArduinoTestTab.update_inventory(self.board_inventory)
+
+        if not self.remote:
+            inventory_cache.save(INVENTORY_CACHE_FILE, self.board_inventory)
+
+    def board_change(self, inventory):
+        """The presence monitor (or the daemon) saw boards come or go. Runs on the monitor (or client) thread."""
+        self.ui_dispatcher.post(self.apply_inventory, inventory)
+
+    def health_change(self, adr, state):
+        """A board was quarantined or has recovered. Runs on the bus worker."""
+        self.ui_dispatcher.post(self.inventoryTab.update_health, adr, state)
 
-        board_inventory = []
-        for dev in dev_list:
-            adr = int(dev, base=16)
-            board_inventory.append(self.i2c_comm.get_device_info(adr))
+    def validate_inventory(self, cached_inventory):
+        """Check the cached inventory against the hardware. Runs on a background thread."""
+        inventory = self.collect_inventory(cached_inventory)
+        self.ui_dispatcher.post(self.apply_inventory, inventory)
 
-        return board_inventory
+    def collect_inventory(self, cached_inventory=()):
+        """Collect the inventory from the boards. See inventory_cache.collect()"""
+        return inventory_cache.collect(self.i2c_comm, cached_inventory)
 
     def tc_exit(self):
-        self.throttleTab.shutDown()
-        sleep(.5)
+        # make sure the power off reaches the throttles before we go
+        pending = [write for write in self.throttleTab.shutDown() if write is not None]
+        futures.wait(pending, timeout=tcc.SHUTDOWN_TIMEOUT)
         exit()
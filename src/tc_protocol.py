@@ -0,0 +1,173 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the compact binary protocol of the control daemon (see
+# tc_daemon.py). Control panels use it to send commands and to keep in sync
+# with the layout: they subscribe to the throttles, lights and switches and
+# are sent only the fields that change, rather than polling.
+#
+# A client opens with the 4 bytes of HELLO, on the daemon's usual socket, and
+# from then on both sides send frames. All values are big endian.
+#
+#     length  uint16   bytes of body
+#     type    uint8    MSG_xxx
+#     body
+#
+# Client -> daemon
+#     MSG_SUBSCRIBE    kinds (uint8, KIND_xxx bits). The daemon sends a MSG_DELTA with the
+#                      current state of those kinds, then one each time some of it changes.
+#     MSG_UNSUBSCRIBE  kinds
+#     MSG_COMMAND      id (uint16), command (uint8), then
+#                        CMD_THROTTLE  adr, throttle instance, field, value        (uint8 each)
+#                        CMD_LIGHTS    adr, then (pin, level) pairs                (uint8 each)
+#                        CMD_SWITCH    switch number (uint16), position (uint8)
+#
+# Daemon -> client
+#     MSG_DELTA        entries of kind, adr, index, field, value (uint8, uint8, uint16, uint8, uint8)
+#                        KIND_THROTTLE  index = throttle instance, field = I2C_REG_DT_xxx - DT_THROTTLE_BASE
+#                        KIND_LIGHT     index = pin, field 0 = power level
+#                        KIND_SWITCH    adr 0, index = switch number, field 0 = position
+#     MSG_RESULT       id (uint16), status (uint8 STATUS_xxx) of a command
+#
+
+import struct
+import threading
+import tc_constants as tcc
+
+HELLO = b"TCB\x01"
+
+HEADER = struct.Struct("!HB")
+ENTRY = struct.Struct("!BBHBB")
+COMMAND = struct.Struct("!HB")
+RESULT = struct.Struct("!HB")
+SWITCH = struct.Struct("!HB")
+MAX_BODY = 0xFFFF
+
+# Message types
+MSG_SUBSCRIBE = 1
+MSG_UNSUBSCRIBE = 2
+MSG_COMMAND = 3
+MSG_DELTA = 16
+MSG_RESULT = 17
+
+# Kinds of state. Bits, so several can be subscribed to at once.
+KIND_THROTTLE = 1
+KIND_LIGHT = 2
+KIND_SWITCH = 4
+KIND_ALL = KIND_THROTTLE | KIND_LIGHT | KIND_SWITCH
+
+# Commands
+CMD_THROTTLE = 1
+CMD_LIGHTS = 2
+CMD_SWITCH = 3
+
+# Throttle fields (offsets of the I2C_REG_DT_xxx registers). Speed is read only.
+FIELD_POWER_STATUS = tcc.I2C_REG_DT_POWER_STATUS - tcc.DT_THROTTLE_BASE
+FIELD_DIRECTION = tcc.I2C_REG_DT_DIRECTION - tcc.DT_THROTTLE_BASE
+FIELD_MOMENTUM = tcc.I2C_REG_DT_MOMENTUM - tcc.DT_THROTTLE_BASE
+FIELD_POWER_LEVEL = tcc.I2C_REG_DT_POWER_LEVEL - tcc.DT_THROTTLE_BASE
+FIELD_SPEED = tcc.I2C_REG_DT_SPEED - tcc.DT_THROTTLE_BASE
+FIELD_EMERGENCY_STOP = tcc.I2C_REG_DT_EMERGENCY_STOP - tcc.DT_THROTTLE_BASE
+
+# Switch positions
+SWITCH_THRU = 0
+SWITCH_DIVERT = 1
+
+# Command results
+STATUS_OK = 0
+STATUS_FAILED = 1               # the board didn't take the write
+STATUS_SUPERSEDED = 2           # a newer power level for the same throttle was sent instead
+STATUS_BAD_COMMAND = 3
+
+
+def frame(msg_type, body=b""):
+    return HEADER.pack(len(body), msg_type) + body
+
+
+def delta_frames(entries):
+    """Encode (kind, adr, index, field, value) entries as one or more MSG_DELTA frames"""
+    per_frame = MAX_BODY // ENTRY.size
+    return b"".join(frame(MSG_DELTA, b"".join(ENTRY.pack(*entry) for entry in entries[i:i + per_frame]))
+                    for i in range(0, max(1, len(entries)), per_frame))
+
+
+def decode_delta(body):
+    return [ENTRY.unpack_from(body, offset) for offset in range(0, len(body) - ENTRY.size + 1, ENTRY.size)]
+
+
+def result_frame(request_id, status):
+    return frame(MSG_RESULT, RESULT.pack(request_id, status))
+
+
+def read_frame(stream):
+    """Read one frame from a binary file object.
+
+    :return: (type, body), (None, None) at end of stream
+    """
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None, None
+    length, msg_type = HEADER.unpack(header)
+    body = stream.read(length)
+    if len(body) < length:
+        return None, None
+    return msg_type, body
+
+
+class ControlState:
+    def __init__(self):
+        """The layout state published to subscribed clients.
+
+        Each change is encoded once and the same frame queued to every subscriber, so a
+        change costs about the same however many clients are attached.
+        """
+        self.values = {}                # (kind, adr, index, field) -> value
+        self.subscribers = {}           # send(frame) -> KIND_xxx bits
+        self.lock = threading.Lock()
+
+    def update(self, kind, adr, changes):
+        """Record new values and send those that changed to the subscribers of kind.
+
+        :param changes: list of (index, field, value)
+        """
+        with self.lock:
+            entries = []
+            for index, field, value in changes:
+                key = (kind, adr, index, field)
+                if self.values.get(key) != value:
+                    self.values[key] = value
+                    entries.append(key + (value,))
+            if not entries:
+                return
+            # sent under the lock so every subscriber sees the changes in the same order
+            data = delta_frames(entries)
+            for send, kinds in self.subscribers.items():
+                if kinds & kind:
+                    send(data)
+
+    def forget(self, adr):
+        """Drop the state of the board at adr (i.e. it has gone)"""
+        with self.lock:
+            self.values = {key: value for key, value in self.values.items()
+                           if key[0] == KIND_SWITCH or key[1] != adr}
+
+    def subscribe(self, send, kinds):
+        """Send the current state of kinds to send(frame), then every change to it"""
+        with self.lock:
+            self.subscribers[send] = self.subscribers.get(send, 0) | kinds
+            send(delta_frames([key + (value,) for key, value in sorted(self.values.items()) if key[0] & kinds]))
+
+    def unsubscribe(self, send, kinds=KIND_ALL):
+        with self.lock:
+            remaining = self.subscribers.pop(send, 0) & ~kinds
+            if remaining:
+                self.subscribers[send] = remaining
+
+    def subscribed(self, kind):
+        """True if any client is subscribed to kind"""
+        with self.lock:
+            return any(kinds & kind for kinds in self.subscribers.values())
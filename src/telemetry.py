@@ -0,0 +1,169 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the scheduler that polls the boards for telemetry
+# (i.e. throttle speed) and hands the readings to whoever subscribed.
+#
+
+import threading
+from time import monotonic
+import tc_constants as tcc
+
+RATE_FAST = 'fast'
+RATE_SLOW = 'slow'
+RATE_PAUSED = 'paused'
+
+
+class TelemetrySource:
+    def __init__(self, name, adr, reg, data_length, callback, rate, decode=None, read=None):
+        """A register polled by the TelemetryScheduler
+
+        :param name: unique name of the source
+        :param adr: I2C address. 0 means not bound to a board (not polled)
+        :param reg: register to read
+        :param data_length: passed to I2C_Comm.read_register()
+        :param callback: callback(reg_data) made on each good read, via the scheduler's dispatcher
+        :param rate: RATE_FAST, RATE_SLOW or RATE_PAUSED
+        :param decode: optional decode(reg_data). If given, the callback gets the decoded value.
+        :param read: optional read(adr), made on the bus worker instead of reading reg. It returns
+                     the value for the callback, None if the read failed.
+        """
+        self.name = name
+        self.adr = adr
+        self.reg = reg
+        self.data_length = data_length
+        self.callback = callback
+        self.rate = rate
+        self.decode = decode
+        self.read = read
+        self.next_due = 0
+        self.failing = False            # the last read failed
+
+
+class TelemetryScheduler(threading.Thread):
+    def __init__(self, i2c_comm, fast_interval=tcc.TELEMETRY_FAST_INTERVAL,
+                 slow_interval=tcc.TELEMETRY_SLOW_INTERVAL):
+        """Single thread polling all telemetry registers.
+
+        All of the reads that are due are queued to the bus worker together, at polling
+        priority, and the results published once the batch is done. Each source is
+        polled at the rate its owner asks for: fast while active, slow while idle, or
+        not at all while paused.
+        """
+        threading.Thread.__init__(self, name="telemetry", daemon=True)
+        self.i2c_comm = i2c_comm
+        self.intervals = {RATE_FAST: fast_interval, RATE_SLOW: slow_interval}
+        self.sources = {}               # name -> TelemetrySource
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.dispatcher = None
+        self.error_listener = None
+
+    def set_dispatcher(self, dispatcher):
+        """Set the function used to publish readings.
+
+        :param dispatcher: dispatcher(name, callback, reg_data) - typically UiDispatcher.update
+                           so readings are deduplicated and applied on the Tk thread. If None,
+                           callbacks are made directly on the scheduler thread.
+        """
+        self.dispatcher = dispatcher
+
+    def set_error_listener(self, on_error):
+        """on_error(name, error) is called, from the scheduler thread, each time a read fails.
+
+        If no listener is set, the first failure of a source is printed and nothing more
+        until it reads again.
+        """
+        self.error_listener = on_error
+
+    def subscribe(self, name, adr, reg, data_length, callback, rate=RATE_SLOW, decode=None, read=None):
+        """Add (or replace) a telemetry source. See TelemetrySource for the parameters."""
+        with self.lock:
+            self.sources[name] = TelemetrySource(name, adr, reg, data_length, callback, rate, decode, read)
+        self.wakeup.set()
+
+    def unsubscribe(self, name):
+        with self.lock:
+            self.sources.pop(name, None)
+
+    def set_address(self, name, adr):
+        """Rebind a source to a board. adr 0 stops the polling."""
+        with self.lock:
+            self.sources[name].adr = adr
+            self.sources[name].next_due = 0
+        self.wakeup.set()
+
+    def set_rate(self, name, rate):
+        with self.lock:
+            source = self.sources[name]
+            if source.rate == rate:
+                return
+            source.rate = rate
+            source.next_due = 0
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                timeout = self.poll()
+            except Exception as e:
+                # i.e. a callback made on this thread raised. Keep polling for everyone else.
+                print("Telemetry poll failed: {}: {}".format(type(e).__name__, e))
+                timeout = self.intervals[RATE_SLOW]
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def poll(self):
+        """Read every source that is due.
+
+        :return: seconds until the next source is due, None if nothing is being polled
+        """
+        now = monotonic()
+        with self.lock:
+            active = [source for source in self.sources.values()
+                      if source.adr and source.rate != RATE_PAUSED]
+            due = [source for source in active if source.next_due <= now]
+            for source in due:
+                source.next_due = now + self.intervals[source.rate]
+
+        reads = [(source, self.submit_read(source)) for source in due]
+        for source, read in reads:
+            try:
+                if source.read is not None:
+                    value = read.result()
+                    if value is None:
+                        continue
+                else:
+                    reg, reg_data = read.result()
+                    if reg < 0:
+                        continue
+                    value = tuple(reg_data) if source.decode is None else source.decode(reg_data)
+            except Exception as e:
+                self.read_failed(source, e)
+                continue
+            source.failing = False
+            if self.dispatcher is None:
+                source.callback(value)
+            else:
+                self.dispatcher(source.name, source.callback, value)
+
+        if not active:
+            return None
+        return max(0, min(source.next_due for source in active) - monotonic())
+
+    def submit_read(self, source):
+        if source.read is not None:
+            return self.i2c_comm.submit_to(source.adr, tcc.PRIORITY_POLLING, source.read, source.adr)
+        return self.i2c_comm.submit_to(source.adr, tcc.PRIORITY_POLLING, self.i2c_comm.read_register,
+                                       source.adr, source.reg, source.data_length)
+
+    def read_failed(self, source, error):
+        if self.error_listener is not None:
+            self.error_listener(source.name, error)
+        elif not source.failing:
+            print("Telemetry read of {} failed: {}".format(source.name, error))
+        source.failing = True
@@ -12,23 +12,27 @@
 
 import tkinter as tk
 import tkinter.ttk as ttk
-import threading
+from time import monotonic
 import tc_constants as tcc
+import telemetry
 # import tc_styles
-from time import sleep
 
 throttle_a_instance = 0
 throttle_b_instance = 1
 
 class ThrottleTab(ttk.Frame):
-    def __init__(self, master, i2c_comm, **kwargs):
+    def __init__(self, master, i2c_comm, telemetry_scheduler, **kwargs):
         """Throttle Frame contains Throttles for 2 locomotive
 
         :param master: Notebook holding the Throttle frame
         :param i2c_comm - I2C_Comm object
+        :param telemetry_scheduler - TelemetryScheduler used to poll the throttle speeds
         :param kwargs:
         """
         self.i2c_comm = i2c_comm
+        self.telemetry = telemetry_scheduler
+        self.notebook = master
+        self.visible = True                 # we are the first tab in the notebook
 
         ttk.Frame.__init__(self, master, style='DarkGray.TFrame', **kwargs)
         self.throttle_A = Throttle(self, 'Locomotive A', throttle_a_instance)
@@ -42,15 +46,34 @@ class ThrottleTab(ttk.Frame):
         self.grid_columnconfigure(1, weight=1, uniform="group1")
         self.grid_rowconfigure(0, weight=1)
 
+        # no point polling the speed while nobody can see it
+        self.notebook.bind('<<NotebookTabChanged>>', self.tab_changed, add='+')
+
+    def tab_changed(self, event):
+        self.visible = self.notebook.select() == str(self)
+        self.throttle_A.update_telemetry_rate()
+        self.throttle_B.update_telemetry_rate()
+
     def update_inventory(self, inventory):
+        """Bind the throttles to the throttle board. If the board has gone, unbind them."""
+        throttle_address = 0
         for entry in inventory:
             if entry['boardType'] == tcc.BOARD_TYPE_THROTTLE:
-                self.throttle_A.set_i2c_address(entry['i2cAddress'])
-                self.throttle_B.set_i2c_address(entry['i2cAddress'])
+                throttle_address = entry['i2cAddress']
+
+        if throttle_address:
+            self.throttle_A.set_i2c_address(throttle_address)
+            self.throttle_B.set_i2c_address(throttle_address)
+        else:
+            self.throttle_A.clear_i2c_address()
+            self.throttle_B.clear_i2c_address()
 
     def shutDown(self):
-        self.throttle_A.shutDown()
-        self.throttle_B.shutDown()
+        """Power down both throttles.
+
+        :return: list of Futures for the writes, so the caller can wait for them
+        """
+        return [self.throttle_A.shutDown(), self.throttle_B.shutDown()]
 
 
 class Throttle(ttk.Frame):
@@ -63,6 +86,13 @@ class Throttle(ttk.Frame):
         self.parent = throttle_tab
         self.throttle_address = 0
         self.throttle_instance = throttle_instance
+        self.powered = False
+        self.power_setting = 0              # last power level sent (0-200)
+        self.speed = 0                      # last speed read (0-200)
+        self.board_status = None            # last ThrottleStatus read from the board
+        self.last_write_time = 0
+        self.reconcile_pending = None       # after() id of a reconcile waiting out the settle time
+        self.telemetry_name = "throttle-{}-status".format(throttle_instance)
 
         ttk.Frame.__init__(self, throttle_tab,
                            style='MediumGray.TFrame',
@@ -91,36 +121,91 @@ class Throttle(ttk.Frame):
         self.grid_columnconfigure(1, weight=1, uniform="group2")
         self.grid_columnconfigure(2, weight=1, uniform="group2")
 
+        # On boards with a status block the whole status costs the same single read as
+        # the speed register alone. read_throttle_status() picks the registers to read.
+        i2c_comm = self.parent.i2c_comm
+        self.parent.telemetry.subscribe(self.telemetry_name, 0, None, 0, self.status_reading,
+                                        read=lambda adr: i2c_comm.read_throttle_status(adr, self.throttle_instance))
+
     def set_i2c_address(self, adr):
+        """Bind the throttle to the board at adr. May be called again as the inventory is refreshed."""
+        if adr == self.throttle_address:
+            return
         self.throttle_address = adr
 
-        # Configure the board
-        self.power_state('off')
+        # Configure the board. A board that has come back has lost its settings,
+        # so drop the panel back to power off as well.
+        if self.button_panel.power_on:
+            self.button_panel.master_power_but_pressed()
+        else:
+            self.power_state('off')
         self.power_level(0)
         self.set_direction('forward')
         self.set_momentum('off')
 
-        self.start_daemon();
+        self.parent.telemetry.set_address(self.telemetry_name, adr)
 
-    def start_daemon(self):
-        """This daemon will collect speed information from the throttle board."""
-        x = threading.Thread(target=self.poll_speed, daemon=True)
-        x.start()
+    def clear_i2c_address(self):
+        """The throttle board has gone. Stop talking to it until it comes back."""
+        self.throttle_address = 0
+        self.parent.telemetry.set_address(self.telemetry_name, 0)
+
+    def update_telemetry_rate(self):
+        """Poll the speed quickly while the train is (or may be) moving, slowly when it is idle."""
+        if not self.parent.visible:
+            rate = telemetry.RATE_PAUSED
+        elif self.powered and (self.power_setting > 0 or self.speed > 0):
+            rate = telemetry.RATE_FAST
+        else:
+            rate = telemetry.RATE_SLOW
+        self.parent.telemetry.set_rate(self.telemetry_name, rate)
 
-    def poll_speed(self):
-        """This function regularly polls the board for current speed setting.
+    def status_reading(self, status):
+        """Telemetry callback with the board's ThrottleStatus. Runs on the Tk thread, only when the status changes.
 
         Note that internally we use 0-200 but the scale slider uses 0-100, hence the divide by 2."""
-
-        speed_reg = tcc.I2C_REG_DT_SPEED + (tcc.DT_THROTTLE_ALLOCATION * self.throttle_instance)
-        while (1):
-            sleep(0.1)
-            reg, speed = self.parent.i2c_comm.read_register(self.throttle_address, speed_reg, tcc.I2C_REG_ID_LEN + tcc.I2C_DT_SPEED_LEN)
-            if reg > 0:
-                self.speed_setting(speed[0]/2)
+        self.board_status = status
+        self.speed = status.speed
+        self.update_telemetry_rate()
+        self.speed_setting(self.speed/2)
+        self.reconcile()
+
+    def reconcile(self):
+        """Bring the GUI and the board back in line if they disagree.
+
+        If the board has dropped power (i.e. it reset) the GUI follows the board. Otherwise
+        the GUI is the authority and its direction and momentum are sent again. Nothing is
+        done until our own writes have had time to show up in the status.
+        """
+        status = self.board_status
+        if status is None or not self.throttle_address or not self.powered:
+            return
+        settle = self.last_write_time + tcc.THROTTLE_RECONCILE_SETTLE - monotonic()
+        if settle > 0:
+            if self.reconcile_pending is None:
+                self.reconcile_pending = self.after(int(settle * 1000) + 1, self.settled)
+            return
+
+        if status.power_status == tcc.POWER_DISABLED:
+            print("Throttle {} at adr {} has lost power".format(self.throttle_instance, self.throttle_address))
+            self.button_panel.master_power_but_pressed()
+            return
+
+        direction = tcc.DIR_FORWARD if self.button_panel.direction == 'forward' else tcc.DIR_REVERSE
+        if status.direction != direction:
+            self.set_direction(self.button_panel.direction)
+
+        momentum = tcc.MOMENTUM_ENABLED if self.button_panel.momentum == 'on' else tcc.MOMENTUM_DISABLED
+        if status.momentum != momentum:
+            self.set_momentum(self.button_panel.momentum)
+
+    def settled(self):
+        """Our writes have had time to show up in the status. Runs on the Tk thread."""
+        self.reconcile_pending = None
+        self.reconcile()
 
     def speed_setting(self, value):
-        """Speed setting has changed. This change was reported by poll_speed() running on a different thread.
+        """Speed setting has changed. This change was reported by the telemetry scheduler.
 
         :param value: current value (0-100)
         :return: None
@@ -131,29 +216,42 @@ class Throttle(ttk.Frame):
         """Power state of Throttle has changed. The user pressed the button
 
         :param state: 'on'/'off'
-        :return: None
+        :return: Future for the board write (None if there is no board)
         """
         power_status_reg = tcc.I2C_REG_DT_POWER_STATUS + (tcc.DT_THROTTLE_ALLOCATION * self.throttle_instance)
 
+        self.powered = state == 'on'
+        self.update_telemetry_rate()
+
         if state == 'on':
             self.power_control.config_scale('active')
             self.speedometer.config_scale('active')
 
-            self.parent.i2c_comm.write_register_verify(self.throttle_address, power_status_reg, [tcc.POWER_ENABLED])
+            return self.write_register(power_status_reg, tcc.POWER_ENABLED)
         else:
             self.power_control.config_scale('disabled')
             self.speedometer.config_scale('disabled')
 
-            self.parent.i2c_comm.write_register_verify(self.throttle_address, power_status_reg, [tcc.POWER_DISABLED])
+            return self.write_register(power_status_reg, tcc.POWER_DISABLED)
 
     def power_level(self, new_power_level):
         """User has changed the power level. Send it to the board
 
         Note that the range from the scale is 0-100 but internally, we use 0-200.
+
+        The slider fires for every pixel of motion. Coalesce the writes so the board
+        only ever gets the latest setting instead of replaying the whole drag.
         """
         power_level_reg = tcc.I2C_REG_DT_POWER_LEVEL + (tcc.DT_THROTTLE_ALLOCATION * self.throttle_instance)
 
-        self.parent.i2c_comm.write_register_verify(self.throttle_address, power_level_reg, [new_power_level])
+        self.power_setting = new_power_level
+        self.update_telemetry_rate()
+
+        if not self.throttle_address:
+            return
+        self.last_write_time = monotonic()
+        self.parent.i2c_comm.write_register_coalesced(self.throttle_address, power_level_reg, [new_power_level],
+                                                      priority=tcc.PRIORITY_THROTTLE, callback=self.write_complete)
 
     def set_direction(self, new_direction):
         """User has pressed the direction button. Send it to the throttle board.
@@ -164,9 +262,9 @@ class Throttle(ttk.Frame):
         direction_reg = tcc.I2C_REG_DT_DIRECTION + (tcc.DT_THROTTLE_ALLOCATION * self.throttle_instance)
 
         if new_direction == 'forward':
-            self.parent.i2c_comm.write_register_verify(self.throttle_address, direction_reg, [tcc.DIR_FORWARD])
+            self.write_register(direction_reg, tcc.DIR_FORWARD)
         else:
-            self.parent.i2c_comm.write_register_verify(self.throttle_address, direction_reg, [tcc.DIR_REVERSE])
+            self.write_register(direction_reg, tcc.DIR_REVERSE)
 
     def set_momentum(self, new_momentum):
         """User has pressed the momentum button. Send it to the throttle board
@@ -177,9 +275,9 @@ class Throttle(ttk.Frame):
         momentum_reg = tcc.I2C_REG_DT_MOMENTUM + (tcc.DT_THROTTLE_ALLOCATION * self.throttle_instance)
 
         if new_momentum == 'on':
-            self.parent.i2c_comm.write_register_verify(self.throttle_address, momentum_reg, [tcc.MOMENTUM_ENABLED])
+            self.write_register(momentum_reg, tcc.MOMENTUM_ENABLED)
         else:
-            self.parent.i2c_comm.write_register_verify(self.throttle_address, momentum_reg, [tcc.MOMENTUM_DISABLED])
+            self.write_register(momentum_reg, tcc.MOMENTUM_DISABLED)
 
     def execute_stop(self):
         # update the power control so it doesn't jack the power back up
@@ -187,10 +285,33 @@ class Throttle(ttk.Frame):
 
         emergency_stop_reg = tcc.I2C_REG_DT_EMERGENCY_STOP + (tcc.DT_THROTTLE_ALLOCATION * self.throttle_instance)
 
-        self.parent.i2c_comm.write_register_verify(self.throttle_address, emergency_stop_reg, [tcc.STOP_ACTIVATED])
+        self.write_register(emergency_stop_reg, tcc.STOP_ACTIVATED, priority=tcc.PRIORITY_EMERGENCY_STOP)
+
+    def write_register(self, reg, value, priority=tcc.PRIORITY_THROTTLE):
+        """Queue a write of value to the given throttle board register.
+
+        The write is handed to the bus worker so the GUI never waits on the bus.
+        write_complete() is called back on the Tk thread once it is done.
+
+        :return: Future for the write (None if there is no board)
+        """
+        if not self.throttle_address:
+            return None
+        self.last_write_time = monotonic()
+        return self.parent.i2c_comm.write_register_async(self.throttle_address, reg, [value],
+                                                         priority=priority, callback=self.write_complete)
+
+    def write_complete(self, result):
+        """A throttle write has completed.
+
+        :param result: (uncorrected_errors, read_exception, write_exception, data_mismatch)
+        """
+        if result[0] > 0:
+            print("Throttle write to adr {} failed".format(self.throttle_address))
 
     def shutDown(self):
-        self.power_state('off')
+        """Power down the throttle. Returns the Future for the write (None if there is no board)"""
+        return self.power_state('off')
 
 class ButtonPanel(ttk.Frame):
     def __init__(self, throttle_frame, **kwargs):
@@ -426,13 +547,14 @@ class ScaledSlider(ttk.Frame):
     def set_reading(self, value):
         """Used to set current value for tracking_only
 
+        The value is set through the scale's variable. That works whatever state the
+        scale is in, so there is no need to toggle the state (and redraw) for each reading.
+
         :param value:
         :return:
         """
-        if self.tracking_only:
-            self.scale.state(['!disabled'])
-            self.scale.set(value)
-            self.scale.state(['disabled'])
+        if self.tracking_only and self.scale_value.get() != value:
+            self.scale_value.set(value)
 
     def config_scale(self, state):
         """States: active, disabled
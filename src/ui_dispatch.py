@@ -0,0 +1,95 @@
+#
+# Author: Greg Glezman
+#
+# SCCSID : "%W% %G%
+#
+# Copyright (c) 2020 G.Glezman.  All Rights Reserved.
+#
+# This file contains the dispatcher used to get work from other threads
+# (i.e. bus worker completions) back onto the Tk thread.
+#
+
+import queue
+import threading
+import traceback
+import tc_constants as tcc
+
+
+class UiDispatcher:
+    def __init__(self, root, interval=tcc.UI_DISPATCH_INTERVAL):
+        """Marshal calls from any thread onto the Tk event loop.
+
+        Tkinter widgets may only be touched from the thread running mainloop(). Other
+        threads post() their calls here and the Tk thread drains them every interval ms.
+
+        Readings (i.e. telemetry) go through update() instead. Only the latest value
+        for a key is kept, values that haven't changed are dropped, and whatever is left
+        is applied once per drain, so the display is redrawn at most once a frame.
+
+        :param root: Tk root window
+        :param interval: ms between drains of the pending queue
+        """
+        self.root = root
+        self.interval = interval
+        self.pending = queue.SimpleQueue()
+        self.update_lock = threading.Lock()
+        self.updates = {}           # key -> (func, value) waiting for the next drain
+        self.applied = {}           # key -> value last handed to func
+        self.root.after(self.interval, self.drain)
+
+    def post(self, func, *args):
+        """Queue func(*args) to be run on the Tk thread. Safe to call from any thread."""
+        self.pending.put((func, args))
+
+    def update(self, key, func, value):
+        """Queue func(value) to be run on the Tk thread. Safe to call from any thread.
+
+        If another update for key arrives before the next drain it replaces this one.
+        Nothing is done if value is the same as the last value applied for key.
+        """
+        with self.update_lock:
+            if key not in self.updates and key in self.applied and self.applied[key] == value:
+                return
+            self.updates[key] = (func, value)
+
+    def drain(self):
+        """Run everything posted since the last drain. Runs on the Tk thread.
+
+        A callback that raises is reported and skipped; the rest still run and the
+        next drain is always scheduled.
+        """
+        try:
+            while True:
+                try:
+                    func, args = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                self.run(func, *args)
+
+            with self.update_lock:
+                updates, self.updates = self.updates, {}
+                for key, (func, value) in list(updates.items()):
+                    if key in self.applied and self.applied[key] == value:
+                        del updates[key]
+                    else:
+                        self.applied[key] = value
+            for key, (func, value) in updates.items():
+                if not self.run(func, value):
+                    with self.update_lock:
+                        self.applied.pop(key, None)     # so the same value is tried again
+        finally:
+            self.root.after(self.interval, self.drain)
+
+    @staticmethod
+    def run(func, *args):
+        """Call func(*args), reporting rather than raising any error.
+
+        :return: True if func returned normally
+        """
+        try:
+            func(*args)
+            return True
+        except Exception as e:
+            print("UI callback {} failed: {}: {}".format(getattr(func, "__qualname__", func), type(e).__name__, e))
+            traceback.print_exc()
+            return False